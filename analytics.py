@@ -0,0 +1,131 @@
+"""A flat, typed table of every play, for analysis with pandas/Altair. This replaces
+concatenating Playlist.to_json() for every playlist: one query instead of an ORM walk,
+compact dtypes (categoricals for repeated strings, int32 milliseconds, float32 features),
+and missing audio features come through as NaN rather than an exception.
+
+    import analytics
+    plays = analytics.plays_frame(cache_dir='.cache')
+    stats = analytics.playlist_stats(plays)
+
+pandas is needed here, but not by the web app; pyarrow too if you use the Parquet cache.
+Both are listed as optional in requirements.txt.
+"""
+
+import glob
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness',
+            'loudness', 'speechiness', 'valence', 'tempo']
+
+PLAYS_SQL = """
+select p.playlist_id, p.name playlist_name, p.date, pt.sequence,
+       t.track_id, t.spotify_id, t.name, t.duration_ms, t.explicit, t.popularity,
+       album.name album,
+       (select a.name from track_artist ta, artist a
+         where ta.track_id = t.track_id and a.artist_id = ta.artist_id order by ta.rowid limit 1) artist,
+       (select group_concat(name, ', ') from (select a.name from track_artist ta, artist a
+         where ta.track_id = t.track_id and a.artist_id = ta.artist_id order by ta.rowid)) artists,
+       (select group_concat(distinct g.name) from track_artist ta, artist_genre ag, genre g
+         where ta.track_id = t.track_id and ag.artist_id = ta.artist_id and g.genre_id = ag.genre_id) genres,
+       af.key, af.mode, af.time_signature,
+       af.acousticness, af.danceability, af.energy, af.instrumentalness, af.liveness,
+       af.loudness, af.speechiness, af.valence, af.tempo
+from playlist p
+     join playlist_track pt on pt.playlist_id = p.playlist_id
+     join track t on t.track_id = pt.track_id
+     left join album on album.album_id = t.album_id
+     left join audio_features af on af.track_id = t.track_id
+order by p.date, pt.playlist_id, pt.sequence
+"""
+
+DTYPES = {
+    'playlist_id': 'int32',
+    'sequence': 'int32',
+    'track_id': 'int32',
+    'duration_ms': 'int32',
+    'explicit': 'boolean',
+    'popularity': 'Int8',
+    'key': 'Int8',
+    'mode': 'Int8',
+    'time_signature': 'Int8',
+    'playlist_name': 'category',
+    'spotify_id': 'category',
+    'name': 'category',
+    'album': 'category',
+    'artist': 'category',
+    'artists': 'category',
+    'genres': 'category',
+}
+DTYPES.update((f, 'float32') for f in FEATURES)
+
+def _connect(sqlite_filepath):
+    return sqlite3.connect(f"file:{sqlite_filepath}?mode=ro", uri=True)
+
+def _generation(conn):
+    try:
+        row = conn.execute("select value from generation").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+def plays_frame(sqlite_filepath='birdnest.db', cache_dir=None):
+    """Return a DataFrame with one row per play, in playlist order. `start_time_ms` is
+    how far into its playlist each track started.
+
+    If `cache_dir` is set, the frame is saved there as Parquet and re-used until the next
+    ingest bumps the database's generation."""
+    conn = _connect(sqlite_filepath)
+    try:
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, f"plays-{_generation(conn)}.parquet")
+            if os.path.exists(cache_path):
+                return pd.read_parquet(cache_path)
+        df = pd.read_sql(PLAYS_SQL, conn, parse_dates=['date'])
+    finally:
+        conn.close()
+
+    df = df.astype(DTYPES)
+    ends = df.groupby('playlist_id', sort=False)['duration_ms'].cumsum()
+    df['start_time_ms'] = (ends - df['duration_ms']).astype('int32')
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old in glob.glob(os.path.join(cache_dir, 'plays-*.parquet')):
+            os.remove(old)
+        df.to_parquet(cache_path)
+    return df
+
+def playlist_stats(df):
+    """Summarize each playlist in the same shape as AudioFeatures, with each feature
+    averaged over the tracks which have it, weighted by track length. `key` and `mode`
+    are the ones which account for the most time. Expects a frame from plays_frame()."""
+    by_playlist = df.groupby('playlist_id', sort=False)
+    stats = pd.DataFrame({
+        'date': by_playlist['date'].first(),
+        'playlist_name': by_playlist['playlist_name'].first(),
+        'tracks': by_playlist.size().astype('int32'),
+        'duration_ms': by_playlist['duration_ms'].sum().astype('int64'),
+    })
+
+    features = df[FEATURES].to_numpy(dtype='float64')
+    weights = df['duration_ms'].to_numpy(dtype='float64')[:, np.newaxis]
+    present = ~np.isnan(features)
+    weighted = pd.DataFrame(np.where(present, features * weights, 0), columns=FEATURES, index=df.index)
+    total_weight = pd.DataFrame(np.where(present, weights, 0), columns=FEATURES, index=df.index)
+    sums = weighted.groupby(df['playlist_id'], sort=False).sum()
+    totals = total_weight.groupby(df['playlist_id'], sort=False).sum()
+    stats[FEATURES] = (sums / totals.where(totals > 0)).astype('float32')
+
+    for col in ['key', 'mode']:
+        durations = df.dropna(subset=[col]).groupby(['playlist_id', col], sort=False)['duration_ms'].sum()
+        if len(durations):
+            top = durations.sort_values().groupby(level='playlist_id').tail(1).reset_index(level=col)[col]
+            stats[col] = top.reindex(stats.index).astype('Int8')
+        else:
+            stats[col] = pd.Series(pd.NA, index=stats.index, dtype='Int8')
+    return stats
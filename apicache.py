@@ -0,0 +1,99 @@
+"""An on-disk cache of Spotify API responses, so that re-ingests and notebook sessions
+don't keep asking the API for things we already know. Responses are stored in a small
+SQLite file, keyed by endpoint and Spotify ID. A cache opened with `replay_only=True`
+never expires anything and raises CacheMiss instead of going to the network, which
+makes ingests repeatable offline."""
+
+import json
+import sqlite3
+import threading
+import time
+
+DAY = 24 * 60 * 60
+
+# seconds. albums and tracks hardly change; artist popularity and followers drift.
+DEFAULT_TTLS = {
+    'album': 90 * DAY,
+    'track': 30 * DAY,
+    'audio_features': 365 * DAY,
+    'artist': 1 * DAY,
+    'playlist_tracks': 60 * 60,
+    'user_playlists': 10 * 60,
+}
+
+class CacheMiss(KeyError):
+    """Raised in replay-only mode when a response was never recorded"""
+    def __init__(self, endpoint, keys):
+        super().__init__(f"{endpoint}: no recorded response for {', '.join(map(str, keys))}")
+        self.endpoint = endpoint
+        self.keys = keys
+
+class ResponseCache():
+
+    def __init__(self, path='spotify_cache.db', ttls=None, max_bytes=256 * 1024 * 1024, replay_only=False):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""create table if not exists response (
+            endpoint text, key text, body text, size integer, fetched_at real, accessed_at real,
+            primary key (endpoint, key))""")
+        self._conn.execute("create index if not exists response_accessed on response (accessed_at)")
+        self._conn.commit()
+
+    def get_many(self, endpoint, keys):
+        """Return a dict of key->response for those `keys` which are cached and fresh"""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        min_fetched = 0 if self.replay_only else now - self.ttls.get(endpoint, DAY)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute(f"""select key, body from response
+                    where endpoint = ? and fetched_at >= ? and key in ({marks})""",
+                    [endpoint, min_fetched] + chunk)
+                found.update((k, json.loads(body)) for k, body in rows)
+            if found and not self.replay_only:
+                self._conn.executemany("update response set accessed_at = ? where endpoint = ? and key = ?",
+                                       [(now, endpoint, k) for k in found])
+                self._conn.commit()
+        return found
+
+    def get(self, endpoint, key):
+        return self.get_many(endpoint, [key]).get(key)
+
+    def put_many(self, endpoint, items):
+        """Store (key, response) pairs, then evict the least recently used responses if
+        the cache has grown past `max_bytes`"""
+        if self.replay_only:
+            return
+        now = time.time()
+        rows = []
+        for k, v in items:
+            body = json.dumps(v)
+            rows.append((endpoint, k, body, len(body), now, now))
+        with self._lock:
+            self._conn.executemany("insert or replace into response values (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("""delete from response where rowid in (
+                select rowid from (
+                    select rowid, sum(size) over (order by accessed_at desc, rowid desc) running
+                    from response)
+                where running > ?)""", (self.max_bytes,))
+            self._conn.commit()
+
+    def put(self, endpoint, key, value):
+        self.put_many(endpoint, [(key, value)])
+
+    def clear(self, endpoint=None):
+        with self._lock:
+            if endpoint:
+                self._conn.execute("delete from response where endpoint = ?", (endpoint,))
+            else:
+                self._conn.execute("delete from response")
+            self._conn.commit()
@@ -1,77 +1,290 @@
-from flask import Flask, request, render_template, abort
-from sqlalchemy.engine import create_engine
+from flask import Flask, request, render_template, abort, Response, jsonify, stream_with_context
+from markupsafe import Markup, escape
 from sqlalchemy.orm import sessionmaker, scoped_session
-from models import Artist, Database, Genre, Playlist
+from models import Artist, Track, HIGHLIGHT_START, HIGHLIGHT_END
+import cooccurrence
+import indexfiles
+import membership
+import metrics
+import queries
+import similarity
+import snapshot
+import storage
+from cache import GenerationWatcher, RenderCache, SearchCache
 from datetime import date
 from collections import Counter
+from functools import lru_cache, wraps
+import hashlib
+import json
 import os 
+import re
 
 app = Flask(__name__,
     static_folder='static'
     )
+metrics.instrument_app(app) # see metrics.py for BIRDNEST_METRICS_DIR and BIRDNEST_SLOW_REQUEST_MS
 
 # from https://towardsdatascience.com/use-flask-and-sqlalchemy-not-flask-sqlalchemy-5a64fafe22a4
-SQLALCHEMY_DATABASE_URL = 'sqlite:///birdnest.db'
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={
-    "check_same_thread": False
-})
+# read-only connections, so serving never blocks (or is blocked by) an ingest; see storage.py
+db_path = os.environ.get('BIRDNEST_DB', 'birdnest.db')
+engine = storage.web_engine(db_path)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 app.session = scoped_session(SessionLocal)
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    app.session.remove()
+
+# export_static.py sets BIRDNEST_STATIC_EXPORT: its pages have no server behind them, so
+# they leave out whatever needs one (the search typeahead), and aren't shared with its cache
+app.config['STATIC_EXPORT'] = bool(os.environ.get('BIRDNEST_STATIC_EXPORT'))
+
+# Rendered pages are kept until an ingest bumps the data generation. Each worker has its
+# own LRU; set BIRDNEST_PAGE_CACHE_DIR to share pages between workers on disk as well, up
+# to BIRDNEST_PAGE_CACHE_DISK_SIZE of them per generation.
+generation = GenerationWatcher(engine)
+page_cache = RenderCache(max_entries=int(os.environ.get('BIRDNEST_PAGE_CACHE_SIZE', 256)),
+                         disk_dir=None if app.config['STATIC_EXPORT'] else os.environ.get('BIRDNEST_PAGE_CACHE_DIR'),
+                         max_disk_entries=int(os.environ.get('BIRDNEST_PAGE_CACHE_DISK_SIZE', 10000)))
+# Search rankings, keyed by normalized terms, so "Sun Ra Arkestra" and "ra sun  arkestra" share one
+search_cache = SearchCache(generation, max_entries=int(os.environ.get('BIRDNEST_SEARCH_CACHE_SIZE', 1024)))
+# "more like this", memory-mapped from the index which ingest maintains; see similarity.py
+similar = similarity.Index(similarity.index_dir(db_path))
+# who gets played alongside whom; see cooccurrence.py
+cooccurring = indexfiles.Reloader(cooccurrence.index_dir(db_path), cooccurrence.load)
+# which playlists have which tracks and artists, as bitsets; see membership.py
+members = indexfiles.Reloader(membership.index_dir(db_path), membership.load)
+# BIRDNEST_SNAPSHOT=1 serves pages from an in-memory copy of the data; see snapshot.py
+snapshots = snapshot.Holder(db_path, generation) if os.environ.get('BIRDNEST_SNAPSHOT') else None
+
+def read(name, *args, **kwargs):
+    """queries.<name>(app.session, ...), or the same from the snapshot if we're serving from one"""
+    current = snapshots.get() if snapshots else None
+    if current is not None:
+        return getattr(current, name)(*args, **kwargs)
+    return getattr(queries, name)(app.session, *args, **kwargs)
+
+def cached_page(*args):
+    """Serve a view from page_cache when we can, with a strong ETag and Last-Modified
+    so that browsers can revalidate with a conditional GET and get a 304. `args` are the
+    query parameters the view reads; pages are cached by those alone, so that any other
+    query string (/?x=1, /?x=2...) gets the same page rather than another cache entry."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            current, updated = generation.get()
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(request.args.get(a) for a in args))
+            page = page_cache.get(current, key)
+            if page is None:
+                rendered = app.make_response(view(**kwargs))
+                if rendered.status_code != 200:
+                    return rendered
+                page = page_cache.put(current, key, rendered.get_data())
+            response = Response(page.body, mimetype='text/html')
+            response.set_etag(page.etag)
+            response.last_modified = updated
+            response.cache_control.no_cache = True # always revalidate; it's cheap
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def generation_etag(view):
+    """For views which stream their response, so there's no body to hash for an ETag. The data
+    only changes with the generation, so an ETag made from that and the URL does as well,
+    and a conditional GET gets its 304 before any query is run."""
+    @wraps(view)
+    def wrapper(**kwargs):
+        current, updated = generation.get()
+        etag = hashlib.sha1(f"{current}:{request.full_path}".encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(**kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = updated
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+def stream_json_lines(rows, start='', separator='\n', end='\n', chunk_size=200):
+    """Serialize dicts as JSON one at a time, yielding them a chunk of rows at a time"""
+    chunk = [start]
+    first = True
+    for row in rows:
+        if not first:
+            chunk.append(separator)
+        chunk.append(json.dumps(row))
+        first = False
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(end)
+    yield ''.join(chunk)
+
+def parse_playlist_date(date_str):
+    try:
+        (year,month,day) = map(int,date_str.split('-',3))
+        return date(year,month,day)
+    except Exception:
+        return None
+
 @app.route('/')
+@cached_page()
 def index():
-    playlists = app.session.query(Playlist).order_by(Playlist.date.desc()).all()
-    return render_template("index.html", playlists=playlists)
+    return render_template("index.html", playlists=read('playlist_tiles'))
+
+@lru_cache(maxsize=256)
+def _highlight_pattern(terms):
+    words = sorted(set(re.escape(w) for w in terms.replace('"', ' ').lower().split()), key=len, reverse=True)
+    return re.compile(r'(?<!\w)((?:' + '|'.join(words) + r')\w*)', re.IGNORECASE) if words else None
+
+@app.template_filter('highlight')
+def highlight(value, terms):
+    """Escape `value`, wrapping any words which start with one of the search `terms` in <mark>"""
+    pattern = _highlight_pattern(terms or '')
+    value = str(escape(value or ''))
+    if pattern:
+        value = pattern.sub(r'<mark>\1</mark>', value)
+    return Markup(value)
+
+def parse_cursor(cursor):
+    """A search results `after` parameter is 'score:track_id'"""
+    if not cursor:
+        return None
+    try:
+        score, track_id = cursor.rsplit(':', 1)
+        return int(track_id), float(score)
+    except ValueError:
+        abort(400)
 
 @app.route('/search')
+@cached_page('q', 'after')
 def search():
-    db = Database()
     terms = request.args.get('q')
+    after = parse_cursor(request.args.get('after'))
+    more = None
     if terms:
-        tracks = db.search_tracks(app.session, terms)
+        tracks, next_page = queries.search_tracks(app.session, terms, after=after, cache=search_cache,
+                                                  load=lambda ids: read('track_rows', ids))
+        if next_page:
+            more = f"{next_page[1]!r}:{next_page[0]}"
     else:
         tracks = None
-    return render_template("search_results.html", tracks=tracks, terms=terms)
+    return render_template("search_results.html", tracks=tracks, terms=terms, more=more, paged=after is not None)
+
+def _marked(value):
+    return str(escape(value or '')).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+def _unmarked(value):
+    return (value or '').replace(HIGHLIGHT_START, '').replace(HIGHLIGHT_END, '')
+
+@app.route('/search/suggest')
+def search_suggest():
+    """Typeahead suggestions as JSON, from the search index alone. Each has the plain text
+    of its artist, track and album, and an HTML version with the matches in <mark>."""
+    suggestions = []
+    for row in queries.suggest(app.session, request.args.get('q', '')):
+        suggestion = {'track_id': row['track_id']}
+        for column in ('artist', 'track', 'album'):
+            suggestion[column] = _unmarked(row[column])
+            suggestion[f'{column}_html'] = _marked(row[column])
+        suggestions.append(suggestion)
+    return jsonify(suggestions)
 
 @app.route('/genre/<genre_name>')
+@cached_page()
 def genre(genre_name):
-    genre_obj = app.session.query(Genre).filter(Genre.name == genre_name).first()
-    if not genre_obj:
+    found = read('genre', genre_name)
+    if not found:
         abort(404)
-    genre_obj.artists.sort(key=lambda a: -1 * a.popularity) # reverse popularity sort
-    return render_template('genre.html',genre_name=genre_name,genre_obj=genre_obj)
+    genre_obj, plays, genre_stats = found
+    co = cooccurring.get()
+    by_id = dict((a.artist_id, a) for a in genre_obj.artists)
+    circles = [[by_id[a] for a in circle] for circle in co.circles(list(by_id))] if co else []
+    return render_template('genre.html',genre_name=genre_name,genre_obj=genre_obj,plays=plays,genre_stats=genre_stats,circles=circles)
 
 @app.route('/genres')
+@cached_page()
 def genres():
-    genres = sorted(set(x.name for x in app.session.query(Genre).order_by(Genre.name)))
-    return render_template('genres.html', genres=genres)
+    return render_template('genres.html', genres=read('genres'))
 
 @app.route('/artist/<spotify_id>')
+@cached_page()
 def artist(spotify_id):
-    artist = app.session.query(Artist).filter(Artist.spotify_id == spotify_id).first()
+    artist = read('artist', spotify_id)
     if not artist:
         abort(404)
-    return render_template('artist.html',artist=artist)
+    similar_artists = read('similar_artists', similar.get('artists'), [artist.artist_id]).get(artist.artist_id, [])
+    alongside = read('played_alongside', cooccurring.get(), artist.artist_id)
+    circle = read('circle', cooccurring.get(), artist.artist_id)
+    tracks = read('artist_tracks', artist.artist_id)
+    return render_template('artist.html',artist=artist,tracks=tracks,similar_artists=similar_artists,alongside=alongside,circle=circle)
 
 @app.route('/artists')
+@cached_page()
 def artists():
-    artists = app.session.query(Artist).all()
-    from collections import Counter
-    artist_count = ((a.name,len(a.tracks)) for a in artists)
-    return render_template("artists.html",artist_count_json=json.dumps(artist_count))
+    return render_template("artists.html", artists=read('artist_leaderboard'))
 
 
 @app.route('/playlist/<date_str>')
+@cached_page()
 def show_playlist(date_str):
-    try:
-        (year,month,day) = map(int,date_str.split('-',3))
-        playlist_date = date(year,month,day)
-    except Exception:
+    playlist_date = parse_playlist_date(date_str)
+    if playlist_date is None:
         return "Invalid playlist URL", 400 
-    playlist = app.session.query(Playlist).filter(Playlist.date == playlist_date).scalar()
+    playlist = read('playlist_by_date', playlist_date)
     if playlist is None:
         return f"No playlist for {date_str}", 404
-    return render_template("playlist.html", playlist=playlist)
+    tracks = read('playlist_tracks', playlist.playlist_id)
+    more_like = read('more_like', similar.get('tracks'), [t.track_id for t in tracks])
+    repeats = queries.repeats(members.get(), playlist.playlist_id)
+    return render_template("playlist.html", playlist=playlist, tracks=tracks, more_like=more_like, repeats=repeats)
+
+@app.route('/playlist/<date_str>.json')
+@generation_etag
+def playlist_json(date_str):
+    """A playlist's tracks as a JSON array, like Playlist.to_json, streamed"""
+    playlist_date = parse_playlist_date(date_str)
+    if playlist_date is None:
+        return "Invalid playlist URL", 400
+    if not queries.playlist_exists(app.session, playlist_date):
+        return f"No playlist for {date_str}", 404
+    rows = queries.plays(app.session, playlist_date)
+    return Response(stream_with_context(stream_json_lines(rows, '[', ',\n', ']\n')), mimetype='application/json')
+
+@app.route('/export/tracks.ndjson')
+@generation_etag
+def export_tracks():
+    """Every play of every playlist, one JSON object per line, streamed"""
+    rows = queries.plays(app.session)
+    return Response(stream_with_context(stream_json_lines(rows)), mimetype='application/x-ndjson')
+
+SIMILAR_KINDS = {
+    'artists': (queries.similar_artists, Artist),
+    'tracks': (queries.similar_tracks, Track),
+}
+
+@app.route('/similar/<kind>.json')
+@generation_etag
+def similar_json(kind):
+    """The tracks or artists most like each of a batch of them, given as ?id=<spotify_id>&id=...
+    (up to 100), with their similarity scores, top `k` (up to 50) first"""
+    if kind not in SIMILAR_KINDS:
+        abort(404)
+    find, model = SIMILAR_KINDS[kind]
+    spotify_ids = request.args.getlist('id')[:100]
+    k = min(request.args.get('k', queries.SIMILAR_LIMIT, type=int), 50)
+    pks = dict(app.session.query(model.spotify_id, model.__mapper__.primary_key[0]).filter(model.spotify_id.in_(spotify_ids)))
+    found = find(app.session, similar.get(kind), list(pks.values()), k)
+    results = {}
+    for spotify_id in spotify_ids:
+        results[spotify_id] = [dict(spotify_id=o.spotify_id, name=o.name, score=round(score, 4),
+                                    **({'artists': o.artists_str()} if kind == 'tracks' else {}))
+                               for o, score in found.get(pks.get(spotify_id), [])]
+    return jsonify(results)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
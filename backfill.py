@@ -0,0 +1,84 @@
+"""Bring the database up to date with every Conference of the Birds playlist, not just the
+latest one. Playlists whose snapshot_id matches the one we stored are skipped, as are
+artists fetched within --artist-max-age-days, so the cost of a run is proportional to what
+has changed. The rest are ingested a batch at a time, with their tracks and artists
+fetched concurrently.
+
+Each batch is committed along with its playlists' snapshot_ids, so the database itself is
+the checkpoint: an interrupted run, re-run, resumes with the first batch that didn't commit.
+
+    python backfill.py [--batch-size 10] [--workers 8] [--requests-per-second 10]
+"""
+import argparse
+import os
+import time
+from datetime import timedelta
+
+import cooccurrence
+import membership
+import metrics
+import models
+import similarity
+import storage
+from apicache import ResponseCache
+from spotclient import Client
+
+def rate(n, seconds):
+    return f"{n / seconds:,.1f}/s" if seconds else "-"
+
+def report(db, client, playlists_done, elapsed):
+    rows = sum(db.rows_written.values())
+    print(f"{playlists_done} playlists in {elapsed:.1f}s ({rate(playlists_done, elapsed)})")
+    print(f"  fetch:  {client.api_calls} API calls in {db.timings['fetch']:.1f}s ({rate(client.api_calls, db.timings['fetch'])})")
+    print(f"  write:  {rows:,} rows in {db.timings['write']:.1f}s ({rate(rows, db.timings['write'])})"
+          f" -- {', '.join(f'{t} {n:,}' for t, n in db.rows_written.most_common())}")
+    print(f"  search index: {db.timings['index']:.1f}s")
+    print(f"  skipped: {db.skipped['artist']:,} artists fetched within {db.artist_max_age / timedelta(days=1):g} days")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch-size', type=int, default=10, help='playlists per transaction')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent API requests')
+    parser.add_argument('--requests-per-second', type=float, default=10)
+    parser.add_argument('--db', default='birdnest.db')
+    parser.add_argument('--artist-max-age-days', type=float,
+                        help="refetch artists' popularity and followers when older than this (default: BIRDNEST_ARTIST_MAX_AGE_DAYS, or 30)")
+    parser.add_argument('--metrics-file', help='save SQL and API metrics here, in Prometheus text format')
+    args = parser.parse_args()
+
+    cache = ResponseCache('spotify_cache.db', replay_only=bool(os.environ.get('BIRDNEST_REPLAY', False)))
+    client = Client(max_workers=args.workers, requests_per_second=args.requests_per_second, cache=cache)
+    max_age = timedelta(days=args.artist_max_age_days) if args.artist_max_age_days is not None else None
+    db = models.Database(args.db, api_client=client, artist_max_age=max_age)
+    session = models.get_session(args.db, create_all=True)
+
+    start = time.monotonic()
+    birds = client.allbirds(refresh=True)
+    stored = dict(session.query(models.Playlist.spotify_id, models.Playlist.snapshot_id))
+    todo = [p for p in birds if p.get('snapshot_id') is None or stored.get(p['id']) != p.get('snapshot_id')]
+    print(f"{len(birds)} playlists on Spotify, {len(todo)} new or changed "
+          f"({client.api_calls} API calls, {time.monotonic() - start:.1f}s)")
+
+    done = 0
+    try:
+        for batch in models.chunked(todo, args.batch_size):
+            db.insert_playlists_from_json(session, batch)
+            session.commit()
+            done += len(batch)
+            elapsed = time.monotonic() - start
+            print(f"[{done}/{len(todo)}] through {batch[-1]['name']} ({rate(done, elapsed)} playlists)")
+    except KeyboardInterrupt:
+        session.rollback()
+        print(f"interrupted; {done} playlists were saved and will be skipped next time")
+
+    if done:
+        similarity.update_after_ingest(session, args.db)
+        cooccurrence.update_after_ingest(session, args.db)
+        membership.update_after_ingest(session, args.db)
+    storage.finish_ingest(session)
+    report(db, client, done, time.monotonic() - start)
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+
+if __name__ == '__main__':
+    main()
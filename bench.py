@@ -0,0 +1,217 @@
+"""Benchmarks for ingest, the search index and the web pages, run against synthetic data
+(see synthetic.py) so that they need neither Spotify nor the real birdnest.db.
+
+    python bench.py                              # 10 and 500 playlists
+    python bench.py --scale 10 500 5000 --out before.json
+    python bench.py --out after.json --compare before.json
+
+For each scale this builds a fresh database in --workdir, then times:
+
+* ingest: every playlist through Database.insert_playlists_from_json, a batch at a time
+* rebuild_fts: rebuilding the search index from scratch
+* search: queries.search_tracks for a few kinds of query, without the search cache
+* routes: each Flask route through the test client, both uncached (page and search
+  caches cleared before every request) and from the page cache
+
+Timings are in milliseconds: the median, 95th percentile and minimum of --repeat runs.
+Results are saved as JSON, and --compare prints the ratio of each median to an earlier run's.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+from datetime import datetime
+
+import models
+import queries
+import storage
+import synthetic
+
+def summarize(seconds):
+    seconds = sorted(seconds)
+    ms = lambda s: round(s * 1000, 3)
+    return {
+        'median_ms': ms(seconds[len(seconds) // 2]),
+        'p95_ms': ms(seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))]),
+        'min_ms': ms(seconds[0]),
+        'runs': len(seconds),
+    }
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+def bench_ingest(db_path, data, batch_size):
+    client = synthetic.StubClient(data)
+    db = models.Database(db_path, api_client=client)
+    session = models.get_session(db_path, create_all=True)
+    playlists = list(reversed(client.allbirds())) # oldest first, as backfill would
+    start = time.perf_counter()
+    for batch in models.chunked(playlists, batch_size):
+        db.insert_playlists_from_json(session, batch)
+        session.commit()
+    elapsed = time.perf_counter() - start
+    storage.finish_ingest(session)
+    rows = sum(db.rows_written.values())
+    return {
+        'playlists': len(playlists),
+        'seconds': round(elapsed, 3),
+        'playlists_per_second': round(len(playlists) / elapsed, 2),
+        'rows_per_second': round(rows / elapsed, 1),
+        'rows_written': dict(db.rows_written),
+        'stage_seconds': {stage: round(s, 3) for stage, s in db.timings.items()},
+    }
+
+def bench_rebuild_fts(db_path, repeat):
+    db = models.Database(db_path, api_client=synthetic.StubClient(None))
+    session = models.get_session(db_path, create_all=False)
+    def rebuild():
+        db.rebuild_fts(session)
+        session.commit()
+    result = timed(rebuild, repeat)
+    storage.finish_ingest(session)
+    return result
+
+def search_terms(db_path):
+    """A common word, a whole artist name, an unfinished word (as typed ahead), and a
+    rare word, all taken from the data itself"""
+    conn = sqlite3.connect(db_path)
+    artist = conn.execute("""select a.name from artist a join artist_plays p on p.artist_id = a.artist_id
+        order by p.plays desc limit 1""").fetchone()[0]
+    conn.close()
+    return {
+        'common word': 'the',
+        'top artist': artist,
+        'prefix': 'su',
+        'rare word': synthetic.WORDS[-1],
+        'no match': 'zzyzx',
+    }
+
+def bench_search(db_path, repeat):
+    session = sessionmaker_for(db_path)()
+    results = {}
+    for label, terms in search_terms(db_path).items():
+        first_page, _ = queries.search_tracks(session, terms)
+        result = timed(lambda: queries.search_tracks(session, terms), repeat)
+        result.update(terms=terms, results=len(first_page))
+        results[label] = result
+    session.close()
+    return results
+
+def sessionmaker_for(db_path):
+    from sqlalchemy.orm import sessionmaker
+    return sessionmaker(bind=storage.web_engine(db_path))
+
+def routes(db_path):
+    conn = sqlite3.connect(db_path)
+    genre = conn.execute("""select g.name from genre g join genre_plays p on p.genre_id = g.genre_id
+        order by p.plays desc limit 1""").fetchone()
+    artist = conn.execute("""select a.spotify_id from artist a join artist_plays p on p.artist_id = a.artist_id
+        order by p.plays desc limit 1""").fetchone()[0]
+    latest = conn.execute("select max(date) from playlist").fetchone()[0]
+    conn.close()
+    urls = ['/', '/genres', '/artists', f'/artist/{artist}', f'/playlist/{latest}',
+            '/search?q=the', '/search?q=su', '/search/suggest?q=su']
+    if genre:
+        urls.insert(3, f'/genre/{genre[0]}')
+    return urls
+
+def bench_routes(db_path, repeat):
+    os.environ['BIRDNEST_DB'] = db_path
+    os.environ.pop('BIRDNEST_PAGE_CACHE_DIR', None)
+    import app as app_module
+    app_module = importlib.reload(app_module) # a fresh engine and caches for this database
+    client = app_module.app.test_client()
+    def uncached(url):
+        app_module.page_cache.memory.clear()
+        app_module.search_cache.memory.clear()
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    results = {}
+    for url in routes(db_path):
+        result = {'uncached': timed(lambda: uncached(url), repeat)}
+        client.get(url)
+        result['cached'] = timed(lambda: client.get(url), repeat)
+        results[url] = result
+    app_module.engine.dispose()
+    return results
+
+def run(scale, args):
+    db_path = os.path.join(args.workdir, f"bench-{scale}.db")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    print(f"{scale} playlists: generating")
+    data = synthetic.SyntheticData(playlists=scale, seed=args.seed)
+    print("  ingesting")
+    result = {'ingest': bench_ingest(db_path, data, args.batch_size)}
+    print(f"  {result['ingest']['playlists_per_second']} playlists/s; rebuilding search index")
+    result['rebuild_fts'] = bench_rebuild_fts(db_path, max(1, args.repeat // 5))
+    print("  searching")
+    result['search'] = bench_search(db_path, args.repeat)
+    print("  rendering pages")
+    result['routes'] = bench_routes(db_path, args.repeat)
+    return result
+
+def medians(results, path=()):
+    """Every median_ms in a results tree, by its path"""
+    for key, value in results.items():
+        if key == 'median_ms':
+            yield path, value
+        elif isinstance(value, dict):
+            yield from medians(value, path + (key,))
+
+def compare(before, after):
+    old = dict(medians(before['results']))
+    for path, value in medians(after['results']):
+        if path in old and old[path]:
+            print(f"{value / old[path]:6.2f}x  {old[path]:10.2f}ms -> {value:10.2f}ms  {' / '.join(path)}")
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', type=int, nargs='+', default=[10, 500], help='numbers of playlists')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per timing')
+    parser.add_argument('--batch-size', type=int, default=10, help='playlists per ingest transaction')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default='bench')
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--compare', help='an earlier --out to compare with')
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    output = {
+        'run': {
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'results': {str(scale): run(scale, args) for scale in args.scale},
+    }
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"saved {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+if __name__ == '__main__':
+    main()
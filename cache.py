@@ -0,0 +1,180 @@
+"""Caches for the web app. The data only changes when an ingest commits, and every ingest
+bumps the generation counter in the database, so anything we derive from the data can be
+kept until the generation moves on."""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+import metrics
+import models
+
+SEARCH_CACHE_LOOKUPS = metrics.REGISTRY.counter('birdnest_search_cache_lookups_total', 'Search ranking cache lookups, by result')
+
+class GenerationWatcher():
+    """The database's current generation and when it was last bumped, re-read at most
+    every `interval` seconds, so that checking it doesn't cost a query per request."""
+
+    def __init__(self, engine, interval=1.0):
+        self.engine = engine
+        self.interval = interval
+        self._current = (0, datetime(1970, 1, 1))
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= self.interval:
+                try:
+                    row = self.engine.execute(select([models.generation.c.value, models.generation.c.updated])).first()
+                except OperationalError: # not created yet
+                    row = None
+                if row is not None:
+                    self._current = tuple(row)
+                self._checked = now
+            return self._current
+
+class LRUCache():
+    """A thread-safe dict which forgets its least recently used entries beyond `max_entries`"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+Page = namedtuple('Page', ['body', 'etag'])
+
+class RenderCache():
+    """Rendered pages, keyed by generation, route and arguments. Each process (e.g. gunicorn
+    worker) keeps an in-memory LRU. If `disk_dir` is set, pages are also written there, so
+    that workers can share them and they survive restarts; files from older generations are
+    cleared out when a new generation turns up. Once there are `max_disk_entries` files,
+    pages are only kept in memory until the next generation."""
+
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_entries=10000):
+        self.memory = LRUCache(max_entries)
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._generation = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, generation, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f"{generation}-{digest}")
+
+    def _new_generation(self, generation):
+        self.memory.clear()
+        self._generation = generation
+        if self.disk_dir:
+            # only older generations': a worker which hasn't seen the latest yet mustn't
+            # delete the pages of the workers which have
+            for name in os.listdir(self.disk_dir):
+                try:
+                    older = int(name.split('-', 1)[0]) < generation
+                except ValueError: # a page still being written (.tmp), or not ours
+                    continue
+                if older:
+                    try:
+                        os.remove(os.path.join(self.disk_dir, name))
+                    except OSError: pass
+
+    def get(self, generation, key):
+        if generation != self._generation:
+            self._new_generation(generation)
+        page = self.memory.get(key)
+        if page is None and self.disk_dir:
+            try:
+                with open(self._path(generation, key), 'rb') as f:
+                    etag, body = f.read().split(b'\n', 1)
+                page = Page(body, etag.decode('ascii'))
+                self.memory.put(key, page)
+            except (OSError, ValueError): pass
+        return page
+
+    def put(self, generation, key, body):
+        """Cache a rendered page, returning it as a Page with a strong ETag"""
+        page = Page(body, hashlib.sha1(body).hexdigest())
+        if generation == self._generation:
+            self.memory.put(key, page)
+            if self.disk_dir and len(os.listdir(self.disk_dir)) < self.max_disk_entries:
+                # write then rename, so other workers never see half a page
+                fd, tmp = tempfile.mkstemp(dir=self.disk_dir, prefix='.')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(page.etag.encode('ascii') + b'\n' + body)
+                os.replace(tmp, self._path(generation, key))
+        return page
+
+def search_key(terms):
+    """Normalize search terms for caching. FTS5 matching is case-insensitive and a search
+    matches all of its words, in any order, so those don't matter -- except that the last
+    word is matched as a prefix, so it stays last."""
+    words = terms.replace('"', ' ').lower().split()
+    return ' '.join(sorted(words[:-1]) + words[-1:])
+
+class SearchCache():
+    """Ranked search results, as (track_id, score) pairs, per page of results. Everything is
+    dropped when the generation moves on, since that's when the search index changes.
+    `hits` and `misses` count lookups since the cache was made."""
+
+    def __init__(self, watcher, max_entries=1024):
+        self.watcher = watcher
+        self.memory = LRUCache(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def ranked(self, terms, limit, after, fetch):
+        """The page of results for `terms`, calling `fetch()` for it if it isn't cached"""
+        current, _ = self.watcher.get()
+        with self._lock:
+            if current != self._generation:
+                self.memory.clear()
+                self._generation = current
+        key = (search_key(terms), limit, after)
+        ranked = self.memory.get(key)
+        with self._lock:
+            if ranked is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        SEARCH_CACHE_LOOKUPS.inc(result='miss' if ranked is None else 'hit')
+        if ranked is None:
+            ranked = tuple(fetch())
+            if current == self._generation:
+                self.memory.put(key, ranked)
+        return list(ranked)
+
+    def stats(self):
+        return {'entries': len(self.memory), 'hits': self.hits, 'misses': self.misses}
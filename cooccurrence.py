@@ -0,0 +1,226 @@
+"""Which artists get played in the same session: an artist x artist matrix of how many
+playlists each pair has both been in, for "often played alongside" and for grouping
+artists into circles, without joining playlist_track to track_artist at request time.
+
+The matrix is symmetric and sparse, kept as CSR arrays (indptr, indices, counts) indexed
+by artist_id, with each artist's own number of playlists on the diagonal. Alongside it
+is each playlist's set of artists, so that when a playlist is ingested again (its
+snapshot_id changed) its old pairs can be taken away before its new ones are added;
+an update only looks at the playlists which are new or changed.
+
+Pairs are scored by count, by pointwise mutual information (how much more often they're
+together than chance would have it) or by Jaccard (the share of either's playlists which
+have both). Circles are communities found by label propagation over a graph of each
+artist's closest others by Jaccard, started from the last update's circles.
+
+Like similarity.py, it's kept next to the database in a directory of .npy files (see
+indexfiles.py), which the web app memory-maps.
+
+    python cooccurrence.py            # bring it up to date
+    python cooccurrence.py --full     # rebuild it from scratch
+"""
+
+import os
+import zlib
+
+import numpy as np
+from sqlalchemy import text, bindparam
+
+import indexfiles
+
+MIN_COUNT = 2 # pairs played together fewer times than this are left out of PMI rankings and circles
+NEIGHBOURS = 10 # how many of its closest others each artist's circle is found from
+SCORES = ('count', 'pmi', 'jaccard')
+ARRAYS = ['playlist_ids', 'playlist_signatures', 'members_indptr', 'members',
+          'indptr', 'indices', 'counts', 'clusters']
+
+def index_dir(db_path='birdnest.db'):
+    return indexfiles.index_dir(db_path, 'cooccurrence')
+
+def _playlist_artists(conn, playlist_ids):
+    """{playlist_id: sorted artist_ids}"""
+    artists = dict((p, []) for p in playlist_ids)
+    for i in range(0, len(playlist_ids), 500):
+        for playlist_id, artist_id in conn.execute(text("""select distinct pt.playlist_id, ta.artist_id
+                from playlist_track pt join track_artist ta on ta.track_id = pt.track_id
+                where pt.playlist_id in :ids order by pt.playlist_id, ta.artist_id""").bindparams(
+                bindparam('ids', expanding=True)), {'ids': playlist_ids[i:i+500]}):
+            artists[playlist_id].append(artist_id)
+    return artists
+
+def _pairs(members, sign):
+    """Every (a, b) pair of a playlist's artists, both ways round and each with itself"""
+    members = np.asarray(members, dtype=np.int64)
+    return np.repeat(members, len(members)), np.tile(members, len(members)), np.full(len(members) ** 2, sign, dtype=np.int64)
+
+def _merge(indptr, indices, counts, rows, cols, deltas, n):
+    """CSR arrays of `n` rows for the existing counts plus the (rows, cols, deltas), without
+    the entries which come to zero"""
+    old_rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    keys = np.concatenate([old_rows * n + indices, rows * n + cols])
+    unique, inverse = np.unique(keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=np.concatenate([counts, deltas])).round().astype(np.int32)
+    unique, summed = unique[summed != 0], summed[summed != 0]
+    new_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(unique // n, minlength=n), out=new_indptr[1:])
+    return new_indptr, (unique % n).astype(np.int32), summed
+
+def _edges(indptr, indices, counts, playlists, neighbours=NEIGHBOURS):
+    """(a, b, jaccard) from each artist to its `neighbours` closest others, counting only
+    those played together at least MIN_COUNT times, and more often than chance (positive
+    PMI). Without that, a few artists who are in every other playlist hold everyone together."""
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    plays = np.zeros(len(indptr) - 1, dtype=np.int64)
+    diagonal = rows == indices
+    plays[rows[diagonal]] = counts[diagonal]
+    others = indices.astype(np.int64)
+    keep = ~diagonal & (counts >= MIN_COUNT) & (counts.astype(np.float64) * playlists > plays[rows] * plays[others])
+    a, b, c = rows[keep], others[keep], counts[keep]
+    w = c / (plays[a] + plays[b] - c)
+    order = np.lexsort((-w, a))
+    a, b, w = a[order], b[order], w[order]
+    starts = np.searchsorted(a, a) # where each artist's edges begin
+    nearest = np.arange(len(a)) - starts < neighbours
+    return a[nearest], b[nearest], w[nearest]
+
+def _clusters(indptr, indices, counts, playlists, previous=None, iterations=30):
+    """A label per artist_id, by label propagation: each artist takes the label with the
+    most weight among its neighbours, half of them at a time so that labels can't just
+    swap back and forth. Artists with no neighbours keep their own."""
+    n = len(indptr) - 1
+    labels = np.arange(n, dtype=np.int64)
+    if previous is not None:
+        labels[:len(previous)] = previous
+    a, b, w = _edges(indptr, indices, counts, playlists)
+    rng = np.random.default_rng(0)
+    for _ in range(iterations):
+        keys = a * n + labels[b]
+        unique, inverse = np.unique(keys, return_inverse=True)
+        weight = np.bincount(inverse, weights=w)
+        node, label = unique // n, unique % n
+        order = np.lexsort((label, -weight, node)) # by node, heaviest label first, ties to the lowest
+        first = order[np.r_[True, node[order][1:] != node[order][:-1]]] if len(order) else order
+        best = labels.copy()
+        best[node[first]] = label[first]
+        turn = rng.random(n) < 0.5
+        changed = turn & (best != labels)
+        labels[changed] = best[changed]
+        if changed.sum() <= n // 1000:
+            break
+    return labels.astype(np.int32)
+
+def update(conn, path, generation=None, full=False):
+    """Bring the index in `path` up to date with the database behind `conn`. Returns
+    {'playlists': (playlists, playlists added, changed or removed)}."""
+    previous = indexfiles.current_version(path)
+    old = indexfiles.load_arrays(previous, dict((a, a) for a in ARRAYS)) if previous and not full else None
+    unchanged = old is not None
+    playlists = conn.execute(text("select playlist_id, snapshot_id from playlist order by playlist_id")).fetchall()
+    ids = np.array([p for p, _ in playlists], dtype=np.int64)
+    signatures = np.array([zlib.crc32(repr(s).encode('utf-8')) for _, s in playlists], dtype=np.int64)
+    n = (conn.execute(text("select max(artist_id) from artist")).scalar() or 0) + 1
+
+    if old is None:
+        old = {'playlist_ids': np.zeros(0, dtype=np.int64), 'playlist_signatures': np.zeros(0, dtype=np.int64),
+               'members_indptr': np.zeros(1, dtype=np.int64), 'members': np.zeros(0, dtype=np.int32),
+               'indptr': np.zeros(1, dtype=np.int64), 'indices': np.zeros(0, dtype=np.int32),
+               'counts': np.zeros(0, dtype=np.int32), 'clusters': None}
+    old_row = dict((int(p), i) for i, p in enumerate(old['playlist_ids']))
+    old_members = lambda p: old['members'][old['members_indptr'][old_row[p]]:old['members_indptr'][old_row[p] + 1]]
+    changed = [int(p) for p, s in zip(ids, signatures) if p not in old_row or old['playlist_signatures'][old_row[p]] != s]
+    removed = set(old_row) - set(ids.tolist())
+    if unchanged and not changed and not removed:
+        return {'playlists': (len(ids), 0)}
+    n = max(n, len(old['indptr']) - 1)
+
+    new_members = _playlist_artists(conn, changed)
+    pairs = [_pairs(old_members(p), -1) for p in list(changed) + list(removed) if p in old_row]
+    pairs += [_pairs(new_members[p], 1) for p in changed]
+    if pairs:
+        rows, cols, deltas = (np.concatenate(parts) for parts in zip(*pairs))
+    else:
+        rows = cols = deltas = np.zeros(0, dtype=np.int64)
+    indptr, indices, counts = _merge(old['indptr'], old['indices'], old['counts'], rows, cols, deltas, n)
+
+    members = [new_members[p] if p in new_members else old_members(p) for p in ids.tolist()]
+    members_indptr = np.zeros(len(members) + 1, dtype=np.int64)
+    np.cumsum([len(m) for m in members], out=members_indptr[1:])
+    arrays = {
+        'playlist_ids': ids,
+        'playlist_signatures': signatures,
+        'members_indptr': members_indptr,
+        'members': np.concatenate(members).astype(np.int32) if members else np.zeros(0, dtype=np.int32),
+        'indptr': indptr,
+        'indices': indices,
+        'counts': counts,
+        'clusters': _clusters(indptr, indices, counts, len(ids), old['clusters']) if pairs or old['clusters'] is None else old['clusters'],
+    }
+    version = indexfiles.new_version(path, generation)
+    for name, array in arrays.items():
+        np.save(os.path.join(version, f"{name}.npy"), array)
+    indexfiles.publish(path, version, {'generation': generation, 'playlists': len(ids)})
+    return {'playlists': (len(ids), len(changed) + len(removed))}
+
+class Cooccurrence():
+    """A loaded version of the index, for asking questions of"""
+
+    def __init__(self, indptr, indices, counts, clusters, playlists):
+        self.indptr, self.indices, self.counts = indptr, indices, counts
+        self.clusters = clusters
+        self.playlists = playlists
+        n = len(indptr) - 1
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        diagonal = rows == indices
+        self.plays = np.zeros(n, dtype=np.int64) # how many playlists each artist_id has been in
+        self.plays[rows[diagonal]] = counts[diagonal]
+        self._by_cluster = np.argsort(clusters, kind='stable')
+        self._cluster_labels = np.asarray(clusters)[self._by_cluster]
+
+    def alongside(self, artist_id, k=10, score='count'):
+        """[(artist_id, times played together, score), ...] for the artists played in the same
+        playlists as `artist_id`, best `score` first. For PMI, pairs played together fewer
+        than MIN_COUNT times are left out, since one chance meeting of two rarities scores highest."""
+        if not 0 <= artist_id < len(self.plays) or not self.plays[artist_id]:
+            return []
+        start, end = self.indptr[artist_id], self.indptr[artist_id + 1]
+        others, together = np.asarray(self.indices[start:end]), np.asarray(self.counts[start:end]).astype(np.float64)
+        keep = others != artist_id
+        if score == 'pmi':
+            keep &= together >= MIN_COUNT
+        others, together = others[keep], together[keep]
+        mine, theirs = self.plays[artist_id], self.plays[others]
+        scores = {
+            'count': together + together / (mine + theirs - together), # jaccard breaks ties
+            'pmi': np.log(together * self.playlists / (mine * theirs)),
+            'jaccard': together / (mine + theirs - together),
+        }[score]
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [(int(others[i]), int(together[i]), float(scores[i])) for i in top]
+
+    def circle(self, artist_id, k=10):
+        """Up to `k` other artist_ids in the same circle as `artist_id`, most played first"""
+        if not 0 <= artist_id < len(self.plays) or not self.plays[artist_id]:
+            return []
+        label = self.clusters[artist_id]
+        start, end = np.searchsorted(self._cluster_labels, [label, label + 1])
+        members = self._by_cluster[start:end]
+        members = members[members != artist_id]
+        return [int(a) for a in members[np.argsort(-self.plays[members], kind='stable')[:k]]]
+
+    def circles(self, artist_ids, min_size=2):
+        """`artist_ids` grouped by circle, biggest group first, leaving out groups smaller than `min_size`"""
+        groups = {}
+        for a in artist_ids:
+            if 0 <= a < len(self.plays) and self.plays[a]:
+                groups.setdefault(int(self.clusters[a]), []).append(a)
+        return sorted((g for g in groups.values() if len(g) >= min_size), key=len, reverse=True)
+
+def load(version):
+    arrays = indexfiles.load_arrays(version, {'indptr': 'indptr', 'indices': 'indices', 'counts': 'counts', 'clusters': 'clusters'})
+    return Cooccurrence(playlists=indexfiles.read_meta(version)['playlists'], **arrays)
+
+def update_after_ingest(session, db_path='birdnest.db', full=False):
+    return indexfiles.update_after_ingest('co-occurrence', update, index_dir(db_path), session, full)
+
+if __name__ == '__main__':
+    indexfiles.main(__doc__.split('\n\n')[0], update_after_ingest)
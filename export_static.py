@@ -0,0 +1,331 @@
+"""Export the site as static files, so it can be served by any static file server or CDN
+instead of by app.py.
+
+    python export_static.py                  # into site/, from birdnest.db
+    python export_static.py --out /srv/birds --db other.db
+    python export_static.py --force          # render every page, even unchanged ones
+
+Every route is rendered through the Flask app itself, to <url>/index.html, with .gz (and,
+if the optional brotli package is installed, .br) siblings for servers which serve precompressed
+files (nginx's gzip_static and brotli_static, for instance). Search can't run on a static
+server, so /search/ is a page which searches a copy of the search index in the browser,
+split into JSON shards so that a query only fetches the few it needs.
+
+Exports are incremental. Each page has a fingerprint of the rows it's rendered from, and
+site/manifest.json remembers the fingerprints from the last export, so only pages whose
+playlist, artist or genre changed since then are rendered again, and pages for things
+which no longer exist are removed. The sections drawn from ingest's indexes (such as a
+playlist's Repeats, from membership.py, or an artist's circle, from cooccurrence.py) are
+fingerprinted by what the index has for the page: the ids it lists, in order. Changing a template or any of the code in CODE changes every fingerprint, so then
+everything is rendered again.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import defaultdict
+
+try:
+    import brotli
+except ImportError: # optional: without it there are just .gz siblings
+    brotli = None
+
+import cooccurrence
+import indexfiles
+import membership
+import queries
+import similarity
+from models import SEARCH_PAGE_SIZE
+
+CODE = ['templates', 'app.py', 'queries.py', 'models.py', 'viewmodels.py', 'indexfiles.py',
+        'similarity.py', 'cooccurrence.py', 'membership.py']
+COMPRESSIBLE = ('.html', '.json', '.css', '.js', '.svg', '.txt', '.ico')
+TRACKS_PER_SHARD = 1000
+
+# Each of these lists the rows a kind of page is rendered from, as (url, ...) in a stable
+# order. A page's fingerprint is a hash of all of its rows, from all of its kind's queries.
+PLAYLIST_ROWS = ["""
+    select '/playlist/' || p.date, p.*, pt.sequence, t.*, f.*, a.spotify_id, a.name
+    from playlist p
+    left join playlist_track pt on pt.playlist_id = p.playlist_id
+    left join track t on t.track_id = pt.track_id
+    left join audio_features f on f.track_id = t.track_id
+    left join track_artist ta on ta.track_id = t.track_id
+    left join artist a on a.artist_id = ta.artist_id
+    where p.date is not null
+    order by p.date, pt.sequence, ta.rowid"""]
+
+ARTIST_ROWS = ["""
+    select '/artist/' || a.spotify_id, a.name, a.images, a.popularity, a.followers, g.name
+    from artist a
+    left join artist_genre ag on ag.artist_id = a.artist_id
+    left join genre g on g.genre_id = ag.genre_id
+    order by a.spotify_id, g.name""", """
+    select '/artist/' || a.spotify_id, t.*, f.*, other.spotify_id, other.name
+    from artist a
+    join track_artist ta on ta.artist_id = a.artist_id
+    join track t on t.track_id = ta.track_id
+    left join audio_features f on f.track_id = t.track_id
+    join track_artist ota on ota.track_id = t.track_id
+    join artist other on other.artist_id = ota.artist_id
+    order by a.spotify_id, ta.rowid, ota.rowid""", """
+    select '/artist/' || a.spotify_id, al.spotify_id, al.name, al.spotify_url, al.images
+    from artist a
+    join album_artist aa on aa.artist_id = a.artist_id
+    join album al on al.album_id = aa.album_id
+    order by a.spotify_id, aa.rowid"""]
+
+GENRE_ROWS = ["""
+    select '/genre/' || g.name, gp.*, a.spotify_id, a.name, a.popularity, a.followers, ap.plays
+    from genre g
+    left join genre_plays gp on gp.genre_id = g.genre_id
+    left join artist_genre ag on ag.genre_id = g.genre_id
+    left join artist a on a.artist_id = ag.artist_id
+    left join artist_plays ap on ap.artist_id = a.artist_id
+    order by g.name, a.artist_id""", """
+    select '/genre/' || g.name, a.artist_id, other.name
+    from genre g
+    join artist_genre ag on ag.genre_id = g.genre_id
+    join artist a on a.artist_id = ag.artist_id
+    join artist_genre oag on oag.artist_id = a.artist_id
+    join genre other on other.genre_id = oag.genre_id
+    order by g.name, a.artist_id, other.name"""]
+
+# pages with a bit of everything on them
+SINGLETON_ROWS = {
+    '/': ["select date, images from playlist order by date"],
+    '/genres': ["""select g.name, gp.plays from genre g
+        left join genre_plays gp on gp.genre_id = g.genre_id order by g.name"""],
+    '/artists': ["""select a.spotify_id, a.name, ap.* from artist_plays ap
+        join artist a on a.artist_id = ap.artist_id order by ap.plays desc, a.artist_id"""],
+}
+
+def _index(module, db_path):
+    """The current version of one of ingest's indexes (similarity, cooccurrence or
+    membership), loaded, or None if there isn't one yet"""
+    version = indexfiles.current_version(module.index_dir(db_path))
+    return module.load(version) if version else None
+
+def repeats_rows(conn, db_path):
+    members = _index(membership, db_path)
+    for date, playlist_id in conn.execute("select date, playlist_id from playlist where date is not null order by date"):
+        yield ('/playlist/' + date, queries.repeats(members, playlist_id))
+
+def similarity_rows(conn, db_path, batch_size=1000):
+    vectors = _index(similarity, db_path) or {}
+    if 'tracks' in vectors:
+        playlists = defaultdict(list)
+        for date, track_id in conn.execute("""select p.date, pt.track_id from playlist p
+                join playlist_track pt on pt.playlist_id = p.playlist_id
+                where p.date is not null order by p.date, pt.sequence"""):
+            playlists[date].append(track_id)
+        for date, track_ids in playlists.items():
+            yield ('/playlist/' + date, [i for i, _ in vectors['tracks'].like(track_ids, queries.SIMILAR_LIMIT)])
+    if 'artists' in vectors:
+        artists = conn.execute("select artist_id, spotify_id from artist order by artist_id").fetchall()
+        for start in range(0, len(artists), batch_size): # an artists x artists matrix a batch at a time
+            batch = dict(artists[start:start + batch_size])
+            for artist_id, similar in vectors['artists'].similar(list(batch), queries.SIMILAR_LIMIT).items():
+                yield ('/artist/' + batch[artist_id], [i for i, _ in similar])
+
+def cooccurrence_rows(conn, db_path):
+    co = _index(cooccurrence, db_path)
+    if co is None:
+        return
+    for spotify_id, artist_id in conn.execute("select spotify_id, artist_id from artist order by spotify_id"):
+        yield ('/artist/' + spotify_id, co.alongside(artist_id, queries.SIMILAR_LIMIT), co.circle(artist_id, queries.SIMILAR_LIMIT))
+    genres = defaultdict(list)
+    for name, artist_id in conn.execute("""select g.name, ag.artist_id from genre g
+            join artist_genre ag on ag.genre_id = g.genre_id order by g.name, ag.artist_id"""):
+        genres[name].append(artist_id)
+    for name, artist_ids in genres.items():
+        yield ('/genre/' + name, co.circles(artist_ids))
+
+# and these make the rows that the sections drawn from an index are rendered from, the
+# same way, given the database and its path (from which the indexes' paths follow)
+INDEX_ROWS = [similarity_rows, cooccurrence_rows, repeats_rows]
+
+def code_version(root='.'):
+    """A hash of everything which decides how pages look, besides the data"""
+    h = hashlib.sha1()
+    for name in CODE:
+        path = os.path.join(root, name)
+        paths = [os.path.join(d, f) for d, _, files in os.walk(path) for f in files] if os.path.isdir(path) else [path]
+        for p in sorted(paths):
+            h.update(p.encode('utf-8'))
+            with open(p, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def fingerprints(conn, version, db_path):
+    """{url: fingerprint} for every page of the site"""
+    hashes = defaultdict(lambda: hashlib.sha1(version.encode('utf-8')))
+    for sql in PLAYLIST_ROWS + ARTIST_ROWS + GENRE_ROWS:
+        for row in conn.execute(sql):
+            hashes[row[0]].update(repr(row[1:]).encode('utf-8'))
+    for rows in INDEX_ROWS:
+        for row in rows(conn, db_path):
+            hashes[row[0]].update(repr(row[1:]).encode('utf-8'))
+    for url, sqls in SINGLETON_ROWS.items():
+        for sql in sqls:
+            for row in conn.execute(sql):
+                hashes[url].update(repr(row).encode('utf-8'))
+    hashes['/search/'].update(repr((SEARCH_PAGE_SIZE, TRACKS_PER_SHARD)).encode('utf-8'))
+    return {url: h.hexdigest() for url, h in hashes.items() if exportable(url)}
+
+def exportable(url):
+    # the app can't route a genre with a slash in its name either
+    return not any(part in ('.', '..') for part in url.split('/')) and not (url.startswith('/genre/') and url.count('/') > 2)
+
+def page_path(url):
+    return url.strip('/') + '/index.html' if url != '/' else 'index.html'
+
+def tokenize(text):
+    """Words the way SQLite's unicode61 tokenizer sees them: case and accents folded"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r'[^\W_]+', text.lower())
+
+def token_shard(token):
+    return 'tokens-' + (token[0] if re.match(r'[a-z0-9]', token[0]) else '_')
+
+def search_shards(conn):
+    """The search index as {filename: JSON}: tokens-<first letter>.json maps each word to
+    the track_ids with it, and tracks-<n>.json has (artist, track, album, url) for track_ids
+    n * TRACKS_PER_SHARD up to (n + 1) * TRACKS_PER_SHARD."""
+    tokens = defaultdict(lambda: defaultdict(set))
+    tracks = defaultdict(dict)
+    for track_id, artist, track, album, url in conn.execute("""
+            select s.rowid, s.artist, s.track, s.album, t.spotify_url
+            from track_search s join track t on t.track_id = s.rowid order by s.rowid"""):
+        for token in tokenize(' '.join(filter(None, (artist, track, album)))):
+            tokens[token_shard(token)][token].add(track_id)
+        tracks[f"tracks-{track_id // TRACKS_PER_SHARD}"][track_id] = [artist, track, album, url]
+    shards = {name: {t: sorted(ids) for t, ids in sorted(shard.items())} for name, shard in tokens.items()}
+    shards.update(tracks)
+    return {f"search/{name}.json": json.dumps(shard, separators=(',', ':')).encode('utf-8')
+            for name, shard in shards.items()}
+
+class Site():
+    """The export directory, and what's in it according to its manifest"""
+
+    def __init__(self, out):
+        self.out = out
+        self.manifest_path = os.path.join(out, 'manifest.json')
+        try:
+            with open(self.manifest_path) as f:
+                self.previous = json.load(f)
+        except (OSError, ValueError):
+            self.previous = {}
+        self.files = {} # relative path -> sha1 of what's there now
+        self.written = 0
+
+    def keep(self, path):
+        """Keep a file from the last export as it is"""
+        if path in self.previous.get('files', {}) and os.path.exists(os.path.join(self.out, path)):
+            self.files[path] = self.previous['files'][path]
+            return True
+        return False
+
+    def write(self, path, body):
+        """Write a file with its compressed siblings, unless it's already there as it is"""
+        digest = hashlib.sha1(body).hexdigest()
+        if self.previous.get('files', {}).get(path) == digest and self.keep(path):
+            return
+        self.files[path] = digest
+        versions = [('', body)]
+        if path.endswith(COMPRESSIBLE):
+            versions.append(('.gz', gzip.compress(body, 9, mtime=0)))
+            if brotli is not None:
+                versions.append(('.br', brotli.compress(body)))
+        for suffix, data in versions:
+            full = os.path.join(self.out, path + suffix)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(full + '.tmp', full) # so a server never sees half a file
+        self.written += 1
+
+    def remove_stale(self):
+        """Remove whatever the last export wrote which this one didn't; returns how many"""
+        stale = set(self.previous.get('files', {})) - set(self.files)
+        for path in stale:
+            for suffix in ('', '.gz', '.br'):
+                try:
+                    os.remove(os.path.join(self.out, path + suffix))
+                except FileNotFoundError:
+                    pass
+            directory = os.path.dirname(os.path.join(self.out, path))
+            while directory != self.out and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        return len(stale)
+
+    def save(self, **manifest):
+        manifest['files'] = dict(sorted(self.files.items()))
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+def export(out, db_path, force=False):
+    os.environ['BIRDNEST_DB'] = db_path
+    os.environ['BIRDNEST_STATIC_EXPORT'] = '1'
+    from flask import render_template
+    from app import app, engine # only now, so that the app opens db_path
+
+    if brotli is None:
+        print("no brotli package (see requirements.txt), so skipping .br files")
+    site = Site(out)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    generation = conn.execute("select value from generation").fetchone()
+    version = code_version(os.path.dirname(os.path.abspath(__file__)))
+    pages = fingerprints(conn, version, db_path)
+    previous_pages = {} if force else site.previous.get('pages', {})
+
+    client = app.test_client()
+    rendered = 0
+    for url, fingerprint in sorted(pages.items()):
+        path = page_path(url)
+        if previous_pages.get(url) == fingerprint and site.keep(path):
+            continue
+        if url == '/search/':
+            with app.test_request_context(url):
+                body = render_template('static_search.html', shards={
+                    'page_size': SEARCH_PAGE_SIZE, 'tracks_per_shard': TRACKS_PER_SHARD}).encode('utf-8')
+        else:
+            response = client.get(url)
+            if response.status_code != 200:
+                print(f"skipping {url}: {response.status_code}")
+                del pages[url]
+                continue
+            body = response.get_data()
+        site.write(path, body)
+        rendered += 1
+
+    for name, body in search_shards(conn).items():
+        site.write(name, body)
+
+    static = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    for directory, _, files in os.walk(static):
+        for name in files:
+            full = os.path.join(directory, name)
+            with open(full, 'rb') as f:
+                site.write(os.path.join('static', os.path.relpath(full, static)), f.read())
+
+    removed = site.remove_stale()
+    site.save(version=version, generation=generation[0] if generation else None, pages=pages)
+    conn.close()
+    engine.dispose()
+    print(f"{rendered} of {len(pages)} pages rendered, {site.written} files written, {removed} removed")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', default='site')
+    parser.add_argument('--db', default=os.environ.get('BIRDNEST_DB', 'birdnest.db'))
+    parser.add_argument('--force', action='store_true', help='render every page')
+    args = parser.parse_args()
+    export(args.out, args.db, args.force)
@@ -1,25 +1,14 @@
-from spotclient import Client
+"""Merge duplicate genres, which older versions of ingest used to create, in one
+transaction. Upgrading the schema (e.g. with models.get_session()) does this anyway when
+it adds the unique index on genre.name, and ingest can't create them since, so this is
+only for a database which somehow has them again."""
 import models
-from collections import defaultdict
+import storage
 
 session = models.get_session(create_all=True)
 
-gdict = defaultdict(list)
-
-for g in session.query(models.Genre).all():
-    gdict[g.name].append(g)
-
-print(f"Found {len(gdict)} unique genres")
-
-for gname, glist in gdict.items():
-    if len(glist) > 1:
-        main = glist[0]
-        rest = glist[1:]
-        for bogus in rest:
-            for artist in bogus.artists:
-                artist.genre_objs.remove(bogus)
-                artist.genre_objs.append(main)
-            session.delete(bogus)
-
-print(f"down to {session.query(models.Genre).count()}")
+print(f"{session.query(models.Genre).count()} genres")
+merged = models.merge_duplicate_genres(session)
 session.commit()
+print(f"merged {merged} duplicates, down to {session.query(models.Genre).count()}")
+storage.finish_ingest(session)
@@ -0,0 +1,113 @@
+"""Derived indexes (see similarity.py, cooccurrence.py and membership.py) kept as
+directories of .npy files next to the database, which ingest writes and the web app
+memory-maps.
+
+Each update is written to a new version directory, and then a CURRENT file is pointed at
+it, so readers never see half an index. Old versions are removed straight away; anyone
+who has their files mapped keeps them until they let go. An update which finds nothing
+changed writes nothing.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+def index_dir(db_path, name):
+    """Where the `name` index for `db_path` lives: e.g. birdnest-similarity/, or the
+    BIRDNEST_<NAME>_DIR environment variable"""
+    return os.environ.get(f"BIRDNEST_{name.upper()}_DIR") or os.path.splitext(db_path)[0] + f"-{name}"
+
+def current_version(path):
+    try:
+        with open(os.path.join(path, 'CURRENT')) as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def read_meta(version):
+    if version is None:
+        return {}
+    with open(os.path.join(version, 'meta.json')) as f:
+        return json.load(f)
+
+def new_version(path, generation=None):
+    """A fresh directory to write the next version into"""
+    os.makedirs(path, exist_ok=True)
+    version = tempfile.mkdtemp(dir=path, prefix=f"v{generation or 0}-")
+    os.chmod(version, 0o755) # mkdtemp makes it private, but the web app may run as someone else
+    return version
+
+def publish(path, version, meta):
+    """Make `version` the current one, with `meta` as its meta.json"""
+    with open(os.path.join(version, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    with open(os.path.join(path, '.CURRENT'), 'w') as f:
+        f.write(os.path.basename(version))
+    os.replace(os.path.join(path, '.CURRENT'), os.path.join(path, 'CURRENT'))
+    for name in os.listdir(path):
+        if name.startswith('v') and name != os.path.basename(version):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+def load_arrays(version, names, mmap_mode='r'):
+    """{key: array} for a {key: file name} of .npy files in `version`, memory-mapped"""
+    return dict((key, np.load(os.path.join(version, f"{name}.npy"), mmap_mode=mmap_mode)) for key, name in names.items())
+
+class Reloader():
+    """Whatever `load(version_dir)` makes of the current version of the index in `path`,
+    loaded again when there's a new version, which is checked for at most every `interval`
+    seconds. `get()` is None until there's an index to read."""
+
+    def __init__(self, path, load, interval=1.0):
+        self.path = path
+        self.load = load
+        self.interval = interval
+        self._version = None
+        self._loaded = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= self.interval:
+                self._checked = now
+                version = current_version(self.path)
+                if version != self._version:
+                    try:
+                        self._loaded = self.load(version) if version else None
+                        self._version = version
+                    except (OSError, ValueError):
+                        pass # replaced while we were reading it; try again next time
+            return self._loaded
+
+def update_after_ingest(name, update, path, session, full=False):
+    """Bring the `name` index in `path` up to date with `update(conn, path, generation, full)`
+    once an ingest has committed. `update` returns {what: (rows, rows recomputed)}; if
+    anything was recomputed the generation is bumped (and committed), so that cached pages
+    pick it up. Returns what `update` did."""
+    import models
+    generation = session.execute(text("select value from generation")).scalar()
+    start = time.perf_counter()
+    result = update(session, path, generation, full)
+    if any(changed for _, changed in result.values()):
+        models.bump_generation(session)
+    session.commit()
+    print(f"{name} index: {', '.join(f'{n:,} {what} ({changed:,} recomputed)' for what, (n, changed) in result.items())}"
+          f" in {time.perf_counter() - start:.1f}s")
+    return result
+
+def main(description, update_after_ingest):
+    """The command line for an index module, given its update_after_ingest(session, db_path, full)"""
+    import models
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--db', default='birdnest.db')
+    parser.add_argument('--full', action='store_true', help='rebuild from scratch')
+    args = parser.parse_args()
+    update_after_ingest(models.get_session(args.db, create_all=False), args.db, args.full)
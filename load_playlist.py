@@ -1,19 +1,32 @@
 from spotclient import Client
+from apicache import ResponseCache
+import cooccurrence
+import membership
 import models
+import similarity
+import storage
+import os
 
-db = models.Database()
+# BIRDNEST_REPLAY=1 re-runs an ingest from previously recorded API responses, offline
+cache = ResponseCache('spotify_cache.db', replay_only=bool(os.environ.get('BIRDNEST_REPLAY', False)))
+c = Client(cache=cache)
+db = models.Database(api_client=c)
 session = models.get_session(create_all=True)
 
-c = Client()
-ab = c.allbirds()
+ab = c.allbirds(refresh=True) # about one API call, and the only one if nothing has changed
 latest = ab[0]
 print(f"latest from API: {latest['name']}")
 
-# update the database with the latest material
+# update the database with the latest material, unless its snapshot_id says we have it already
 playlist = db.insert_playlist_from_json(session, latest)
-print(f"saved playlist: {playlist.name}")
+if db.skipped['playlist']:
+    print(f"already up to date: {playlist.name}")
+else:
+    print(f"saved playlist: {playlist.name}")
 
-# if that looks right, rebuild the index and commit db changes
-
-db.rebuild_fts(session)
+# if that looks right, commit db changes. the search index is kept up to date as we go.
 session.commit()
+similarity.update_after_ingest(session)
+cooccurrence.update_after_ingest(session)
+membership.update_after_ingest(session)
+storage.finish_ingest(session)
@@ -0,0 +1,246 @@
+"""Which tracks and artists each playlist has, as one bitset per playlist, for questions
+about repeats across sessions: how much two playlists share, how novel a week's playlist
+was, and which playlists are closest to each other.
+
+Bit i of a playlist's track bitset is set if it has the track with track_id i, and the
+same for artists; rows are packed with numpy.packbits, one row per playlist in date order.
+Intersection and union counts are then a bitwise and/or plus a popcount, over a batch of
+rows at once. Also kept are:
+
+* novelty: the fraction of each playlist's tracks (and artists) which no earlier playlist had
+* similarity: for every pair of playlists, the Jaccard similarity of their tracks, and of
+  their artists, as a P x P matrix
+
+An update reads only the playlists which are new or changed (by snapshot_id). A new
+latest playlist costs O(its size) to add its bits and work out its novelty, plus one
+vectorized pass over the other rows for its row and column of the similarity matrices.
+A change to an older playlist means recomputing novelty from there on.
+
+Like similarity.py, it's kept next to the database in a directory of .npy files (see
+indexfiles.py), which the web app memory-maps.
+
+    python membership.py            # bring it up to date
+    python membership.py --full     # rebuild it from scratch
+"""
+
+import os
+import zlib
+from datetime import date
+
+import numpy as np
+from sqlalchemy import text, bindparam
+
+import indexfiles
+
+KINDS = ('tracks', 'artists')
+BLOCK_BYTES = 32 * 1024 * 1024 # bound on the temporaries of a batch of bitwise operations
+POPCOUNT_ROWS = 16 # up to this many changed playlists, popcount them against every row; past it, see _shared
+ARRAYS = ['playlist_ids', 'dates', 'signatures'] + [f"{kind}-{name}" for kind in KINDS
+          for name in ('bits', 'sizes', 'novelty', 'similarity', 'seen')]
+
+if hasattr(np, 'bitwise_count'): # numpy 2
+    def popcount(bits):
+        """Set bits per row"""
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+else:
+    _BITS_SET = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(bits):
+        """Set bits per row"""
+        return _BITS_SET[bits].sum(axis=-1, dtype=np.int64)
+
+def index_dir(db_path='birdnest.db'):
+    return indexfiles.index_dir(db_path, 'membership')
+
+def bitset(ids, width):
+    """A packed row of `width` bits with the bits for `ids` set"""
+    bits = np.zeros(width, dtype=bool)
+    bits[np.asarray(ids, dtype=np.int64)] = True
+    return np.packbits(bits)
+
+def _members(conn, playlist_ids):
+    """{kind: {playlist_id: ids}} for the given playlists"""
+    members = dict((kind, dict((p, []) for p in playlist_ids)) for kind in KINDS)
+    for i in range(0, len(playlist_ids), 500):
+        chunk = {'ids': playlist_ids[i:i+500]}
+        for playlist_id, track_id in conn.execute(text(
+                "select distinct playlist_id, track_id from playlist_track where playlist_id in :ids").bindparams(
+                bindparam('ids', expanding=True)), chunk):
+            members['tracks'][playlist_id].append(track_id)
+        for playlist_id, artist_id in conn.execute(text("""select distinct pt.playlist_id, ta.artist_id
+                from playlist_track pt join track_artist ta on ta.track_id = pt.track_id
+                where pt.playlist_id in :ids""").bindparams(bindparam('ids', expanding=True)), chunk):
+            members['artists'][playlist_id].append(artist_id)
+    return members
+
+def _blocks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def intersections(bits, rows):
+    """len(rows) x P counts of what each of `rows` shares with every playlist, by popcount"""
+    out = np.zeros((len(rows), len(bits)), dtype=np.int64)
+    start = 0
+    for block in _blocks(rows, max(1, BLOCK_BYTES // max(1, bits.size))):
+        out[start:start + len(block)] = popcount(bits[block][:, None, :] & bits[None, :, :])
+        start += len(block)
+    return out
+
+def _set_bits(bits):
+    """(rows, ids) of every set bit, a few rows at a time so as not to unpack them all at once"""
+    rows, ids = [], []
+    for block in _blocks(np.arange(len(bits)), max(1, BLOCK_BYTES // max(1, bits.shape[1] * 8))):
+        r, i = np.nonzero(np.unpackbits(bits[block], axis=1))
+        rows.append(r + block[0])
+        ids.append(i)
+    return (np.concatenate(rows), np.concatenate(ids)) if rows else (np.zeros(0, dtype=np.int64),) * 2
+
+def _shared(bits, rows):
+    """The same as intersections(bits, rows), but by way of which playlists have each id,
+    so that each row costs O(its size * how many playlists have each of its ids) rather than
+    a pass over all of `bits`. That's what makes rebuilding all P x P of them bearable."""
+    have, ids = _set_bits(bits)
+    order = np.argsort(ids, kind='stable')
+    having = have[order] # the playlists with each id, id by id
+    indptr = np.zeros(bits.shape[1] * 8 + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=bits.shape[1] * 8), out=indptr[1:])
+    out = np.zeros((len(rows), len(bits)), dtype=np.int64)
+    start = 0
+    for block in _blocks(rows, max(1, BLOCK_BYTES // 8 // max(1, len(bits)))):
+        r, i = np.nonzero(np.unpackbits(bits[block], axis=1))
+        lengths = indptr[i + 1] - indptr[i]
+        offsets = np.repeat(indptr[i] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        keys = np.repeat(r, lengths) * len(bits) + having[offsets]
+        out[start:start + len(block)] = np.bincount(keys, minlength=len(block) * len(bits)).reshape(len(block), len(bits))
+        start += len(block)
+    return out
+
+def _novelty(bits, sizes, start, seen=None):
+    """(novelty, seen): the novelty of the playlists from position `start` on, and everything
+    any playlist has. `seen` is everything before `start`, if that's known already."""
+    if seen is None:
+        seen = np.bitwise_or.reduce(bits[:start], axis=0) if start else np.zeros(bits.shape[1], dtype=np.uint8)
+    novelty = np.zeros(len(bits) - start, dtype=np.float32)
+    for i in range(start, len(bits)):
+        if sizes[i]:
+            novelty[i - start] = popcount(bits[i] & ~seen) / sizes[i]
+        seen |= bits[i]
+    return novelty, seen
+
+def update(conn, path, generation=None, full=False):
+    """Bring the index in `path` up to date with the database behind `conn`. Returns
+    {'playlists': (playlists, playlists added, changed or removed)}."""
+    previous = indexfiles.current_version(path)
+    old = indexfiles.load_arrays(previous, dict((a, a) for a in ARRAYS)) if previous and not full else None
+    playlists = conn.execute(text("""select playlist_id, date, snapshot_id from playlist
+        where date is not null order by date, playlist_id""")).fetchall()
+    ids = np.array([p for p, _, _ in playlists], dtype=np.int64)
+    dates = np.array([date.fromisoformat(str(d)).toordinal() for _, d, _ in playlists], dtype=np.int64)
+    signatures = np.array([zlib.crc32(repr(s).encode('utf-8')) for _, _, s in playlists], dtype=np.int64)
+    widths = {
+        'tracks': (conn.execute(text("select max(track_id) from track")).scalar() or 0) + 1,
+        'artists': (conn.execute(text("select max(artist_id) from artist")).scalar() or 0) + 1,
+    }
+
+    old_row = dict((int(p), i) for i, p in enumerate(old['playlist_ids'])) if old else {}
+    old_signatures = np.asarray(old['signatures']) if old else None
+    kept = np.array([int(p) in old_row and old_signatures[old_row[int(p)]] == s for p, s in zip(ids, signatures)], dtype=bool)
+    changed = ids[~kept].tolist()
+    removed = len(set(old_row) - set(ids.tolist()))
+    if old is not None and not changed and not removed:
+        return {'playlists': (len(ids), 0)}
+    # novelty only depends on what came before, so it's kept up to the first playlist which
+    # changed or moved
+    n = min(len(ids), len(old_row))
+    unmoved = kept[:n] & (ids[:n] == np.asarray(old['playlist_ids'][:n])) if old else kept[:0]
+    start = int(np.argmin(unmoved)) if not unmoved.all() else n
+    members = _members(conn, changed)
+
+    arrays = {'playlist_ids': ids, 'dates': dates, 'signatures': signatures}
+    for kind in KINDS:
+        width = -(-max(widths[kind], (old[f"{kind}-bits"].shape[1] * 8) if old else 0) // 8) # whole bytes
+        bits = np.zeros((len(ids), width), dtype=np.uint8)
+        at = np.array([old_row.get(int(p), 0) for p in ids], dtype=np.int64)
+        if old is not None and kept.any():
+            old_bits = old[f"{kind}-bits"]
+            bits[kept, :old_bits.shape[1]] = old_bits[at[kept]]
+        for row in np.flatnonzero(~kept):
+            bits[row] = bitset(members[kind][int(ids[row])], width * 8)
+        sizes = popcount(bits)
+
+        novelty = np.zeros(len(ids), dtype=np.float32)
+        seen = None
+        if start:
+            novelty[:start] = old[f"{kind}-novelty"][at[:start]]
+        if old is not None and start == len(old_row): # only new playlists, after all the old ones
+            seen = np.zeros(width, dtype=np.uint8)
+            seen[:len(old[f"{kind}-seen"])] = old[f"{kind}-seen"]
+        novelty[start:], seen = _novelty(bits, sizes, start, seen)
+
+        similarity = np.zeros((len(ids), len(ids)), dtype=np.float32)
+        if old is not None and kept.any():
+            similarity[np.ix_(kept, kept)] = old[f"{kind}-similarity"][np.ix_(at[kept], at[kept])]
+        stale = np.flatnonzero(~kept)
+        if len(stale):
+            shared = intersections(bits, stale) if len(stale) <= POPCOUNT_ROWS else _shared(bits, stale)
+            union = sizes[stale][:, None] + sizes[None, :] - shared
+            jaccard = np.divide(shared, union, out=np.zeros(shared.shape), where=union > 0).astype(np.float32)
+            similarity[stale, :] = jaccard
+            similarity[:, stale] = jaccard.T
+        arrays.update({f"{kind}-bits": bits, f"{kind}-sizes": sizes.astype(np.int32),
+                       f"{kind}-novelty": novelty, f"{kind}-similarity": similarity, f"{kind}-seen": seen})
+
+    version = indexfiles.new_version(path, generation)
+    for name, array in arrays.items():
+        np.save(os.path.join(version, f"{name}.npy"), array)
+    indexfiles.publish(path, version, {'generation': generation})
+    return {'playlists': (len(ids), len(changed) + removed)}
+
+class Membership():
+    """A loaded version of the index, for asking questions of"""
+
+    def __init__(self, arrays):
+        self.playlist_ids = arrays['playlist_ids']
+        self.dates = arrays['dates']
+        self.arrays = arrays
+        self._positions = dict((int(p), i) for i, p in enumerate(self.playlist_ids))
+
+    def positions(self, playlist_ids):
+        return np.array([self._positions[p] for p in playlist_ids if p in self._positions], dtype=np.int64)
+
+    def counts(self, playlist_ids, kind='tracks'):
+        """(intersections, unions): len(playlist_ids) x P counts of the tracks (or artists)
+        each of `playlist_ids` shares with every playlist, and has between them"""
+        bits, sizes = self.arrays[f"{kind}-bits"], self.arrays[f"{kind}-sizes"]
+        rows = self.positions(playlist_ids)
+        shared = intersections(bits, rows)
+        return shared, sizes[rows][:, None] + sizes[None, :] - shared
+
+    def novelty(self, playlist_id, kind='tracks'):
+        """The fraction of a playlist's tracks (or artists) which no earlier playlist had"""
+        if playlist_id not in self._positions:
+            return None
+        return float(self.arrays[f"{kind}-novelty"][self._positions[playlist_id]])
+
+    def closest(self, playlist_id, k=5, kind='tracks'):
+        """[(playlist date, similarity, shared), ...] for the `k` playlists most like
+        `playlist_id` by Jaccard similarity of their tracks (or artists)"""
+        if playlist_id not in self._positions:
+            return []
+        row = self._positions[playlist_id]
+        scores = np.array(self.arrays[f"{kind}-similarity"][row])
+        scores[row] = -1
+        top = np.argsort(-scores, kind='stable')[:k]
+        top = top[scores[top] > 0]
+        sizes = self.arrays[f"{kind}-sizes"]
+        # jaccard = shared / (a + b - shared), so shared = jaccard * (a + b) / (1 + jaccard)
+        shared = np.rint(scores[top] * (sizes[row] + sizes[top]) / (1 + scores[top])).astype(int)
+        return [(date.fromordinal(int(self.dates[i])), float(scores[i]), int(n)) for i, n in zip(top, shared)]
+
+def load(version):
+    return Membership(indexfiles.load_arrays(version, dict((a, a) for a in ARRAYS)))
+
+def update_after_ingest(session, db_path='birdnest.db', full=False):
+    return indexfiles.update_after_ingest('membership', update, index_dir(db_path), session, full)
+
+if __name__ == '__main__':
+    indexfiles.main(__doc__.split('\n\n')[0], update_after_ingest)
@@ -0,0 +1,270 @@
+"""Performance counters for the web app and ingest, in Prometheus' text format.
+
+    metrics.instrument_app(app)   # per-route latency, SQL and template timing, /metrics
+
+A streamed response is counted once it's been sent, with the SQL its body ran.
+
+SQL is counted by engines made by storage.py, which instruments them with
+instrument_engine().
+
+Each process keeps its own REGISTRY. Under gunicorn, where every worker has its own, set
+BIRDNEST_METRICS_DIR to a directory shared by the workers (and emptied on deploy): each
+worker saves its numbers there, and /metrics adds them all up, whichever worker answers.
+
+Set BIRDNEST_SLOW_REQUEST_MS to log requests slower than that, with every SQL statement
+they ran and how long each took, to the `birdnest.slow` logger.
+
+Scripts can save their numbers with write_textfile(), e.g. for node_exporter's textfile
+collector.
+"""
+
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+slow_log = logging.getLogger('birdnest.slow')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}' if pairs else ''
+
+class Counter():
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def inc(self, amount=1, **labels):
+        self.registry._inc(self.name, labels, amount)
+
+class Histogram():
+    def __init__(self, registry, name, buckets):
+        self.registry = registry
+        self.name = name
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        self.registry._observe(self.name, labels, self.buckets, value)
+
+class Registry():
+    """Counters and histograms, each with any number of labelled series. Thread-safe."""
+
+    def __init__(self):
+        self._meta = {} # name -> (type, help, buckets)
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [per-bucket counts (the last is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def counter(self, name, help):
+        self._meta.setdefault(name, ('counter', help, None))
+        return Counter(self, name)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        self._meta.setdefault(name, ('histogram', help, tuple(buckets)))
+        return Histogram(self, name, tuple(buckets))
+
+    def _inc(self, name, labels, amount):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def _observe(self, name, labels, buckets, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            series[0][bisect_left(buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """Everything recorded so far, as something json can save"""
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels, list(counts), total, n] for (name, labels), (counts, total, n) in self._histograms.items()],
+            }
+
+    def render(self, snapshots=None):
+        """Prometheus text exposition of `snapshots` (default: just this process) added up"""
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+        counters, histograms = {}, {}
+        for snap in snapshots:
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total, n in snap['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                series = histograms.setdefault(key, [[0] * len(counts), 0, 0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += n
+        lines = []
+        for name, (kind, help, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+            else:
+                for (series_name, labels), (counts, total, n) in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for le, count in zip(list(buckets) + ['+Inf'], counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {n}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram('birdnest_request_seconds', 'Time to handle a request, by route')
+REQUEST_SQL_STATEMENTS = REGISTRY.histogram('birdnest_request_sql_statements', 'SQL statements run per request, by route', COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = REGISTRY.histogram('birdnest_request_sql_seconds', 'Time spent in SQL per request, by route')
+TEMPLATE_SECONDS = REGISTRY.histogram('birdnest_template_render_seconds', 'Time to render a template, by template')
+SQL_STATEMENTS = REGISTRY.counter('birdnest_sql_statements_total', 'SQL statements run, by engine role')
+SQL_SECONDS = REGISTRY.counter('birdnest_sql_seconds_total', 'Time spent in SQL, by engine role')
+API_CALLS = REGISTRY.counter('birdnest_spotify_api_calls_total', 'Spotify API requests, by spotipy method and HTTP status')
+API_SECONDS = REGISTRY.histogram('birdnest_spotify_api_seconds', 'Spotify API request latency, by spotipy method')
+API_RETRIES = REGISTRY.counter('birdnest_spotify_api_retries_total', 'Spotify API requests retried, by spotipy method and HTTP status')
+
+_local = threading.local()
+
+def instrument_engine(engine, role):
+    """Count and time every statement `engine` runs. While a Flask request is being handled
+    on this thread, its statements are also added to that request's totals."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('birdnest_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['birdnest_query_start'].pop()
+        SQL_STATEMENTS.inc(role=role)
+        SQL_SECONDS.inc(elapsed, role=role)
+        stats = getattr(_local, 'request', None)
+        if stats is not None:
+            stats['sql_statements'] += 1
+            stats['sql_seconds'] += elapsed
+            if stats['queries'] is not None:
+                stats['queries'].append((elapsed, statement))
+
+    @event.listens_for(engine, 'handle_error')
+    def failed(context):
+        starts = context.connection.info.get('birdnest_query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+    return engine
+
+def instrument_app(app):
+    """Time every request, its SQL and its templates, and serve /metrics"""
+    from flask import Response, request, before_render_template, template_rendered
+
+    slow_ms = float(os.environ.get('BIRDNEST_SLOW_REQUEST_MS', 0)) or None
+    metrics_dir = os.environ.get('BIRDNEST_METRICS_DIR')
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    @app.before_request
+    def start_request():
+        _local.request = {'start': time.perf_counter(), 'sql_statements': 0, 'sql_seconds': 0,
+                          'queries': [] if slow_ms else None, 'templates': []}
+
+    @app.after_request
+    def finish_request(response):
+        stats = getattr(_local, 'request', None)
+        if stats is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        path = request.full_path.rstrip('?')
+        method, status = request.method, str(response.status_code)
+        def record():
+            _local.request = None
+            elapsed = time.perf_counter() - stats['start']
+            REQUEST_SECONDS.observe(elapsed, route=route, method=method, status=status)
+            REQUEST_SQL_STATEMENTS.observe(stats['sql_statements'], route=route)
+            REQUEST_SQL_SECONDS.observe(stats['sql_seconds'], route=route)
+            if slow_ms and elapsed * 1000 >= slow_ms:
+                lines = [f"{method} {path} took {elapsed * 1000:.0f}ms, "
+                         f"{stats['sql_statements']} SQL statements in {stats['sql_seconds'] * 1000:.0f}ms"]
+                lines.extend(f"  {seconds * 1000:8.2f}ms  {' '.join(statement.split())[:300]}" for seconds, statement in stats['queries'])
+                slow_log.warning('\n'.join(lines))
+            if metrics_dir:
+                save(metrics_dir)
+        if response.is_streamed:
+            # the body's queries run while it's sent, after this, so count until it's closed
+            response.call_on_close(record)
+        else:
+            record()
+        return response
+
+    def template_started(sender, template, context, **extra):
+        stats = getattr(_local, 'request', None)
+        if stats is not None:
+            stats['templates'].append(time.perf_counter())
+
+    def template_finished(sender, template, context, **extra):
+        stats = getattr(_local, 'request', None)
+        if stats is not None and stats['templates']:
+            TEMPLATE_SECONDS.observe(time.perf_counter() - stats['templates'].pop(), template=template.name or 'unknown')
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        if metrics_dir:
+            save(metrics_dir, force=True)
+            body = REGISTRY.render(load(metrics_dir))
+        else:
+            body = REGISTRY.render()
+        return Response(body, mimetype='text/plain; version=0.0.4')
+    return app
+
+_saved = 0
+
+def save(metrics_dir, force=False):
+    """Save this process's numbers to `metrics_dir`, at most once a second unless `force`"""
+    global _saved
+    now = time.monotonic()
+    if not force and now - _saved < 1:
+        return
+    _saved = now
+    fd, tmp = tempfile.mkstemp(dir=metrics_dir, prefix='.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(REGISTRY.snapshot(), f)
+    os.replace(tmp, os.path.join(metrics_dir, f"{os.getpid()}.json"))
+
+def load(metrics_dir):
+    """Every process's saved numbers"""
+    snapshots = []
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError): pass
+    return snapshots
+
+def write_textfile(path):
+    """Save this process's numbers in Prometheus text format"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
@@ -1,33 +1,440 @@
 # https://docs.sqlalchemy.org/en/13/orm/tutorial.html#querying
-from sqlalchemy import create_engine, text, ForeignKey, Column, Table
-from sqlalchemy import Integer, Float, Date, String, Boolean, JSON
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import event, text, bindparam, inspect, ForeignKey, Column, Index, Table
+from sqlalchemy import Integer, Float, Date, DateTime, String, Boolean, JSON
+from sqlalchemy.orm import sessionmaker, relationship, deferred, Session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 
+import os
 import re
 import json
-from datetime import date
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
 from sqlalchemy.orm.base import attribute_str
-from spotclient import Client
+
+import storage
 
 PLAYLIST_DATE_PATTERN = re.compile('^.*(?P<year>20\d{2})-(?P<month>\d{2})-(?P<day>\d{2}).*$')
 
 def get_session(sqlite_filepath='birdnest.db',create_all=True):
-    engine = create_engine(f"sqlite:///{sqlite_filepath}")
+    """A session for loading data, over storage.ingest_engine's single writer connection"""
+    engine = storage.ingest_engine(sqlite_filepath)
     if create_all:
         Base.metadata.create_all(engine)
+        upgrade_schema(engine)
     sessionfactory = sessionmaker()
     sessionfactory.configure(bind=engine)
     return sessionfactory()
 
+PRIMARY_KEYS = {
+    'playlist': 'playlist_id',
+    'track': 'track_id',
+    'artist': 'artist_id',
+    'album': 'album_id',
+}
+
+# stay comfortably under SQLite's limit on bound parameters
+CHUNK_SIZE = 500
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def upsert(session, table, rows, key='spotify_id'):
+    """INSERT ... ON CONFLICT(key) DO UPDATE a list of dicts into `table`, with executemany.
+    Rows may have different keys; only the columns present in a row are updated.
+    Returns the number of rows written."""
+    by_columns = defaultdict(list)
+    for row in rows:
+        by_columns[tuple(row.keys())].append(row)
+    written = 0
+    for cols, batch in by_columns.items():
+        updates = ', '.join(f"{c} = excluded.{c}" for c in cols if c != key)
+        written += session.execute(text(f"""insert into {table} ({', '.join(cols)})
+            values ({', '.join(':' + c for c in cols)})
+            on conflict ({key}) do update set {updates}"""), batch).rowcount
+    return written
+
+def insert_missing_pairs(session, table, left, right, pairs):
+    """Add (left, right) rows to an association table, skipping those it already has.
+    They're added in the order given, since readers take the order of a track's (or an
+    album's) artists from the rowids. Returns the number of rows added."""
+    pairs = list(dict.fromkeys(pairs))
+    existing = set()
+    for chunk in chunked(dict.fromkeys(l for l, _ in pairs)):
+        rows = session.execute(text(f"select {left}, {right} from {table} where {left} in :ids").bindparams(
+            bindparam('ids', expanding=True)), {'ids': chunk})
+        existing.update(tuple(row) for row in rows)
+    missing = [{'l': l, 'r': r} for l, r in pairs if (l, r) not in existing]
+    if missing:
+        session.execute(text(f"insert into {table} ({left}, {right}) values (:l, :r)"), missing)
+    return len(missing)
+
+def insert_pairs(session, table, left, right, pairs):
+    """Like insert_missing_pairs, for association tables with a unique index on (left, right),
+    which lets the database skip the ones it already has. Returns the number of rows added."""
+    rows = [{'l': l, 'r': r} for l, r in set(pairs)]
+    if not rows:
+        return 0
+    return session.execute(text(f"insert into {table} ({left}, {right}) values (:l, :r) on conflict do nothing"), rows).rowcount
+
+def genre_ids(session):
+    """name -> genre_id for the genres this session has seen. Genres are never renamed and
+    (since genre.name is unique) never duplicated, so this holds for as long as the session
+    does, bar a rollback, which clears it."""
+    return session.info.setdefault('genre_ids', {})
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_genre_ids(session, previous_transaction):
+    session.info.pop('genre_ids', None)
+
+class IdentityMap(object):
+    """spotify_id -> primary key, for each table touched by a bulk ingest. Lookups are
+    set-based and each ID is only looked up once. Genres are keyed by name."""
+
+    def __init__(self, session):
+        self.session = session
+        self.ids = defaultdict(dict)
+        self.ids['genre'] = genre_ids(session)
+
+    def __getitem__(self, table):
+        return self.ids[table]
+
+    def resolve(self, table, spotify_ids):
+        pk = PRIMARY_KEYS[table]
+        missing = set(spotify_ids) - self.ids[table].keys()
+        sql = text(f"select spotify_id, {pk} from {table} where spotify_id in :ids").bindparams(
+            bindparam('ids', expanding=True))
+        for chunk in chunked(missing):
+            self.ids[table].update(tuple(row) for row in self.session.execute(sql, {'ids': chunk}))
+        return self.ids[table]
+
+    def resolve_genres(self, names):
+        missing = set(names) - self.ids['genre'].keys()
+        sql = text("select name, genre_id from genre where name in :names").bindparams(
+            bindparam('names', expanding=True))
+        for chunk in chunked(missing):
+            self.ids['genre'].update(tuple(row) for row in self.session.execute(sql, {'names': chunk}))
+        return self.ids['genre']
+
+def upgrade_schema(engine):
+    """create_all only creates missing tables. Bring an older database up to date by adding
+    columns and indexes which have since been added to the models, and the search index and
+    the triggers which maintain it. New columns must be nullable. Creating a unique index
+    fails if the table has duplicates, which need to be cleaned up by hand."""
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    if 'genre' in tables and 'ix_genre_name' not in set(i['name'] for i in inspector.get_indexes('genre')):
+        # genre names are unique now, and artist_genre pairs; clear out the old duplicates first
+        with engine.begin() as conn:
+            merge_duplicate_genres(conn)
+    added = set()
+    for table in Base.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                engine.execute(f"alter table {table.name} add column {column.name} {column_type}")
+                added.add((table.name, column.name))
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+    with engine.begin() as conn:
+        for ddl in TRACK_SEARCH_SCHEMA:
+            conn.execute(ddl)
+        # track_search used to be dropped and rebuilt on every ingest, with arbitrary rowids
+        if 'track_search' in tables and 'track_search_dirty' not in tables:
+            rebuild_track_search(conn)
+        for ddl in ROLLUP_SCHEMA:
+            conn.execute(ddl)
+        if conn.execute(text("select not exists (select 1 from artist_plays) and exists (select 1 from playlist_track)")).scalar():
+            rebuild_rollups(conn)
+        if ('album', 'thumbnail_url') in added:
+            fill_in_thumbnails(conn)
+
+def fill_in_thumbnails(conn):
+    """Set album.thumbnail_url for albums from before ingest picked it"""
+    rows = [{'album_id': album_id, 'thumbnail_url': thumbnail(json.loads(images))}
+            for album_id, images in conn.execute(text("select album_id, images from album where images is not null"))]
+    for chunk in chunked(rows):
+        conn.execute(text("update album set thumbnail_url = :thumbnail_url where album_id = :album_id"), chunk)
+
+# track_search is a full-text index with one row per played track, with rowid = track_id.
+# Rather than rebuilding it after each ingest, triggers queue any track whose indexed text
+# might have changed in track_search_dirty, and update_track_search re-indexes just those.
+TRACK_SEARCH_SCHEMA = [
+    "create virtual table if not exists track_search using fts5(artist, track, album, track_id unindexed)",
+    "create table if not exists track_search_dirty (track_id integer primary key)",
+    """create trigger if not exists track_search_track_update after update of name, album_id on track
+        when old.name is not new.name or old.album_id is not new.album_id begin
+        insert or ignore into track_search_dirty values (new.track_id); end""",
+    """create trigger if not exists track_search_track_delete after delete on track begin
+        insert or ignore into track_search_dirty values (old.track_id); end""",
+    """create trigger if not exists track_search_playlist_track_insert after insert on playlist_track begin
+        insert or ignore into track_search_dirty values (new.track_id); end""",
+    """create trigger if not exists track_search_playlist_track_delete after delete on playlist_track begin
+        insert or ignore into track_search_dirty values (old.track_id); end""",
+    """create trigger if not exists track_search_track_artist_insert after insert on track_artist begin
+        insert or ignore into track_search_dirty values (new.track_id); end""",
+    """create trigger if not exists track_search_track_artist_delete after delete on track_artist begin
+        insert or ignore into track_search_dirty values (old.track_id); end""",
+    """create trigger if not exists track_search_artist_update after update of name on artist
+        when old.name is not new.name begin
+        insert or ignore into track_search_dirty
+            select track_id from track_artist where artist_id = new.artist_id; end""",
+    """create trigger if not exists track_search_album_update after update of name on album
+        when old.name is not new.name begin
+        insert or ignore into track_search_dirty
+            select track_id from track where album_id = new.album_id; end""",
+]
+
+TRACK_SEARCH_SELECT = """select t.track_id,
+           t.name track,
+           GROUP_CONCAT(a.name,';') artist,
+           album.name album
+    from
+        track t,
+        track_artist ta,
+        artist a,
+        album
+    where t.track_id = ta.track_id
+         and ta.artist_id = a.artist_id
+         and t.album_id = album.album_id
+         and exists (select 1 from playlist_track pt where pt.track_id = t.track_id)
+         {and_where}
+    group by t.track_id, t.name"""
+
+TRACK_SEARCH_SQL = """insert into track_search (rowid, track_id, track, artist, album)
+    select track_id, track_id, track, artist, album from ({select})"""
+
+# Play counts per artist, genre and album live in the *_plays tables, so that leaderboards
+# are an indexed read rather than a join over the whole history. As with the search index,
+# triggers queue whatever an ingest touches in rollup_dirty, and update_rollups recounts it.
+ROLLUP_SCHEMA = [
+    "create table if not exists rollup_dirty (kind text, id integer, primary key (kind, id))",
+    """create trigger if not exists rollup_playlist_track_insert after insert on playlist_track begin
+        insert or ignore into rollup_dirty select 'artist', artist_id from track_artist where track_id = new.track_id;
+        insert or ignore into rollup_dirty select 'album', album_id from track where track_id = new.track_id and album_id is not null;
+        insert or ignore into rollup_dirty select 'genre', ag.genre_id from track_artist ta, artist_genre ag
+            where ta.track_id = new.track_id and ag.artist_id = ta.artist_id; end""",
+    """create trigger if not exists rollup_playlist_track_delete after delete on playlist_track begin
+        insert or ignore into rollup_dirty select 'artist', artist_id from track_artist where track_id = old.track_id;
+        insert or ignore into rollup_dirty select 'album', album_id from track where track_id = old.track_id and album_id is not null;
+        insert or ignore into rollup_dirty select 'genre', ag.genre_id from track_artist ta, artist_genre ag
+            where ta.track_id = old.track_id and ag.artist_id = ta.artist_id; end""",
+    """create trigger if not exists rollup_track_artist_insert after insert on track_artist begin
+        insert or ignore into rollup_dirty values ('artist', new.artist_id);
+        insert or ignore into rollup_dirty select 'genre', genre_id from artist_genre where artist_id = new.artist_id; end""",
+    """create trigger if not exists rollup_track_artist_delete after delete on track_artist begin
+        insert or ignore into rollup_dirty values ('artist', old.artist_id);
+        insert or ignore into rollup_dirty select 'genre', genre_id from artist_genre where artist_id = old.artist_id; end""",
+    """create trigger if not exists rollup_artist_genre_insert after insert on artist_genre begin
+        insert or ignore into rollup_dirty values ('genre', new.genre_id); end""",
+    """create trigger if not exists rollup_artist_genre_delete after delete on artist_genre begin
+        insert or ignore into rollup_dirty values ('genre', old.genre_id); end""",
+    """create trigger if not exists rollup_track_album_update after update of album_id on track
+        when old.album_id is not new.album_id begin
+        insert or ignore into rollup_dirty select 'album', old.album_id where old.album_id is not null;
+        insert or ignore into rollup_dirty select 'album', new.album_id where new.album_id is not null; end""",
+]
+
+# for each kind of rollup: its table, its key, the key's column in a query for
+# (key, playlist_id, sequence, date) with one row per play, and that query.
+# {only} is where to restrict it to the rows being recounted.
+ROLLUPS = {
+    'artist': ('artist_plays', 'artist_id', 'ta.artist_id', """select distinct ta.artist_id, pt.playlist_id, pt.sequence, p.date
+        from track_artist ta, playlist_track pt, playlist p
+        where pt.track_id = ta.track_id and p.playlist_id = pt.playlist_id {only}"""),
+    'genre': ('genre_plays', 'genre_id', 'ag.genre_id', """select distinct ag.genre_id, pt.playlist_id, pt.sequence, p.date
+        from artist_genre ag, track_artist ta, playlist_track pt, playlist p
+        where ta.artist_id = ag.artist_id and pt.track_id = ta.track_id and p.playlist_id = pt.playlist_id {only}"""),
+    'album': ('album_plays', 'album_id', 't.album_id', """select t.album_id, pt.playlist_id, pt.sequence, p.date
+        from track t, playlist_track pt, playlist p
+        where pt.track_id = t.track_id and p.playlist_id = pt.playlist_id and t.album_id is not null {only}"""),
+}
+
+def _recount(conn, kind, dirty_only):
+    table, key, column, plays = ROLLUPS[kind]
+    if dirty_only:
+        conn.execute(text(f"delete from {table} where {key} in (select id from rollup_dirty where kind = :kind)"), {'kind': kind})
+        only = f"and {column} in (select id from rollup_dirty where kind = :kind)"
+    else:
+        conn.execute(text(f"delete from {table}"))
+        only = ""
+    conn.execute(text(f"""insert into {table} ({key}, plays, first_played, last_played)
+        select {key}, count(*), min(date), max(date) from ({plays.format(only=only)}) group by {key}"""), {'kind': kind})
+
+def update_rollups(conn):
+    """Recount plays for the artists, genres and albums queued in rollup_dirty"""
+    for kind in ROLLUPS:
+        _recount(conn, kind, dirty_only=True)
+    conn.execute(text("delete from rollup_dirty"))
+
+def rebuild_rollups(conn):
+    """Recount every play, from scratch"""
+    for kind in ROLLUPS:
+        _recount(conn, kind, dirty_only=False)
+    conn.execute(text("delete from rollup_dirty"))
+
+def merge_duplicate_genres(conn):
+    """Merge genres with the same name into the one with the lowest genre_id, and drop
+    duplicate artist_genre rows, all set-based and in the caller's transaction. Returns
+    how many genres were merged away."""
+    conn.execute(text("drop table if exists temp.genre_merge"))
+    conn.execute(text("""create temp table genre_merge as
+        select g.genre_id, k.keep from genre g
+            join (select name, min(genre_id) keep from genre group by name) k on k.name = g.name
+        where g.genre_id <> k.keep"""))
+    merged = conn.execute(text("select count(*) from temp.genre_merge")).scalar()
+    if merged:
+        conn.execute(text("""update artist_genre
+            set genre_id = (select keep from temp.genre_merge m where m.genre_id = artist_genre.genre_id)
+            where genre_id in (select genre_id from temp.genre_merge)"""))
+        conn.execute(text("delete from genre_plays where genre_id in (select genre_id from temp.genre_merge)"))
+        conn.execute(text("delete from genre where genre_id in (select genre_id from temp.genre_merge)"))
+    conn.execute(text("drop table temp.genre_merge"))
+    duplicates = conn.execute(text("""delete from artist_genre where rowid not in (
+        select min(rowid) from artist_genre group by artist_id, genre_id)""")).rowcount
+    if merged or duplicates:
+        _recount(conn, 'genre', dirty_only=False)
+        bump_generation(conn)
+    return merged
+
+def bump_generation(conn):
+    conn.execute(text("""insert into generation (generation_id, value, updated) values (1, 1, :now)
+        on conflict (generation_id) do update set value = value + 1, updated = excluded.updated""").bindparams(
+        bindparam('now', type_=DateTime)), {'now': datetime.utcnow()})
+
+def update_track_search(conn):
+    """Re-index the tracks queued in track_search_dirty. Returns how many were queued."""
+    queued = conn.execute(text("select count(*) from track_search_dirty")).scalar()
+    if queued:
+        conn.execute(text("delete from track_search where rowid in (select track_id from track_search_dirty)"))
+        conn.execute(text(TRACK_SEARCH_SQL.format(select=TRACK_SEARCH_SELECT.format(
+            and_where="and t.track_id in (select track_id from track_search_dirty)"))))
+        conn.execute(text("delete from track_search_dirty"))
+    return queued
+
+def rebuild_track_search(conn):
+    """Repopulate track_search from scratch, in place, so searches still work (against the
+    old index) until the transaction commits. Raises if FTS5's integrity check fails."""
+    conn.execute(text("delete from track_search"))
+    conn.execute(text(TRACK_SEARCH_SQL.format(select=TRACK_SEARCH_SELECT.format(and_where=""))))
+    conn.execute(text("delete from track_search_dirty"))
+    conn.execute(text("insert into track_search (track_search) values ('integrity-check')"))
+    bump_generation(conn)
+
+def check_track_search(conn):
+    """Compare the search index with what it should contain. Returns a list of problems,
+    which is empty if all is well."""
+    problems = []
+    try:
+        conn.execute(text("insert into track_search (track_search) values ('integrity-check')"))
+    except Exception as e:
+        problems.append(f"FTS5 integrity check failed: {e}")
+    expected = TRACK_SEARCH_SELECT.format(and_where="")
+    missing = conn.execute(text(f"""select count(*) from ({expected})
+        where track_id not in (select rowid from track_search)""")).scalar()
+    if missing:
+        problems.append(f"{missing} tracks are missing from the index")
+    stale = conn.execute(text(f"""select count(*) from track_search
+        where rowid not in (select track_id from ({expected}))""")).scalar()
+    if stale:
+        problems.append(f"{stale} indexed tracks shouldn't be")
+    queued = conn.execute(text("select count(*) from track_search_dirty")).scalar()
+    if queued:
+        problems.append(f"{queued} tracks are waiting to be re-indexed")
+    return problems
+
+# bm25 weights for track_search's columns (artist, track, album, track_id). Artists count
+# for most, since that's mostly what people are looking for.
+SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 0.0)
+SEARCH_PAGE_SIZE = 50
+
+def fts_query(terms, prefix=False):
+    """Turn what someone typed into an FTS5 query matching all of its words. With `prefix`,
+    the last word may be unfinished, as when typing ahead."""
+    words = [f'"{w}"' for w in terms.replace('"', ' ').split()]
+    if prefix and words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+def search_track_ids(conn, terms, limit=SEARCH_PAGE_SIZE, after=None, prefix=True):
+    """Rank the tracks matching `terms`, best first, returning up to `limit` (track_id, score)
+    pairs. As with bm25(), lower scores are better. For the next page, pass the last pair
+    of this one as `after`."""
+    query = fts_query(terms, prefix)
+    if not query:
+        return []
+    params = {'query': query, 'limit': limit}
+    where = ""
+    if after is not None:
+        where = "where score > :after_score or (score = :after_score and track_id > :after_id)"
+        params.update(after_id=after[0], after_score=after[1])
+    weights = ', '.join(map(str, SEARCH_WEIGHTS))
+    return [tuple(row) for row in conn.execute(text(f"""select track_id, score from (
+            select rowid track_id, bm25(track_search, {weights}) score
+            from track_search where track_search match :query)
+        {where}
+        order by score, track_id limit :limit"""), params)]
+
+# highlight() markers for suggest_tracks; control characters, so they can't clash with
+# anything in a name and can be swapped for markup after escaping.
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03'
+
+def suggest_tracks(conn, terms, limit=10):
+    """The best few matches for a partly typed query, answered from the search index alone.
+    Returns dicts of track_id, artist, track and album, with the matching words in each
+    wrapped in HIGHLIGHT_START and HIGHLIGHT_END."""
+    query = fts_query(terms, prefix=True)
+    if not query:
+        return []
+    weights = ', '.join(map(str, SEARCH_WEIGHTS))
+    rows = conn.execute(text(f"""select rowid track_id,
+            highlight(track_search, 0, :start, :end) artist,
+            highlight(track_search, 1, :start, :end) track,
+            highlight(track_search, 2, :start, :end) album
+        from track_search where track_search match :query
+        order by bm25(track_search, {weights}) limit :limit"""),
+        {'query': query, 'limit': limit, 'start': HIGHLIGHT_START, 'end': HIGHLIGHT_END})
+    return [dict(row) for row in rows]
+
 class Database(object):
     engine = None
     api_client = None
 
-    def __init__(self,sqlite_filepath='birdnest.db'):
-        self.api_client = Client()
+    def __init__(self,sqlite_filepath='birdnest.db',api_client=None,artist_max_age=None):
+        """`api_client` defaults to a plain spotclient.Client; pass one with a
+        ResponseCache (possibly in replay-only mode) to avoid re-fetching from the API.
+        Artists fetched from the API within `artist_max_age` (a timedelta; by default
+        BIRDNEST_ARTIST_MAX_AGE_DAYS days, or 30) aren't fetched again.
+        `rows_written` counts rows per table, `skipped` the playlists and artists which
+        were already up to date, and `timings` seconds per stage of ingest, for reporting
+        throughput."""
+        if api_client is None:
+            from spotclient import Client # only ingest needs spotipy, so the web app doesn't load it
+            api_client = Client()
+        self.api_client = api_client
+        if artist_max_age is None:
+            artist_max_age = timedelta(days=float(os.environ.get('BIRDNEST_ARTIST_MAX_AGE_DAYS', 30)))
+        self.artist_max_age = artist_max_age
+        self.rows_written = Counter()
+        self.skipped = Counter()
+        self.timings = Counter()
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
 
     def insert_playlist_from_json(self,session, j):
         """Given JSON matching Spotify's PlaylistObject, fully update the database.
@@ -35,45 +442,181 @@ class Database(object):
            in the input to this param. Should this make further calls? Or leave that for another
            process?
         """
-        # consider replace/overwrite/error semantics
-        playlist = Playlist.get_or_create(session,j['id'])
-        playlist.name = j['name']
-        playlist.description = j['description']
-        try:
-            playlist.images = j['images']
-        except KeyError: pass
-
-        playlist.spotify_url = j['external_urls'].get('spotify')
-
-        if match := PLAYLIST_DATE_PATTERN.match(playlist.name): # := walrus requires Python 3.8
-            playlist.date = date(*(map(int,match.groups())))
-
-        for i,t in enumerate(self.api_client.playlist_tracks(j['id'],full=True)):
-            track_obj = self.insert_track_from_json(session,t)
-            playlist.playlist_tracks.append(PlaylistTrack(playlist=playlist,track=track_obj,sequence=i))
-
-        session.add(playlist)
-
-        # fill in artists
-        artist_ids = set()
-        for t in playlist.tracks:
-            for a in t.artists:
-                artist_ids.add(a.spotify_id)
+        return self.insert_playlists_from_json(session, [j])[0]
 
-        self.fill_in_artists(session,artist_ids)
+    def insert_playlists_from_json(self, session, playlists, force=False):
+        """Bulk version of insert_playlist_from_json for a batch of PlaylistObjects. Every track,
+        artist and genre the batch mentions is resolved to a primary key with set-based lookups
+        through an IdentityMap, and written with executemany upserts keyed on spotify_id, instead
+        of a get_or_create query per object. Returns the Playlist objects, in input order.
 
-        self.fill_in_audio_features(session, playlist.tracks)
-
-        self.fill_in_albums(session)
-
-        return playlist
-
-    def fill_in_artists(self, session, artist_ids):
-        artists = []
-        for a in self.api_client.artists(artist_ids):
-            artist = self.insert_artist_from_json(session, a)
-            artists.append(artist)
-        return artists
+        Playlists whose snapshot_id is the one we already have haven't changed on Spotify, so
+        unless `force` is set they're skipped: no API calls and no writes. If the whole batch
+        is unchanged the data generation isn't bumped either, so caches stay warm.
+        Don't forget to commit the session yourself..."""
+        playlists = list(playlists)
+        session.flush()
+        ids = IdentityMap(session)
+        changed = playlists if force else self.changed_playlists(session, playlists)
+        self.skipped['playlist'] += len(playlists) - len(changed)
+        if changed:
+            self._insert_playlists(session, changed, ids)
+
+        ids.resolve('playlist', [p['id'] for p in playlists])
+        by_pk = dict((pl.playlist_id, pl) for pl in session.query(Playlist).filter(Playlist.playlist_id.in_(ids['playlist'].values())))
+        return [by_pk[ids['playlist'][p['id']]] for p in playlists]
+
+    def changed_playlists(self, session, playlists):
+        """The PlaylistObjects in `playlists` which are new, or whose snapshot_id differs from the one stored"""
+        stored = {}
+        for chunk in chunked([p['id'] for p in playlists]):
+            stored.update(session.execute(text("select spotify_id, snapshot_id from playlist where spotify_id in :ids").bindparams(
+                bindparam('ids', expanding=True)), {'ids': chunk}).fetchall())
+        return [p for p in playlists if p.get('snapshot_id') is None or stored.get(p['id']) != p['snapshot_id']]
+
+    def _insert_playlists(self, session, playlists, ids):
+        playlist_tracks = {}
+        track_json = {}
+        with self.timed('fetch'):
+            fetched = self.api_client.playlists_tracks([p['id'] for p in playlists], full=True,
+                                                       snapshot_ids=[p.get('snapshot_id') for p in playlists])
+        for p, tracks in zip(playlists, fetched):
+            # local files and tracks since removed from Spotify come back without IDs
+            tracks = [t for t in tracks if t and t.get('id')]
+            playlist_tracks[p['id']] = tracks
+            for t in tracks:
+                track_json[t['id']] = t
+
+        # track data embeds simplified albums, which in turn embed their artists
+        albums = dict((t['album']['id'], t['album']) for t in track_json.values() if t['album'].get('id'))
+        simplified = dict((a['id'], a) for t in track_json.values() for a in t['artists'] if a.get('id'))
+        simplified.update((a['id'], a) for al in albums.values() for a in al.get('artists', []) if a.get('id'))
+        self.fill_in_artists(session, simplified.keys(), ids=ids, fallback=simplified)
+        self.upsert_albums(session, albums, ids)
+
+        with self.timed('write'):
+            self.rows_written['track'] += upsert(session, 'track', [{
+                'spotify_id': t['id'],
+                'name': t['name'],
+                'duration_ms': t['duration_ms'],
+                'explicit': t['explicit'],
+                'popularity': t['popularity'],
+                'isrc_id': t['external_ids'].get('isrc'),
+                'spotify_url': t['external_urls'].get('spotify'),
+                'preview_url': t['preview_url'],
+                'album_id': ids['album'].get(t['album'].get('id')),
+            } for t in track_json.values()])
+            ids.resolve('track', track_json.keys())
+
+            # in credit order: the first is the track's primary artist
+            credits = dict.fromkeys((ids['track'][t['id']], ids['artist'][a['id']])
+                                    for t in track_json.values() for a in t['artists'] if a.get('id'))
+            self.rows_written['track_artist'] += insert_missing_pairs(
+                session, 'track_artist', 'track_id', 'artist_id', credits)
+
+            playlist_rows = []
+            for p in playlists:
+                row = {
+                    'spotify_id': p['id'],
+                    'name': p['name'],
+                    'description': p['description'],
+                    'spotify_url': p['external_urls'].get('spotify'),
+                    'snapshot_id': p.get('snapshot_id'),
+                }
+                if 'images' in p:
+                    row['images'] = json.dumps(p['images'])
+                if match := PLAYLIST_DATE_PATTERN.match(p['name']): # := walrus requires Python 3.8
+                    row['date'] = date(*(map(int,match.groups()))).isoformat()
+                playlist_rows.append(row)
+            self.rows_written['playlist'] += upsert(session, 'playlist', playlist_rows)
+            ids.resolve('playlist', playlist_tracks.keys())
+
+            # a playlist's track listing is replaced wholesale
+            playlist_pks = [ids['playlist'][p] for p in playlist_tracks]
+            session.execute(text("delete from playlist_track where playlist_id in :ids").bindparams(
+                bindparam('ids', expanding=True)), {'ids': playlist_pks})
+            rows = [{'p': ids['playlist'][p], 't': ids['track'][t['id']], 'i': i}
+                    for p, tracks in playlist_tracks.items() for i, t in enumerate(tracks)]
+            if rows:
+                session.execute(text("insert into playlist_track (playlist_id, track_id, sequence) values (:p, :t, :i)"), rows)
+            self.rows_written['playlist_track'] += len(rows)
+
+        # the ORM hasn't seen any of the above
+        session.expire_all()
+
+        with self.timed('index'):
+            self.update_fts(session)
+            update_rollups(session)
+        bump_generation(session)
+
+    def fill_in_artists(self, session, artist_ids, ids=None, fallback=None, max_age=None):
+        """Fetch full ArtistObjects for `artist_ids` and upsert them, along with their genres.
+        Artists fetched within `max_age` (by default self.artist_max_age) are left as they are.
+        `fallback` may map IDs to simplified ArtistObjects to use if the API has nothing better.
+        Returns an IdentityMap which includes the artists."""
+        if ids is None:
+            ids = IdentityMap(session)
+        all_ids = list(artist_ids)
+        fresh = self.fresh_artists(session, all_ids, self.artist_max_age if max_age is None else max_age)
+        artist_ids = [a for a in all_ids if a not in fresh]
+        self.skipped['artist'] += len(all_ids) - len(artist_ids)
+        fallback = fallback or {}
+        rows = []
+        artist_genres = []
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f') # as SQLAlchemy stores a DateTime
+        with self.timed('fetch'):
+            api_artists = self.api_client.artists(artist_ids) if artist_ids else []
+        for spotify_id, a in zip(artist_ids, api_artists):
+            if a is not None:
+                fetched_at = now
+            else:
+                a = fallback.get(spotify_id)
+                if a is None: continue
+                fetched_at = None
+            row = {
+                'spotify_id': spotify_id,
+                'name': a['name'],
+                'spotify_url': a['external_urls'].get('spotify'),
+            }
+            if fetched_at:
+                row['fetched_at'] = fetched_at
+            # simplified ArtistObjects don't have these, and we don't want to null them out
+            if 'popularity' in a:
+                row['popularity'] = a['popularity']
+            if 'followers' in a:
+                row['followers'] = a['followers'].get('total')
+            if 'images' in a:
+                row['images'] = json.dumps(a['images'])
+            rows.append(row)
+            artist_genres.extend((spotify_id, g) for g in a.get('genres', []))
+
+        with self.timed('write'):
+            self.rows_written['artist'] += upsert(session, 'artist', rows)
+            ids.resolve('artist', all_ids)
+
+            genre_names = set(g for _, g in artist_genres)
+            ids.resolve_genres(genre_names)
+            missing = [{'name': g} for g in genre_names if g not in ids['genre']]
+            if missing:
+                self.rows_written['genre'] += session.execute(
+                    text("insert into genre (name) values (:name) on conflict (name) do nothing"), missing).rowcount
+                ids.resolve_genres(genre_names)
+            self.rows_written['artist_genre'] += insert_pairs(
+                session, 'artist_genre', 'artist_id', 'genre_id',
+                set((ids['artist'][a], ids['genre'][g]) for a, g in artist_genres))
+        return ids
+
+    def fresh_artists(self, session, artist_ids, max_age):
+        """The spotify_ids among `artist_ids` of artists fetched from the API within `max_age`"""
+        fresh = set()
+        if not max_age:
+            return fresh
+        cutoff = datetime.utcnow() - max_age
+        for chunk in chunked(artist_ids):
+            fresh.update(row[0] for row in session.execute(text(
+                "select spotify_id from artist where fetched_at >= :cutoff and spotify_id in :ids").bindparams(
+                bindparam('ids', expanding=True), bindparam('cutoff', type_=DateTime)), {'ids': chunk, 'cutoff': cutoff}))
+        return fresh
 
     def fill_in_audio_features(self, session, tracks):
         """This endpoint deprecated and disabled 2024-11-24"""
@@ -92,80 +635,88 @@ class Database(object):
         #     track.features = af
         #     session.add(track)
 
-    def insert_track_from_json(self, session, t):
-        track = Track.get_or_create(session,t['id'])
-        track.name = t['name']
-        track.duration_ms = t['duration_ms']
-        track.explicit = t['explicit']
-        track.popularity = t['popularity']
-        track.isrc_id = t['external_ids'].get('isrc')
-        track.spotify_url = t['external_urls'].get('spotify')
-        track.preview_url = t['preview_url']
-
-        for a in t['artists']: # what if they're already there?
-            artist = self.insert_artist_from_json(session,a)
-            if artist not in track.artists:
-                track.artists.append(artist)
-        return track
-
-    def insert_artist_from_json(self, session, a):
-        artist = Artist.get_or_create(session, a['id'],init_data=a)
-        session.add(artist)
-        return artist
-        
-    def search_tracks(self, session, query):
-        query = ' '.join(map(lambda x: f'"{x}"',query.split())) # esca
-        sql = """select t.* from 
-        track t, track_search ts 
-        where t.track_id = ts.track_id
-        and track_search match :terms"""
-        return session.query(Track).from_statement(text(sql)).params(terms=query).all()
+    def search_tracks(self, session, terms, limit=SEARCH_PAGE_SIZE, after=None, options=(), cache=None):
+        """See queries.search_tracks"""
+        import queries
+        return queries.search_tracks(session, terms, limit, after, options, cache)
+
+    def upsert_albums(self, session, albums, ids):
+        """Given simplified AlbumObjects by spotify_id (as embedded in TrackObjects), upsert them
+        and link them to their artists, who must already be in `ids`. Full AlbumObjects, which add
+        label and popularity, are only fetched for albums which aren't in the database yet."""
+        ids.resolve('album', albums.keys())
+        new = [a for a in albums if a not in ids['album']]
+        with self.timed('fetch'):
+            full = dict(zip(new, self.api_client.albums(new)))
+        rows = []
+        for spotify_id, a in albums.items():
+            a = full.get(spotify_id) or a
+            row = {
+                'spotify_id': spotify_id,
+                'name': a['name'],
+                'spotify_url': a.get('external_urls', {}).get('spotify', f"https://open.spotify.com/album/{spotify_id}"),
+                'images': json.dumps(a['images']),
+                'thumbnail_url': thumbnail(a['images']),
+            }
+            # instead of a.get('label') which would overwrite a previous value
+            # with None when we're updating from a simplified AlbumObject
+            if 'label' in a:
+                row['label'] = a['label']
+            if 'popularity' in a:
+                row['popularity'] = a['popularity']
+            rows.append(row)
+        with self.timed('write'):
+            self.rows_written['album'] += upsert(session, 'album', rows)
+            ids.resolve('album', albums.keys())
+            self.rows_written['album_artist'] += insert_missing_pairs(
+                session, 'album_artist', 'album_id', 'artist_id',
+                dict.fromkeys((ids['album'][al], ids['artist'][ar['id']])
+                              for al, a in albums.items() for ar in a.get('artists', []) if ar.get('id') in ids['artist']))
+        return ids
 
     def fill_in_albums(self, session):
         """find all tracks that don't have albums, and look them up from spotify
-           and add the album data. In the normal flow, we don't have the album IDs, so 
-           it's about as easy to find tracks that need them and look them up.
+           and add the album data. Ingest takes albums from the track data, so this
+           is only needed for tracks loaded before it did.
         Don't forget to commit the session yourself..."""
-        track_ids = [t.spotify_id for t in session.query(Track).filter(Track.album == None)]
+        session.flush()
+        missing = dict(session.execute(text("select spotify_id, track_id from track where album_id is null")).fetchall())
+        if not missing:
+            return
 
         # figure out their albums
-        api_tracks = self.api_client.tracks(track_ids)
-        track_album_ids = dict((t['id'], t['album']['id']) for t in api_tracks)
-        album_ids = track_album_ids.values()
-
-        # and get the API data for those albums
-        api_albums = self.api_client.albums(album_ids)
-        api_album_dict = dict((a['id'], a) for a in api_albums)
-
-        # and then create those album objects and attach them
-        for k,v in track_album_ids.items():
-            track = session.query(Track).filter(Track.spotify_id == k).first()
-            track.album = Album.get_or_create(session, v, api_album_dict[v])
+        with self.timed('fetch'):
+            api_tracks = self.api_client.tracks(missing.keys())
+        track_albums = dict((spotify_id, t['album']) for spotify_id, t in zip(missing, api_tracks)
+                            if t and t['album'].get('id'))
+        albums = dict((a['id'], a) for a in track_albums.values())
+
+        ids = IdentityMap(session)
+        album_artists = dict((ar['id'], ar) for a in albums.values() for ar in a['artists'] if ar.get('id'))
+        ids.resolve('artist', album_artists.keys())
+        new_artists = set(album_artists) - ids['artist'].keys()
+        if new_artists:
+            self.fill_in_artists(session, new_artists, ids=ids, fallback=album_artists)
+        self.upsert_albums(session, albums, ids)
+
+        # and then attach them, all at once
+        with self.timed('write'):
+            session.execute(text("update track set album_id = :album_id where track_id = :track_id"),
+                [{'album_id': ids['album'][a['id']], 'track_id': missing[spotify_id]}
+                 for spotify_id, a in track_albums.items()])
+        session.expire_all()
+        self.update_fts(session)
+        update_rollups(session)
+        bump_generation(session)
+
+    def update_fts(self, session):
+        """Re-index just the tracks which triggers have queued in track_search_dirty"""
+        return update_track_search(session)
 
     def rebuild_fts(self, session):
-        "rn easier to just rebuild every time than worry about inconsistencies."
-        session.execute("drop table if exists track_search")
-        session.execute("create virtual table track_search using fts5(artist, track, album, track_id unindexed)")
-
-        UPDATE_FTS_SQL = '''insert into track_search (track_id, track, artist, album) 
-    select t.track_id,
-           t.name track,
-           GROUP_CONCAT(a.name,';') artist,
-           album.name album
-    from 
-        playlist p,
-        playlist_track pt,
-        track t,
-        track_artist ta,
-        artist a,
-        album 
-    where t.track_id = ta.track_id 
-         and ta.artist_id = a.artist_id
-         and p.playlist_id = pt.playlist_id
-         and pt.track_id = t.track_id
-         and t.album_id = album.album_id
-    group by t.track_id, t.name'''
-        session.execute(UPDATE_FTS_SQL)
+        """Repopulate the whole search index from scratch and check it. This shouldn't be needed
+        in the normal course of things, since ingests keep it up to date; see rebuild_search.py"""
+        return rebuild_track_search(session)
 
 Base = declarative_base()
 
@@ -179,29 +730,85 @@ Base = declarative_base()
 #         return o    
 
 
-track_artist = Table("track_artist", Base.metadata, Column("track_id", Integer, ForeignKey("track.track_id")), Column("artist_id", Integer, ForeignKey("artist.artist_id")))
+# association tables are indexed both ways: the search and rollup triggers look them up
+# by either side, once per row written, and without indexes that's a scan every time
+track_artist = Table("track_artist", Base.metadata, Column("track_id", Integer, ForeignKey("track.track_id"), index=True), Column("artist_id", Integer, ForeignKey("artist.artist_id"), index=True))
 
 artist_genre = Table('artist_genre', 
                      Base.metadata, 
                      Column("artist_id", Integer, ForeignKey("artist.artist_id")), 
-                     Column("genre_id", Integer, ForeignKey("genre.genre_id"))
+                     Column("genre_id", Integer, ForeignKey("genre.genre_id"), index=True),
+                     Index('ix_artist_genre_pair', 'artist_id', 'genre_id', unique=True) # also serves artist_id lookups
                 )
 
-album_track =  Table("album_track", Base.metadata, Column("album_id", Integer, ForeignKey("album.album_id")), Column("track_id", Integer, ForeignKey("track.track_id")))
-
-album_artist = Table("album_artist", Base.metadata, Column("album_id", Integer, ForeignKey("album.album_id")), Column("artist_id", Integer, ForeignKey("artist.artist_id")))
+album_track =  Table("album_track", Base.metadata, Column("album_id", Integer, ForeignKey("album.album_id"), index=True), Column("track_id", Integer, ForeignKey("track.track_id"), index=True))
+
+album_artist = Table("album_artist", Base.metadata, Column("album_id", Integer, ForeignKey("album.album_id"), index=True), Column("artist_id", Integer, ForeignKey("artist.artist_id"), index=True))
+
+def plays_table(name, key, target):
+    return Table(name, Base.metadata,
+                 Column(key, Integer, ForeignKey(target), primary_key=True),
+                 Column('plays', Integer, index=True),
+                 Column('first_played', Date),
+                 Column('last_played', Date))
+
+# maintained by update_rollups
+artist_plays = plays_table('artist_plays', 'artist_id', 'artist.artist_id')
+genre_plays = plays_table('genre_plays', 'genre_id', 'genre.genre_id')
+album_plays = plays_table('album_plays', 'album_id', 'album.album_id')
+
+# a single row, bumped by every ingest, so that caches of anything derived from the data
+# know when to let go of it. see bump_generation
+generation = Table('generation', Base.metadata,
+                   Column('generation_id', Integer, primary_key=True),
+                   Column('value', Integer),
+                   Column('updated', DateTime))
+
+
+
+THUMBNAIL_SIZE = 300
+
+def thumbnail(images):
+    """The URL of the THUMBNAIL_SIZE image from a list of Spotify ImageObjects, if there is one"""
+    return pick_image([(i['width'],i['url']) for i in images or []], THUMBNAIL_SIZE)
+
+def pick_image(images,pixels=None,max_size=None,min_size=None):
+    """Return an image URL from a list of (width, url). If pixels
+    is not None, it should be an integer, and the returned image URL will be an exact match for 
+    that pixel size. If there is no exact match, None will be returned.  If pixels is not set but 
+    either max_size or min_size are set, then the URL for the largest image which fits the 
+    constraints will be returned.
+    If no kwargs are set, the first image URL found will be 
+    returned"""
+    if pixels:
+        if pixels in dict(images):
+            img_dict = dict(images)
+            return img_dict[pixels]
+        return None
+    if not max_size and not min_size:
+        return images[0][1]
 
+    for width, url in reversed(sorted(images)):
+        if max_size and min_size:
+            if width <= max_size and width >= min_size:
+                return url
+        elif max_size and width <= max_size:
+            return url
+        elif min_size and width >= min_size:
+            return url
 
+    return None
 
 class Playlist(Base):
     __tablename__ = 'playlist'
     playlist_id = Column(Integer, primary_key=True)
-    spotify_id = Column(String)
+    spotify_id = Column(String, index=True, unique=True)
     spotify_url = Column(String)
     name = Column(String)
     description = Column(String)
     date = Column(Date) # not a spotify property, we have to infer from name
-    playlist_tracks = relationship('PlaylistTrack', order_by='PlaylistTrack.sequence', back_populates='playlist', lazy='joined')
+    snapshot_id = Column(String) # changes whenever the playlist does
+    playlist_tracks = relationship('PlaylistTrack', order_by='PlaylistTrack.sequence', back_populates='playlist')
     tracks = association_proxy('playlist_tracks','track')
 
     images = Column(JSON)
@@ -228,7 +835,7 @@ class Playlist(Base):
         """Produce a JSON representation (String) of the data in this playlist 
         as an array of track-plus objects suitable for use with Vega or Altair.
         Optionally, specify `as_object=True` to have the data returned before
-        being serialized to a String.
+        being serialized to a String. For more than one playlist, see analytics.plays_frame
         """
         j = []
         cum_ms = 0
@@ -263,19 +870,32 @@ class Playlist(Base):
             o = Playlist(spotify_id=spotify_id)
         return o
 
+class PlaylistTile(namedtuple('PlaylistTile', ['date', 'images'])):
+    """Just the columns of a Playlist which _playlist_tile.html needs, for listing
+    playlists without loading them."""
+    __slots__ = ()
+    image_url = Playlist.image_url
+
+    @staticmethod
+    def query(session):
+        return session.query(*(getattr(Playlist, c) for c in PlaylistTile._fields))
+
 class Artist(Base):
     __tablename__ = 'artist'
     artist_id = Column(Integer, primary_key=True)
     name = Column(String)
-    spotify_id = Column(String)
+    spotify_id = Column(String, index=True, unique=True)
     spotify_url = Column(String)
     images = Column(JSON)
     # uri = Column(String) # computable: 'spotify:artist:${spotify_id}'
     popularity = Column(Integer) # changes over time
     # followers is in a struct with a nullable URL (when is it not null?)
     followers = Column(Integer) # changes over time
+    # when popularity and followers last came from the API; see Database.fill_in_artists. Deferred,
+    # so the web app can read a database which ingest hasn't yet upgraded to have it
+    fetched_at = deferred(Column(DateTime))
 
-    genre_objs = relationship('Genre', secondary=artist_genre, back_populates='artists')
+    genre_objs = relationship('Genre', secondary=artist_genre, back_populates='artists', order_by='Genre.name')
     genres = association_proxy('genre_objs','name')
     # external_urls: String[] - spotify among others. 
     # Spotify can be computed: https://open.spotify.com/artist/${spotify_id}
@@ -288,32 +908,8 @@ class Artist(Base):
     albums = relationship('Album', secondary=album_artist, back_populates='artists')
 
     def image_url(self,pixels=None,max_size=None,min_size=None):
-        """Return an image URL from this object's set of images. If pixels
-        is not None, it should be an integer, and the returned image URL will be an exact match for 
-        that pixel size. If there is no exact match, None will be returned.  If pixels is not set but 
-        either max_size or min_size are set, then the URL for the largest image which fits the 
-        constraints will be returned.
-        If no kwargs are set, the first image URL found will be 
-        returned"""
-        images = [(i['width'],i['url']) for i in self.images]
-        if pixels:
-            if pixels in dict(images):
-                img_dict = dict(images)
-                return img_dict[pixels]
-            return None
-        if not max_size and not min_size:
-            return images[0][1]
-
-        for width, url in reversed(sorted(images)):
-            if max_size and min_size:
-                if width <= max_size and width >= min_size:
-                    return url
-            elif max_size and width <= max_size:
-                return url
-            elif min_size and width >= min_size:
-                return url
-
-        return None
+        """Return an image URL from this object's set of images; see pick_image"""
+        return pick_image([(i['width'],i['url']) for i in self.images], pixels, max_size, min_size)
 
     def __repr__(self) -> str:
         return f"Artist({self.spotify_id})"
@@ -347,7 +943,8 @@ class Artist(Base):
         try:
             for g in init_data['genres']:
                 if g not in o.genres:
-                    o.genres.append(g)
+                    # not o.genres.append(g), which would make a new Genre every time
+                    o.genre_objs.append(Genre.get_or_create(session, g))
         except KeyError: pass
 
         return o
@@ -356,7 +953,7 @@ class Track(Base):
 # https://developer.spotify.com/documentation/web-api/reference/#object-trackobject
     __tablename__ = 'track'
     track_id = Column(Integer, primary_key=True)
-    spotify_id = Column(String)
+    spotify_id = Column(String, index=True, unique=True)
     name = Column(String)
     duration_ms = Column(Integer)
     explicit = Column(Boolean)
@@ -365,9 +962,10 @@ class Track(Base):
     spotify_url = Column(String)
     preview_url = Column(String)
     explicit = Column(Boolean)
-    album_id = Column(Integer, ForeignKey('album.album_id'))
+    album_id = Column(Integer, ForeignKey('album.album_id'), index=True)
+    album = relationship('Album', back_populates='tracks')
     features = relationship('AudioFeatures', uselist=False, back_populates='track')
-    artists = relationship('Artist', secondary=track_artist, back_populates='tracks', lazy='joined')
+    artists = relationship('Artist', secondary=track_artist, back_populates='tracks')
     track_playlists = relationship('PlaylistTrack', back_populates='track')
     playlists = association_proxy('track_playlists','playlist')
 
@@ -386,11 +984,13 @@ class Track(Base):
             'explicit': self.explicit,
             'popularity': self.popularity,
             'explicit': self.explicit,
-            'album': self.album.name,
+            'album': self.album.name if self.album else None,
             'artists': self.artists_str(),
         }
 
-        d.update(self.features.to_json(True))
+        # audio features haven't been available from the API since 2024-11-24
+        if self.features is not None:
+            d.update(self.features.to_json(True))
 
         if as_object:
             return d
@@ -416,7 +1016,7 @@ class Track(Base):
 class PlaylistTrack(Base):
     __tablename__ = 'playlist_track'
     playlist_id = Column(Integer, ForeignKey("playlist.playlist_id"),primary_key=True)
-    track_id = Column("track_id", Integer, ForeignKey("track.track_id"),primary_key=True)
+    track_id = Column("track_id", Integer, ForeignKey("track.track_id"),primary_key=True,index=True)
     sequence = Column(Integer,primary_key=True) # allow for a track being played twice in a playlist
     playlist = relationship("Playlist", back_populates="playlist_tracks")
     track = relationship("Track", back_populates="track_playlists")
@@ -425,8 +1025,8 @@ class PlaylistTrack(Base):
 class Genre(Base):
     __tablename__ = 'genre'
     genre_id = Column(Integer, primary_key=True)
-    name = Column(String)
-    artists = relationship('Artist', secondary=artist_genre, back_populates='genre_objs')
+    name = Column(String, index=True, unique=True)
+    artists = relationship('Artist', secondary=artist_genre, back_populates='genre_objs', order_by='Artist.artist_id')
 
     def __init__(self,genre) -> None:
         super().__init__()
@@ -436,7 +1036,8 @@ class Genre(Base):
     def get_or_create(session, name):
         o = session.query(Genre).filter_by(name=name).scalar()
         if o is None:
-            o = Genre(name=name)
+            o = Genre(name)
+            session.add(o) # so that the next lookup (which autoflushes) finds it
         return o
 
 PITCH_CLASSES = [
@@ -453,11 +1054,26 @@ PITCH_CLASSES = [
     'B♭',
     'B'
 ]
+
+def key_name(key):
+    try:
+        return PITCH_CLASSES[key]
+    except:
+        return ''
+
+def mode_name(mode):
+    if mode == 0:
+        return 'major'
+    elif mode == 1:
+        return 'minor'
+    else:
+        return ''
+
 class AudioFeatures(Base):
     # https://developer.spotify.com/documentation/web-api/reference/#object-audiofeaturesobject
     __tablename__ = 'audio_features'
     features_id = Column(Integer, primary_key=True)
-    track_id = Column(Integer, ForeignKey('track.track_id'))
+    track_id = Column(Integer, ForeignKey('track.track_id'), index=True)
     track = relationship('Track', uselist=False, back_populates="features")
     analysis_url = Column(String)
     key = Column(Integer)
@@ -505,61 +1121,31 @@ class AudioFeatures(Base):
 
     @property
     def key_str(self):
-        try:
-            return PITCH_CLASSES[self.key]
-        except:
-            return ''
+        return key_name(self.key)
 
     @property
     def mode_str(self):
-        if self.mode == 0:
-            return 'major'
-        elif self.mode == 1:
-            return 'minor'
-        else:
-            return ''
+        return mode_name(self.mode)
 
 class Album(Base):
     # https://developer.spotify.com/documentation/web-api/reference/#object-simplifiedalbumobject
     # https://developer.spotify.com/documentation/web-api/reference/#object-albumobject
     __tablename__ = 'album'
     album_id = Column(Integer, primary_key=True)
-    spotify_id = Column(String)
+    spotify_id = Column(String, index=True, unique=True)
     spotify_url = Column(String)
     name = Column(String)
     label = Column(String)
     images = Column(JSON) # not in simplified
+    # picked from images at ingest, for track listings; see thumbnail. Deferred, like Artist.fetched_at
+    thumbnail_url = deferred(Column(String))
     popularity = Column(Integer) # not in simplified
     artists = relationship('Artist', secondary=album_artist, back_populates='albums')
-    tracks = relationship("Track", backref="album")
+    tracks = relationship("Track", back_populates="album")
 
     def image_url(self,pixels=None,max_size=None,min_size=None):
-        """Return an image URL from this object's set of images. If pixels
-        is not None, it should be an integer, and the returned image URL will be an exact match for 
-        that pixel size. If there is no exact match, None will be returned.  If pixels is not set but 
-        either max_size or min_size are set, then the URL for the largest image which fits the 
-        constraints will be returned.
-        If no kwargs are set, the first image URL found will be 
-        returned"""
-        images = [(i['width'],i['url']) for i in self.images]
-        if pixels:
-            if pixels in dict(images):
-                img_dict = dict(images)
-                return img_dict[pixels]
-            return None
-        if not max_size and not min_size:
-            return images[0][1]
-
-        for width, url in reversed(sorted(images)):
-            if max_size and min_size:
-                if width <= max_size and width >= min_size:
-                    return url
-            elif max_size and width <= max_size:
-                return url
-            elif min_size and width >= min_size:
-                return url
-
-        return None
+        """Return an image URL from this object's set of images; see pick_image"""
+        return pick_image([(i['width'],i['url']) for i in self.images], pixels, max_size, min_size)
 
     @staticmethod
     def get_or_create(session, spotify_id, init_data=None):
@@ -572,6 +1158,7 @@ class Album(Base):
         # treat init_data as a SpotifyAPI AlbumObject (or simplified, be careful)
         o.name = init_data['name']
         o.images = init_data['images']
+        o.thumbnail_url = thumbnail(o.images)
         try:
             # instead of init_data.get('label') which would overwrite a previous value
             # which might not be intended if we're updating from a simplified
@@ -0,0 +1,214 @@
+"""The read side of the web app: everything the Flask views ask of the database. Nothing
+here talks to Spotify, so the web tier needs neither spotipy nor API credentials -- those
+belong to ingest (models.Database, load_playlist.py, backfill.py).
+
+Each function takes a session and eagerly loads just the relationships its template
+touches, a query per relationship, instead of lazy-loading them row by row as the
+template renders."""
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import selectinload
+
+from models import Artist, Genre, Playlist, PlaylistTrack, PlaylistTile, Track
+from models import artist_plays, genre_plays, search_track_ids, suggest_tracks, SEARCH_PAGE_SIZE
+from models import key_name, mode_name
+from viewmodels import track_rows_sql, TrackRow
+
+# tracks for _tracks_table.html come separately, as TrackRows; see playlist_tracks and artist_tracks
+ARTIST_OPTIONS = [
+    selectinload(Artist.genre_objs),
+    selectinload(Artist.albums),
+]
+
+GENRE_OPTIONS = [selectinload(Genre.artists).selectinload(Artist.genre_objs)]
+
+SEARCH_OPTIONS = [
+    selectinload(Track.artists),
+    selectinload(Track.album),
+    selectinload(Track.track_playlists).selectinload(PlaylistTrack.playlist),
+]
+
+LEADERBOARD_SIZE = 250
+SIMILAR_LIMIT = 10
+
+def playlist_tiles(session):
+    """Every playlist as a PlaylistTile, newest first"""
+    return [PlaylistTile(*row) for row in PlaylistTile.query(session).order_by(Playlist.date.desc())]
+
+def playlist_by_date(session, playlist_date):
+    return session.query(Playlist).filter(Playlist.date == playlist_date).scalar()
+
+def _has_thumbnails(session):
+    """Whether ingest has upgraded the database to have album.thumbnail_url yet"""
+    return any(row[1] == 'thumbnail_url' for row in session.execute(text("pragma table_info(album)")))
+
+def playlist_tracks(session, playlist_id):
+    """A playlist's tracks as viewmodels.TrackRows, in order"""
+    sql = track_rows_sql('playlist_track pt join track t on t.track_id = pt.track_id',
+                         'where pt.playlist_id = :playlist_id', 'order by pt.sequence', _has_thumbnails(session))
+    return [TrackRow(row) for row in session.execute(text(sql), {'playlist_id': playlist_id})]
+
+def artist(session, spotify_id):
+    return session.query(Artist).options(*ARTIST_OPTIONS).filter(Artist.spotify_id == spotify_id).first()
+
+def artist_tracks(session, artist_id):
+    """An artist's tracks as viewmodels.TrackRows"""
+    sql = track_rows_sql('track_artist x join track t on t.track_id = x.track_id',
+                         'where x.artist_id = :artist_id', 'order by x.rowid', _has_thumbnails(session))
+    return [TrackRow(row) for row in session.execute(text(sql), {'artist_id': artist_id})]
+
+def track_rows(session, track_ids):
+    """{track_id: TrackRow} for search results, with the playlists each was played in as PlaylistTiles"""
+    if not track_ids:
+        return {}
+    sql = text(track_rows_sql(where='where t.track_id in :ids', thumbnails=_has_thumbnails(session))).bindparams(bindparam('ids', expanding=True))
+    rows = {row[0]: TrackRow(row) for row in session.execute(sql, {'ids': list(track_ids)})}
+    playlists = {}
+    for track_id, playlist_date, images in session.query(PlaylistTrack.track_id, Playlist.date, Playlist.images).join(
+            Playlist, Playlist.playlist_id == PlaylistTrack.playlist_id).filter(PlaylistTrack.track_id.in_(list(rows))):
+        playlists.setdefault(track_id, []).append(PlaylistTile(playlist_date, images))
+    for track_id, row in rows.items():
+        row.playlists = tuple(playlists.get(track_id, ()))
+    return rows
+
+def artist_leaderboard(session, limit=LEADERBOARD_SIZE):
+    """The most played artists, as (spotify_id, name, plays, first_played, last_played)"""
+    return session.query(Artist.spotify_id, Artist.name, artist_plays.c.plays,
+                         artist_plays.c.first_played, artist_plays.c.last_played).join(
+        artist_plays, artist_plays.c.artist_id == Artist.artist_id).order_by(
+        artist_plays.c.plays.desc()).limit(limit).all()
+
+def genre(session, name):
+    """Returns (genre, plays, stats): the Genre with its artists by popularity, a dict of
+    plays per artist_id, and its genre_plays row. Or None if there's no such genre."""
+    genre_obj = session.query(Genre).options(*GENRE_OPTIONS).filter(Genre.name == name).first()
+    if not genre_obj:
+        return None
+    genre_obj.artists.sort(key=lambda a: -(a.popularity or 0)) # reverse popularity sort
+    plays = dict(session.query(artist_plays.c.artist_id, artist_plays.c.plays).filter(
+        artist_plays.c.artist_id.in_([a.artist_id for a in genre_obj.artists])))
+    stats = session.query(genre_plays).filter(genre_plays.c.genre_id == genre_obj.genre_id).first()
+    return genre_obj, plays, stats
+
+def genres(session):
+    """Every genre name with its plays"""
+    return session.query(Genre.name, genre_plays.c.plays).outerjoin(
+        genre_plays, genre_plays.c.genre_id == Genre.genre_id).order_by(Genre.name).all()
+
+def search_tracks(session, terms, limit=SEARCH_PAGE_SIZE, after=None, options=SEARCH_OPTIONS, cache=None, load=None):
+    """One page of ranked search results. Returns (tracks, next) where `next` is the
+    `after` for the following page, or None if this is the last. Only this page's
+    Tracks are loaded; `options` are loader options for them. If `cache` (a
+    cache.SearchCache) has the ranking, the index isn't searched again. `load` takes
+    track_ids to {track_id: track}, to get the tracks from somewhere other than the
+    session (such as snapshot.Snapshot.tracks)."""
+    fetch = lambda: search_track_ids(session, terms, limit + 1, after)
+    ranked = cache.ranked(terms, limit + 1, after, fetch) if cache is not None else fetch()
+    ranked, more = ranked[:limit], ranked[limit:]
+    ids = [track_id for track_id, _ in ranked]
+    if load is not None:
+        by_id = load(ids)
+    else:
+        by_id = {t.track_id: t for t in session.query(Track).options(*options).filter(Track.track_id.in_(ids))} if ids else {}
+    tracks = [by_id[i] for i in ids if i in by_id]
+    return tracks, (ranked[-1] if more else None)
+
+def suggest(session, terms, limit=10):
+    """Typeahead suggestions, from the search index alone; see models.suggest_tracks"""
+    return suggest_tracks(session, terms, limit)
+
+# Every play, flattened like Playlist.to_json: one row per track per playlist, in order
+PLAYS_SQL = """
+select p.playlist_id, p.date,
+       t.spotify_id track_id, t.name, t.duration_ms, t.explicit, t.popularity,
+       album.name album,
+       (select group_concat(name, ', ') from (select a.name from track_artist ta join artist a on a.artist_id = ta.artist_id
+         where ta.track_id = t.track_id order by ta.rowid)) artists,
+       af.features_id, af.key, af.mode, af.tempo, af.time_signature, af.acousticness, af.danceability,
+       af.energy, af.instrumentalness, af.liveness, af.loudness, af.speechiness, af.valence
+from playlist p
+     join playlist_track pt on pt.playlist_id = p.playlist_id
+     join track t on t.track_id = pt.track_id
+     left join album on album.album_id = t.album_id
+     left join audio_features af on af.track_id = t.track_id
+where p.date is not null {where}
+order by p.date, p.playlist_id, pt.sequence
+"""
+
+TRACK_COLUMNS = ['track_id', 'name', 'duration_ms', 'explicit', 'popularity', 'album', 'artists']
+FEATURE_COLUMNS = ['tempo', 'time_signature', 'acousticness', 'danceability', 'energy',
+                   'instrumentalness', 'liveness', 'loudness', 'speechiness', 'valence']
+
+def plays(session, playlist_date=None):
+    """Yield a dict per play, with the same keys as Playlist.to_json(True) (start_time_ms
+    included) but straight from one Core query, a row at a time, so that memory use stays
+    flat however much history there is. All playlists, or just the one for `playlist_date`."""
+    where = "and p.date = :date" if playlist_date else ""
+    params = {'date': playlist_date.isoformat()} if playlist_date else {}
+    playlist_id, cum_ms = None, 0
+    for row in session.execute(text(PLAYS_SQL.format(where=where)), params):
+        if row.playlist_id != playlist_id:
+            playlist_id, cum_ms = row.playlist_id, 0
+            year, month, day = map(int, row.date.split('-'))
+            playlist_json = {'date': row.date, 'year': year, 'month': month, 'day': day}
+        d = {c: row[c] for c in TRACK_COLUMNS}
+        d['explicit'] = None if d['explicit'] is None else bool(d['explicit'])
+        if row.features_id is not None:
+            d.update(key=row.key, key_str=key_name(row.key), mode=row.mode, mode_str=mode_name(row.mode))
+            d.update((c, row[c]) for c in FEATURE_COLUMNS)
+        d.update(playlist_json)
+        d['start_time_ms'] = cum_ms
+        cum_ms += row.duration_ms or 0
+        yield d
+
+def playlist_exists(session, playlist_date):
+    return session.execute(text("select 1 from playlist where date = :date"), {'date': playlist_date.isoformat()}).first() is not None
+
+def _by_id(session, key, ids, options=()):
+    """Objects by primary key, where `key` is e.g. Track.track_id"""
+    if not ids:
+        return {}
+    return {getattr(o, key.key): o for o in session.query(key.class_).options(*options).filter(key.in_(list(ids)))}
+
+def similar_artists(session, vectors, artist_ids, k=SIMILAR_LIMIT):
+    """{artist_id: [(Artist, score), ...]} for a batch of artist_ids, from a similarity.Vectors
+    of artists (which may be None, if there's no index yet)"""
+    similar = vectors.similar(artist_ids, k) if vectors is not None else {}
+    artists = _by_id(session, Artist.artist_id, set(i for pairs in similar.values() for i, _ in pairs))
+    return {a: [(artists[i], score) for i, score in pairs if i in artists] for a, pairs in similar.items()}
+
+def similar_tracks(session, vectors, track_ids, k=SIMILAR_LIMIT):
+    """{track_id: [(Track, score), ...]}, like similar_artists"""
+    similar = vectors.similar(track_ids, k) if vectors is not None else {}
+    tracks = _by_id(session, Track.track_id, set(i for pairs in similar.values() for i, _ in pairs), [selectinload(Track.artists)])
+    return {t: [(tracks[i], score) for i, score in pairs if i in tracks] for t, pairs in similar.items()}
+
+def more_like(session, vectors, track_ids, k=SIMILAR_LIMIT):
+    """[(Track, score), ...] most like a set of tracks taken together, such as a playlist"""
+    similar = vectors.like(track_ids, k) if vectors is not None else []
+    tracks = _by_id(session, Track.track_id, [i for i, _ in similar], [selectinload(Track.artists)])
+    return [(tracks[i], score) for i, score in similar if i in tracks]
+
+def played_alongside(session, cooccurring, artist_id, k=SIMILAR_LIMIT):
+    """[(Artist, playlists together), ...] for the artists most often played in the same
+    playlists as `artist_id`, from a cooccurrence.Cooccurrence (or None, if there isn't one)"""
+    alongside = cooccurring.alongside(artist_id, k) if cooccurring is not None else []
+    artists = _by_id(session, Artist.artist_id, [a for a, _, _ in alongside])
+    return [(artists[a], together) for a, together, _ in alongside if a in artists]
+
+def circle(session, cooccurring, artist_id, k=SIMILAR_LIMIT):
+    """The most played of the other Artists in the same circle as `artist_id`"""
+    members = cooccurring.circle(artist_id, k) if cooccurring is not None else []
+    artists = _by_id(session, Artist.artist_id, members)
+    return [artists[a] for a in members if a in artists]
+
+def repeats(members, playlist_id, k=5):
+    """How much of a playlist has been played before, from a membership.Membership (or None,
+    if there isn't one): {'novelty': {'tracks': ..., 'artists': ...}, 'closest': [(date,
+    similarity, shared tracks), ...]}, or None"""
+    if members is None or members.novelty(playlist_id) is None:
+        return None
+    return {
+        'novelty': dict((kind, members.novelty(playlist_id, kind)) for kind in ('tracks', 'artists')),
+        'closest': members.closest(playlist_id, k),
+    }
@@ -0,0 +1,26 @@
+"""Check the track_search full-text index, and rebuild it from scratch if anything is wrong.
+Normally the index is kept up to date as playlists are loaded, so this is a repair tool.
+
+    python rebuild_search.py           # check, and rebuild if there are problems
+    python rebuild_search.py --check   # just check
+    python rebuild_search.py --force   # rebuild regardless
+"""
+import sys
+import models
+import storage
+
+session = models.get_session(create_all=True)
+
+problems = models.check_track_search(session)
+for p in problems:
+    print(p)
+if not problems:
+    print("search index looks fine")
+
+if '--force' in sys.argv or (problems and '--check' not in sys.argv):
+    print("rebuilding search index")
+    models.rebuild_track_search(session)
+    session.commit()
+    storage.finish_ingest(session)
+    for p in models.check_track_search(session):
+        print(f"still: {p}")
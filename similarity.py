@@ -0,0 +1,272 @@
+"""'More like this' for tracks and artists, from a precomputed index of vectors, so that a
+page asks numpy for a matrix product instead of walking audio_features and artist_genre.
+
+* A track's vector is its audio features where we have them (centered, so that cosine
+  similarity means something), and otherwise the TF-IDF weighted bag of its artists'
+  genres. The two go in separate columns, so a track is only ever like another of its kind.
+* An artist's vector is its TF-IDF genre bag, plus a column for popularity.
+
+There are thousands of genres, so genre bags are squashed into DIMENSIONS columns by a
+fixed random projection (each genre_id gets its own seeded Gaussian row), which keeps
+cosine similarities close to what they were. Every row is L2-normalized, so a dot product
+is a cosine similarity, and matrices are contiguous float32.
+
+The index lives in a directory next to the database (birdnest-similarity/, or
+BIRDNEST_SIMILARITY_DIR), as .npy files which the web app memory-maps (see indexfiles.py),
+so every worker shares one copy in the page cache. `update` runs after each ingest and only
+recomputes the rows whose inputs changed, keeping the IDF weights from the last full
+rebuild until the data has grown by a quarter since then.
+
+    python similarity.py            # bring the index up to date
+    python similarity.py --full     # rebuild it from scratch
+"""
+
+import os
+import zlib
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import text
+
+import indexfiles
+
+DIMENSIONS = 128
+SEED = 1972 # any constant, so long as it stays the same
+POPULARITY_WEIGHT = 0.25
+REBUILD_GROWTH = 1.25
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness',
+            'speechiness', 'valence', 'loudness', 'tempo']
+KINDS = ('tracks', 'artists')
+
+def index_dir(db_path='birdnest.db'):
+    return indexfiles.index_dir(db_path, 'similarity')
+
+def signature(value):
+    return zlib.crc32(repr(value).encode('utf-8'))
+
+def _inputs(conn):
+    """{kind: (ids, {id: (genre_ids, extra)})} from the database, where `extra` is a track's
+    audio features (or None) and an artist's popularity"""
+    tracks = defaultdict(list)
+    for track_id, genre_id in conn.execute(text("""select distinct ta.track_id, ag.genre_id
+            from track_artist ta join artist_genre ag on ag.artist_id = ta.artist_id
+            where ta.track_id in (select track_id from playlist_track)""")):
+        tracks[track_id].append(genre_id)
+    features = dict((row[0], tuple(row[1:])) for row in conn.execute(text(f"""
+        select track_id, {', '.join(FEATURES)} from audio_features
+        where track_id in (select track_id from playlist_track) and {' and '.join(f + ' is not null' for f in FEATURES)}""")))
+    track_ids = [row[0] for row in conn.execute(text("select distinct track_id from playlist_track order by track_id"))]
+
+    artists = defaultdict(list)
+    for artist_id, genre_id in conn.execute(text("select artist_id, genre_id from artist_genre")):
+        artists[artist_id].append(genre_id)
+    popularity = dict(conn.execute(text("select artist_id, popularity from artist")).fetchall())
+    artist_ids = sorted(popularity)
+    return {
+        'tracks': (track_ids, {t: (sorted(tracks.get(t, ())), features.get(t)) for t in track_ids}),
+        'artists': (artist_ids, {a: (sorted(artists.get(a, ())), popularity[a]) for a in artist_ids}),
+    }
+
+def _idf(inputs):
+    """genre_ids and their inverse document frequencies, over a kind's rows"""
+    df = defaultdict(int)
+    for genres, _ in inputs.values():
+        for g in genres:
+            df[g] += 1
+    genre_ids = np.array(sorted(df), dtype=np.int64)
+    counts = np.array([df[g] for g in genre_ids], dtype=np.float64)
+    return genre_ids, (np.log((1 + len(inputs)) / (1 + counts)) + 1).astype(np.float32)
+
+def _projection(genre_ids):
+    """The random row which stands for each genre; always the same for the same genre_id"""
+    if not len(genre_ids):
+        return np.zeros((0, DIMENSIONS), dtype=np.float32)
+    return np.stack([np.random.default_rng([SEED, int(g)]).standard_normal(DIMENSIONS)
+                     for g in genre_ids]).astype(np.float32) / np.float32(np.sqrt(DIMENSIONS))
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+class Weights():
+    """What's needed to turn inputs into vectors, fixed at each full rebuild so that vectors
+    made by later updates are comparable with the ones already in the index"""
+
+    def __init__(self, idf_genres, idf, feature_means, feature_scales):
+        self.idf_genres, self.idf = idf_genres, idf
+        self.feature_means, self.feature_scales = feature_means, feature_scales
+
+    @classmethod
+    def fit(cls, kind, inputs):
+        idf_genres, idf = _idf(inputs)
+        means, scales = np.zeros(len(FEATURES)), np.ones(len(FEATURES))
+        if kind == 'tracks': # an artist's extra is its popularity, not a row of features
+            features = [extra for _, extra in inputs.values() if extra is not None]
+            if features:
+                features = np.array(features, dtype=np.float64)
+                means, scales = features.mean(axis=0), features.std(axis=0)
+                scales[scales == 0] = 1
+        return cls(idf_genres, idf, means.astype(np.float32), scales.astype(np.float32))
+
+    def vectors(self, kind, ids, inputs):
+        """A normalized row per id: the projected genre bag, then the audio features (for
+        tracks, which have either but not both) or popularity (for artists)"""
+        extra_columns = len(FEATURES) if kind == 'tracks' else 1
+        matrix = np.zeros((len(ids), DIMENSIONS + extra_columns), dtype=np.float32)
+        genres = self._genre_matrix(ids, inputs)
+        for row, i in enumerate(ids):
+            _, extra = inputs[i]
+            if kind == 'tracks' and extra is not None:
+                matrix[row, DIMENSIONS:] = (np.array(extra, dtype=np.float32) - self.feature_means) / self.feature_scales
+            elif kind == 'tracks' or genres[row].any():
+                matrix[row, :DIMENSIONS] = genres[row]
+                if kind == 'artists':
+                    matrix[row, DIMENSIONS] = POPULARITY_WEIGHT * (extra or 0) / 100
+        return _normalize(matrix)
+
+    def _genre_matrix(self, ids, inputs):
+        idf = dict(zip(self.idf_genres.tolist(), self.idf.tolist()))
+        unknown = max(idf.values(), default=1.0) # a genre new since the last rebuild is a rare one
+        rows, genre_ids = [], []
+        for row, i in enumerate(ids):
+            for g in inputs[i][0]:
+                rows.append(row)
+                genre_ids.append(g)
+        weights = np.array([idf.get(g, unknown) for g in genre_ids], dtype=np.float32)
+        unique, inverse = np.unique(np.array(genre_ids, dtype=np.int64), return_inverse=True)
+        projected = _projection(unique)
+        bags = np.zeros((len(ids), DIMENSIONS), dtype=np.float32)
+        for start in range(0, len(rows), 20000): # bounded temporaries
+            chunk = slice(start, start + 20000)
+            np.add.at(bags, np.array(rows[chunk], dtype=np.int64), weights[chunk, None] * projected[inverse[chunk]])
+        return _normalize(bags)
+
+    def save(self, path):
+        np.savez(path, idf_genres=self.idf_genres, idf=self.idf,
+                 feature_means=self.feature_means, feature_scales=self.feature_scales)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['idf_genres'], f['idf'], f['feature_means'], f['feature_scales'])
+
+def update(conn, path, generation=None, full=False):
+    """Bring the index in `path` up to date with the database behind `conn`. Returns
+    {kind: (rows, rows recomputed)}."""
+    previous = indexfiles.current_version(path)
+    meta = {} if full else indexfiles.read_meta(previous)
+    if meta.get('dimensions') != DIMENSIONS:
+        meta = {}
+    result = {}
+    built = {}
+    arrays = {}
+    for kind, (ids, inputs) in _inputs(conn).items():
+        ids = np.array(ids, dtype=np.int64)
+        signatures = np.array([signature(inputs[i]) for i in ids], dtype=np.int64)
+        rebuild = not meta or len(ids) > REBUILD_GROWTH * meta['built'][kind]
+        if rebuild:
+            weights = Weights.fit(kind, inputs)
+            stale = np.ones(len(ids), dtype=bool)
+            matrix = np.zeros((len(ids), 0), dtype=np.float32)
+        else:
+            weights = Weights.load(os.path.join(previous, f"{kind}-weights.npz"))
+            old_ids = np.load(os.path.join(previous, f"{kind}-ids.npy"))
+            old_signatures = np.load(os.path.join(previous, f"{kind}-signatures.npy"))
+            old = np.load(os.path.join(previous, f"{kind}.npy"), mmap_mode='r')
+            at = np.minimum(np.searchsorted(old_ids, ids), max(len(old_ids) - 1, 0))
+            found = (old_ids[at] == ids) if len(old_ids) else np.zeros(len(ids), dtype=bool)
+            stale = ~found | (old_signatures[at] != signatures)
+            matrix = np.zeros((len(ids), old.shape[1]), dtype=np.float32)
+            matrix[~stale] = old[at[~stale]]
+        fresh = weights.vectors(kind, ids[stale].tolist(), inputs)
+        if rebuild:
+            matrix = fresh
+        else:
+            matrix[stale] = fresh
+        arrays[kind] = (np.ascontiguousarray(matrix, dtype=np.float32), ids, signatures, weights)
+        built[kind] = len(ids) if rebuild else meta['built'][kind]
+        result[kind] = (len(ids), int(stale.sum()))
+
+    if meta and not any(changed for _, changed in result.values()):
+        return result
+    version = indexfiles.new_version(path, generation)
+    for kind, (matrix, ids, signatures, weights) in arrays.items():
+        np.save(os.path.join(version, f"{kind}.npy"), matrix)
+        np.save(os.path.join(version, f"{kind}-ids.npy"), ids)
+        np.save(os.path.join(version, f"{kind}-signatures.npy"), signatures)
+        weights.save(os.path.join(version, f"{kind}-weights.npz"))
+    indexfiles.publish(path, version, {'dimensions': DIMENSIONS, 'generation': generation, 'built': built})
+    return result
+
+class Vectors():
+    """One kind's vectors, with the ids they belong to (in ascending order)"""
+
+    def __init__(self, ids, matrix):
+        self.ids = ids
+        self.matrix = matrix
+
+    def positions(self, ids):
+        """Rows for `ids`, leaving out any which aren't in the index, and their ids"""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if not len(self.ids) or not len(ids):
+            return np.zeros(0, dtype=np.int64), ids[:0]
+        at = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = self.ids[at] == ids
+        return at[found], ids[found]
+
+    def _top(self, scores, k, excluded):
+        """The top `k` of each row of `scores`, skipping `excluded` positions, as lists of (id, score)"""
+        scores[:, excluded] = -np.inf
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return [[] for _ in scores]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        return [[(int(self.ids[p]), float(s)) for p, s in zip(ps, ss) if s > 0]
+                for ps, ss in zip(top, top_scores)]
+
+    def similar(self, ids, k=10):
+        """{id: [(similar id, score), ...]} for each of `ids` that's in the index, top `k`
+        first, all in one matrix product"""
+        positions, found = self.positions(ids)
+        if not len(positions):
+            return {}
+        scores = self.matrix[positions] @ self.matrix.T
+        scores[np.arange(len(positions)), positions] = -np.inf # not itself
+        return dict(zip(found.tolist(), self._top(scores, k, [])))
+
+    def like(self, ids, k=10):
+        """The top `k` [(id, score), ...] for the centroid of `ids`, other than `ids` themselves"""
+        positions, _ = self.positions(ids)
+        if not len(positions):
+            return []
+        centroid = self.matrix[positions].sum(axis=0)
+        norm = np.linalg.norm(centroid)
+        if not norm:
+            return []
+        scores = (self.matrix @ (centroid / norm))[None, :]
+        return self._top(scores, k, positions)[0]
+
+def load(version):
+    """{kind: Vectors}, memory-mapped from a version of the index"""
+    return dict((kind, Vectors(**indexfiles.load_arrays(version, {'ids': f"{kind}-ids", 'matrix': kind})))
+                for kind in KINDS)
+
+class Index():
+    """The index for the web app, reloaded when `update` has written a new version.
+    `get(kind)` is None until there's an index to read."""
+
+    def __init__(self, path, interval=1.0):
+        self.reloader = indexfiles.Reloader(path, load, interval)
+
+    def get(self, kind):
+        return (self.reloader.get() or {}).get(kind)
+
+def update_after_ingest(session, db_path='birdnest.db', full=False):
+    return indexfiles.update_after_ingest('similarity', update, index_dir(db_path), session, full)
+
+if __name__ == '__main__':
+    indexfiles.main(__doc__.split('\n\n')[0], update_after_ingest)
@@ -0,0 +1,291 @@
+"""An in-memory copy of everything the web pages show, for serving them without the ORM.
+
+The whole database is small and only changes when an ingest commits, so instead of
+building ORM instances (and their identity map and instrumentation) on every request,
+this loads playlists, tracks, artists, albums and genres once, into plain __slots__
+objects with the attributes the templates use, with the lookups the views need already
+built: playlists by date, artists by spotify_id, each genre's artists by popularity,
+and so on. A view is then a dict lookup or two.
+
+It's opt-in: set BIRDNEST_SNAPSHOT=1 and app.py loads a snapshot at startup, and loads
+another in the background whenever an ingest bumps the generation. Until the new one is
+ready, requests go to the database as usual, so nobody gets a page from old data.
+Search ranking (FTS) and the JSON endpoints always use the database.
+
+To see how much memory a snapshot takes and how long it takes to load, and what the
+biggest genre and busiest artist allocate at peak read through the ORM and from the
+snapshot:
+
+    python snapshot.py --db birdnest.db
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+
+from models import pick_image
+from queries import LEADERBOARD_SIZE, SIMILAR_LIMIT
+from viewmodels import track_rows_sql, TrackRow
+
+Plays = namedtuple('Plays', ['plays', 'first_played', 'last_played'])
+Leader = namedtuple('Leader', ['spotify_id', 'name', 'plays', 'first_played', 'last_played'])
+
+class Playlist():
+    __slots__ = ('playlist_id', 'spotify_id', 'spotify_url', 'name', 'description', 'date', 'image_url', 'tracks')
+
+class Album():
+    __slots__ = ('album_id', 'spotify_id', 'spotify_url', 'name', 'images')
+
+    def image_url(self, pixels=None, max_size=None, min_size=None):
+        return pick_image(self.images, pixels, max_size, min_size)
+
+class Artist():
+    __slots__ = ('artist_id', 'spotify_id', 'spotify_url', 'name', 'images', 'popularity', 'followers',
+                 'genres', 'tracks', 'albums')
+
+    def image_url(self, pixels=None, max_size=None, min_size=None):
+        return pick_image(self.images, pixels, max_size, min_size)
+
+class Genre():
+    __slots__ = ('genre_id', 'name', 'artists')
+
+def _images(value):
+    """A JSON images column as a tuple of (width, url)"""
+    return tuple((i['width'], i['url']) for i in json.loads(value)) if value else ()
+
+def _date(value):
+    return date.fromisoformat(value) if value else None
+
+def _fill(cls, row, names):
+    o = cls.__new__(cls)
+    for name, value in zip(names, row):
+        setattr(o, name, value)
+    return o
+
+class Snapshot():
+    """The data as of one generation. Its methods are named after (and return what) the
+    functions in queries.py do, less the session."""
+
+    def __init__(self, conn):
+        self.generation = (conn.execute("select value from generation").fetchone() or (0,))[0]
+        names = ('album_id', 'spotify_id', 'spotify_url', 'name')
+        self.albums_by_id = {}
+        for row in conn.execute("select album_id, spotify_id, spotify_url, name, images from album"):
+            album = self.albums_by_id[row[0]] = _fill(Album, row, names)
+            album.images = _images(row[4])
+
+        names = ('artist_id', 'spotify_id', 'spotify_url', 'name', 'popularity', 'followers')
+        self.artists_by_id = {}
+        for row in conn.execute("select artist_id, spotify_id, spotify_url, name, popularity, followers, images from artist"):
+            artist = self.artists_by_id[row[0]] = _fill(Artist, row, names)
+            artist.images = _images(row[6])
+            artist.genres, artist.tracks, artist.albums = [], [], []
+        self.artists_by_spotify_id = {a.spotify_id: a for a in self.artists_by_id.values()}
+
+        self.genres_by_name = {}
+        genres_by_id = {}
+        for genre_id, name in conn.execute("select genre_id, name from genre"):
+            genre = genres_by_id[genre_id] = Genre()
+            genre.genre_id, genre.name, genre.artists = genre_id, sys.intern(name), []
+            self.genres_by_name[genre.name] = genre
+        # in the order of the Artist.genre_objs and Genre.artists relationships
+        for artist_id, genre_id in conn.execute("""select ag.artist_id, ag.genre_id from artist_genre ag
+                join genre g on g.genre_id = ag.genre_id order by g.name, ag.artist_id"""):
+            artist, genre = self.artists_by_id.get(artist_id), genres_by_id.get(genre_id)
+            if artist is not None and genre is not None:
+                artist.genres.append(genre.name)
+                genre.artists.append(artist)
+        for genre in genres_by_id.values():
+            genre.artists = tuple(sorted(genre.artists, key=lambda a: -(a.popularity or 0))) # as queries.genre does
+
+        # tracks are the same viewmodels.TrackRows as queries.py gives the templates
+        self.tracks_by_id = {}
+        thumbnails = any(row[1] == 'thumbnail_url' for row in conn.execute("pragma table_info(album)"))
+        refs = {}
+        for row in conn.execute(track_rows_sql(thumbnails=thumbnails)):
+            track = self.tracks_by_id[row[0]] = TrackRow(row)
+            track.artists = tuple(refs.setdefault(a, a) for a in track.artists) # one of each, not one per track
+            track.playlists = []
+        for track_id, artist_id in conn.execute("select track_id, artist_id from track_artist order by rowid"):
+            track, artist = self.tracks_by_id.get(track_id), self.artists_by_id.get(artist_id)
+            if track is not None and artist is not None:
+                artist.tracks.append(track)
+        for album_id, artist_id in conn.execute("select album_id, artist_id from album_artist order by rowid"):
+            album, artist = self.albums_by_id.get(album_id), self.artists_by_id.get(artist_id)
+            if album is not None and artist is not None:
+                artist.albums.append(album)
+
+        names = ('playlist_id', 'spotify_id', 'spotify_url', 'name', 'description')
+        self.playlists_by_id = playlists_by_id = {}
+        for row in conn.execute("select playlist_id, spotify_id, spotify_url, name, description, date, images from playlist"):
+            playlist = playlists_by_id[row[0]] = _fill(Playlist, row, names)
+            playlist.date = _date(row[5])
+            images = json.loads(row[6]) if row[6] else None
+            playlist.image_url = images[0]['url'] if images else None
+            playlist.tracks = []
+        for playlist_id, track_id in conn.execute("select playlist_id, track_id from playlist_track order by playlist_id, sequence"):
+            playlist, track = playlists_by_id.get(playlist_id), self.tracks_by_id.get(track_id)
+            if playlist is not None and track is not None:
+                playlist.tracks.append(track)
+                track.playlists.append(playlist)
+        self.playlists_by_date = {p.date: p for p in playlists_by_id.values() if p.date is not None}
+        # nulls last, as SQLite sorts them for order by date desc
+        self.tiles = tuple(sorted(playlists_by_id.values(), key=lambda p: (p.date is not None, p.date or date.min), reverse=True))
+
+        # everything is in place; from here on, nothing changes
+        for o in self.artists_by_id.values():
+            o.genres, o.tracks, o.albums = tuple(o.genres), tuple(o.tracks), tuple(o.albums)
+        for o in self.tracks_by_id.values():
+            o.playlists = tuple(o.playlists)
+        for o in playlists_by_id.values():
+            o.tracks = tuple(o.tracks)
+
+        self.artist_plays = dict((row[0], Plays(row[1], _date(row[2]), _date(row[3])))
+            for row in conn.execute("select artist_id, plays, first_played, last_played from artist_plays"))
+        self.plays_by_artist_id = dict((a, p.plays) for a, p in self.artist_plays.items())
+        self.genre_plays = dict((row[0], Plays(row[1], _date(row[2]), _date(row[3])))
+            for row in conn.execute("select genre_id, plays, first_played, last_played from genre_plays"))
+        self.genre_list = tuple((name, self.genre_plays[g.genre_id].plays if g.genre_id in self.genre_plays else None)
+                                for name, g in sorted(self.genres_by_name.items()))
+        # most played first; SQLite reads the plays index backwards for this, so ties go to the later artist_id
+        leaders = sorted(((a, p) for a, p in self.artist_plays.items() if a in self.artists_by_id), key=lambda ap: (-(ap[1].plays or 0), -ap[0]))
+        self.leaders = tuple(Leader(self.artists_by_id[a].spotify_id, self.artists_by_id[a].name, *p) for a, p in leaders)
+
+    def playlist_tiles(self):
+        return self.tiles
+
+    def playlist_by_date(self, playlist_date):
+        return self.playlists_by_date.get(playlist_date)
+
+    def playlist_tracks(self, playlist_id):
+        return self.playlists_by_id[playlist_id].tracks
+
+    def artist(self, spotify_id):
+        return self.artists_by_spotify_id.get(spotify_id)
+
+    def artist_tracks(self, artist_id):
+        return self.artists_by_id[artist_id].tracks
+
+    def artist_leaderboard(self, limit=LEADERBOARD_SIZE):
+        return self.leaders[:limit]
+
+    def genre(self, name):
+        genre = self.genres_by_name.get(name)
+        if genre is None:
+            return None
+        return genre, self.plays_by_artist_id, self.genre_plays.get(genre.genre_id)
+
+    def genres(self):
+        return self.genre_list
+
+    def track_rows(self, track_ids):
+        return dict((i, self.tracks_by_id[i]) for i in track_ids if i in self.tracks_by_id)
+
+    def similar_artists(self, vectors, artist_ids, k=SIMILAR_LIMIT):
+        similar = vectors.similar(artist_ids, k) if vectors is not None else {}
+        by_id = self.artists_by_id
+        return {a: [(by_id[i], score) for i, score in pairs if i in by_id] for a, pairs in similar.items()}
+
+    def similar_tracks(self, vectors, track_ids, k=SIMILAR_LIMIT):
+        similar = vectors.similar(track_ids, k) if vectors is not None else {}
+        by_id = self.tracks_by_id
+        return {t: [(by_id[i], score) for i, score in pairs if i in by_id] for t, pairs in similar.items()}
+
+    def more_like(self, vectors, track_ids, k=SIMILAR_LIMIT):
+        similar = vectors.like(track_ids, k) if vectors is not None else []
+        return [(self.tracks_by_id[i], score) for i, score in similar if i in self.tracks_by_id]
+
+    def played_alongside(self, cooccurring, artist_id, k=SIMILAR_LIMIT):
+        alongside = cooccurring.alongside(artist_id, k) if cooccurring is not None else []
+        return [(self.artists_by_id[a], together) for a, together, _ in alongside if a in self.artists_by_id]
+
+    def circle(self, cooccurring, artist_id, k=SIMILAR_LIMIT):
+        members = cooccurring.circle(artist_id, k) if cooccurring is not None else []
+        return [self.artists_by_id[a] for a in members if a in self.artists_by_id]
+
+def load(db_path):
+    """A Snapshot of `db_path`, read in one transaction so that it's all from one generation"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False)
+    try:
+        conn.execute("begin")
+        return Snapshot(conn)
+    finally:
+        conn.close()
+
+class Holder():
+    """The Snapshot for the database's current generation (per `watcher`, a
+    cache.GenerationWatcher). When the generation moves on, a new one is loaded in the
+    background; get() is None until it's ready, so callers should use the database instead."""
+
+    def __init__(self, db_path, watcher):
+        self.db_path = db_path
+        self.watcher = watcher
+        self._snapshot = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._load() # the first one we wait for
+
+    def get(self):
+        current = self.watcher.get()[0]
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation >= current: # the watcher may lag a little
+            return snapshot
+        with self._lock:
+            if not self._loading:
+                self._loading = True
+                threading.Thread(target=self._load, daemon=True).start()
+        return None
+
+    def _load(self):
+        try:
+            start = time.perf_counter()
+            self._snapshot = load(self.db_path)
+            print(f"loaded snapshot of generation {self._snapshot.generation} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        except sqlite3.Error as e:
+            print(f"couldn't load a snapshot: {e}", file=sys.stderr)
+        finally:
+            self._loading = False
+
+if __name__ == '__main__':
+    import tracemalloc
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', default='birdnest.db')
+    args = parser.parse_args()
+    tracemalloc.start()
+    start = time.perf_counter()
+    snapshot = load(args.db)
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    print(f"{len(snapshot.playlists_by_date):,} playlists, {len(snapshot.tracks_by_id):,} tracks, "
+          f"{len(snapshot.artists_by_id):,} artists, {len(snapshot.albums_by_id):,} albums, {len(snapshot.genres_by_name):,} genres")
+    print(f"loaded in {elapsed:.1f}s; {size / 1024 / 1024:.1f} MB ({peak / 1024 / 1024:.1f} MB at peak)")
+
+    import queries
+    import storage
+    from sqlalchemy.orm import sessionmaker
+    genre = max(snapshot.genres_by_name.values(), key=lambda g: len(g.artists)).name
+    artist = max(snapshot.artists_by_id.values(), key=lambda a: len(a.tracks)).spotify_id
+    def genre_page(read):
+        read('genre', genre)
+    def artist_page(read):
+        read('artist_tracks', read('artist', artist).artist_id)
+    engine = storage.web_engine(args.db)
+    for url, page in ((f"/genre/{genre}", genre_page), (f"/artist/{artist}", artist_page)):
+        session = sessionmaker(bind=engine)()
+        measured = []
+        for read in (lambda name, *a: getattr(queries, name)(session, *a), lambda name, *a: getattr(snapshot, name)(*a)):
+            tracemalloc.reset_peak()
+            size = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            page(read)
+            measured.append((time.perf_counter() - start, tracemalloc.get_traced_memory()[1] - size))
+        session.close()
+        (orm_time, orm_peak), (snapshot_time, snapshot_peak) = measured
+        print(f"{url}: {orm_peak / 1024 / 1024:.1f} MB at peak in {orm_time * 1000:.0f}ms through the ORM, "
+              f"{snapshot_peak / 1024 / 1024:.1f} MB in {snapshot_time * 1000:.0f}ms from the snapshot")
+    engine.dispose()
@@ -1,24 +1,177 @@
 """A modest wrapper for the spotipy client that deals with the paginated API"""
 
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import spotipy
+import urllib3
+from spotipy import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 
+import metrics
+from apicache import CacheMiss
+
+# statuses we retry ourselves, rather than letting urllib3 sleep inside a worker thread
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def http_session():
+    """A requests session for spotipy which still retries failed connections but hands
+    every response back as it is. spotipy's own retries cover 429 and 5xx (and anything with
+    a Retry-After) even with status_retries=0, and when they run out it reports a 429 without
+    the response's headers; this way the SpotifyException has the real status and Retry-After."""
+    retry = urllib3.Retry(total=3, connect=None, read=False, status=0, status_forcelist=(),
+                          respect_retry_after_header=False, backoff_factor=0.3,
+                          allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class TokenBucket():
+    """A thread-safe token bucket shared by all of a Client's workers. `acquire` blocks
+    until a request may be made. `pause` holds every worker back, e.g. when the API
+    has told us to wait with a `Retry-After` header."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
 class Client():
-    
+
     _allbirds = []
     _sp = None
 
-    def __init__(self, user='joegermuska',scopes=None):
+    def __init__(self, user='joegermuska',scopes=None,max_workers=1,requests_per_second=10,max_retries=5,cache=None):
+        """`max_workers` > 1 turns on concurrent fetching: batched lookups and paginated
+        results are requested in parallel, sharing one rate limiter of
+        `requests_per_second`. Results always come back in input order.
+
+        `cache` is an optional apicache.ResponseCache. If it is in replay-only mode, no
+        spotipy client is constructed at all, and anything not recorded raises CacheMiss."""
         self.user = user
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._limiter = TokenBucket(requests_per_second)
+        self.api_calls = 0
+        self._calls_lock = threading.Lock()
+        if cache is not None and cache.replay_only:
+            return
+        # we handle 429/5xx in _call so that Retry-After applies to all workers
         if scopes: # anonymous
-            self._sp = spotipy.Spotify(auth_manager=SpotifyOAuth(username=self.user,scope=scopes))
+            self._sp = spotipy.Spotify(auth_manager=SpotifyOAuth(username=self.user,scope=scopes),requests_session=http_session())
         else:
-            self._sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+            self._sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(),requests_session=http_session())
+
+    def _call(self, method, *args, **kwargs):
+        """Call a method of the spotipy client through the rate limiter, retrying
+        throttled and failed requests with jittered exponential backoff."""
+        if self._sp is None: # replay-only: whatever's asked for wasn't in the cache
+            raise CacheMiss(method, args)
+        for attempt in range(self.max_retries + 1):
+            self._limiter.acquire()
+            with self._calls_lock:
+                self.api_calls += 1
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                result = getattr(self._sp, method)(*args, **kwargs)
+                status = '200'
+                return result
+            except SpotifyException as e:
+                status = str(e.http_status)
+                if e.http_status not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                metrics.API_RETRIES.inc(method=method, status=status)
+                delay = 2 ** attempt * 0.5
+                try:
+                    delay = max(delay, float(e.headers['Retry-After']))
+                except (KeyError, TypeError, ValueError): pass
+                self._limiter.pause(delay + random.uniform(0, delay / 2))
+            finally:
+                metrics.API_CALLS.inc(method=method, status=status)
+                metrics.API_SECONDS.observe(time.perf_counter() - start, method=method)
+
+    def _map(self, fn, items):
+        items = list(items)
+        if self.max_workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+                return list(executor.map(fn, items))
+        return [fn(i) for i in items]
+
+    def _batched(self, method, ids, size, key=None):
+        """Look up `ids` in chunks of `size`, returning the flattened results in input order"""
+        ids = list(ids)
+        def fetch(chunk):
+            result = self._call(method, chunk)
+            return result[key] if key else result
+        chunks = [ids[i:i+size] for i in range(0, len(ids), size)]
+        return [x for result in self._map(fetch, chunks) for x in result]
+
+    def _cached(self, endpoint, ids, fetch):
+        """Look up objects by ID, first in the cache (if we have one), then with `fetch`
+        for whatever is missing. `fetch` must return results aligned with its input, as
+        the Spotify batch endpoints do."""
+        ids = list(ids)
+        if self.cache is None:
+            return fetch(ids)
+        found = self.cache.get_many(endpoint, ids)
+        missing = [i for i in dict.fromkeys(ids) if i not in found]
+        if missing:
+            if self.cache.replay_only:
+                raise CacheMiss(endpoint, missing)
+            fetched = [(k, v) for k, v in zip(missing, fetch(missing)) if v is not None]
+            self.cache.put_many(endpoint, fetched)
+            found.update(fetched)
+        return [found.get(i) for i in ids]
+
+    def _pages(self, first, fetch):
+        """Given the first page of a Spotify paging object, return every page in order.
+        In concurrent mode the remaining pages are requested in parallel with `fetch(offset)`;
+        otherwise we follow `next` links."""
+        pages = [first]
+        if first['next'] and self.max_workers > 1:
+            offsets = range(first['offset'] + first['limit'], first['total'], first['limit'])
+            pages.extend(self._map(fetch, offsets))
+        else:
+            while pages[-1]['next']:
+                pages.append(self._call('next', pages[-1]))
+        return pages
 
     def get_playlists(self,user=None):
         if user is None:
             user = self.user
-        return self._sp.user_playlists(user)
+        return self._call('user_playlists', user)
 
     def random_playlist(self):
         from random import choice
@@ -26,78 +179,71 @@ class Client():
 
     def allbirds(self,refresh=False):
         if refresh or len(self._allbirds) == 0:
-            playlists = self._sp.user_playlists(self.user)
-            while playlists:
-                for p in playlists['items']:
-                    if 'conference of the birds' in p['name'].lower() and 'jqbx' in p['name'].lower():
-                        self._allbirds.append(p)
-                if playlists['next']:
-                    playlists = self._sp.next(playlists)
-                else:
-                    playlists = None                  
+            self._allbirds = []
+            for p in self._user_playlists(self.user, refresh):
+                if 'conference of the birds' in p['name'].lower() and 'jqbx' in p['name'].lower():
+                    self._allbirds.append(p)
         return self._allbirds
 
-                  
-    def playlist_tracks(self, playlist_id, full=False):
+    def _user_playlists(self, user, refresh=False):
+        if self.cache is not None and (not refresh or self.cache.replay_only):
+            cached = self.cache.get('user_playlists', user)
+            if cached is not None:
+                return cached
+            if self.cache.replay_only:
+                raise CacheMiss('user_playlists', [user])
+        first = self._call('user_playlists', user)
+        pages = self._pages(first, lambda offset: self._call('user_playlists', user, offset=offset))
+        playlists = [p for page in pages for p in page['items']]
+        if self.cache is not None:
+            self.cache.put('user_playlists', user, playlists)
+        return playlists
+
+
+    def playlist_tracks(self, playlist_id, full=False, snapshot_id=None):
+        """The tracks in a playlist. Pass the `snapshot_id` you're after if you have it: the
+        cached tracks are then those of that version of the playlist, rather than of whatever
+        version was fetched within the last hour."""
+        key = f"{playlist_id}:{snapshot_id}" if snapshot_id else playlist_id
         the_tracks = []
-        tracks = self._sp.playlist_tracks(playlist_id)
-        while tracks:
-            for i in tracks['items']:
-                t = i['track']
-                if full:
-                    the_tracks.append(t)
-                else:
-                    the_tracks.append({
-                      # fill it in
-                      'artist': ', '.join([a['name'] for a in t['artists']]),
-                      'title': t['name'],
-                      'album': t['album']['name'],
-                      'url': t['external_urls']['spotify']
-                    })
-            if tracks['next']:
-                tracks = self._sp.next(tracks)
+        for t in self._cached('playlist_tracks', [key], lambda _: [self._playlist_items(playlist_id)])[0]:
+            if full:
+                the_tracks.append(t)
             else:
-                tracks = None
-        return the_tracks       
+                the_tracks.append({
+                  # fill it in
+                  'artist': ', '.join([a['name'] for a in t['artists']]),
+                  'title': t['name'],
+                  'album': t['album']['name'],
+                  'url': t['external_urls']['spotify']
+                })
+        return the_tracks
+
+    def playlists_tracks(self, playlist_ids, full=False, snapshot_ids=None):
+        """playlist_tracks for several playlists at once, fetched concurrently in concurrent mode"""
+        snapshot_ids = snapshot_ids or [None] * len(playlist_ids)
+        return self._map(lambda p: self.playlist_tracks(p[0], full, p[1]), zip(playlist_ids, snapshot_ids))
+
+    def _playlist_items(self, playlist_id):
+        first = self._call('playlist_tracks', playlist_id)
+        pages = self._pages(first, lambda offset: self._call('playlist_tracks', playlist_id, offset=offset))
+        return [i['track'] for tracks in pages for i in tracks['items']]
 
     def artist(self, artist_id):
-        return self._sp.artist(artist_id)
+        return self._cached('artist', [artist_id], lambda ids: [self._call('artist', ids[0])])[0]
 
     def artists(self, artist_ids):
         # max of 50
-        artists = []
-        ids = list(artist_ids)
-        while len(ids) > 0:
-            result = self._sp.artists(ids[:50])
-            artists.extend(result['artists'])
-            ids = ids[50:]
-        return artists
+        return self._cached('artist', artist_ids, lambda ids: self._batched('artists', ids, 50, 'artists'))
 
     def tracks(self, track_ids):
         # max of 50
-        tracks = []
-        ids = list(track_ids)
-        while len(ids) > 0:
-            result = self._sp.tracks(ids[:50])
-            tracks.extend(result['tracks'])
-            ids = ids[50:]
-        return tracks
+        return self._cached('track', track_ids, lambda ids: self._batched('tracks', ids, 50, 'tracks'))
 
     def albums(self, album_ids):
         # max of 20
-        albums = []
-        ids = list(album_ids)
-        while len(ids) > 0:
-            result = self._sp.albums(ids[:20])
-            albums.extend(result['albums'])
-            ids = ids[20:]
-        return albums
+        return self._cached('album', album_ids, lambda ids: self._batched('albums', ids, 20, 'albums'))
 
     def audio_features(self, track_ids):
         # max 100
-        features = []
-        ids = list(track_ids)
-        while len(ids) > 0:
-            features.extend(self._sp.audio_features(ids[:100]))
-            ids = ids[100:]
-        return features
+        return self._cached('audio_features', track_ids, lambda ids: self._batched('audio_features', ids, 100))
@@ -0,0 +1,96 @@
+"""How we open birdnest.db. There are two roles:
+
+* `web`: the Flask app's workers. Read-only (`mode=ro`) connections from a fixed-size
+  pool, so a worker can never take a write lock, with a big mmap so that hot pages are
+  shared between connections through the OS page cache.
+* `ingest`: load_playlist.py, backfill.py and friends. A single writer connection.
+
+The database is put in WAL mode (which sticks to the file), so readers carry on with the
+last committed data while an ingest is writing, rather than waiting for it. After an
+ingest, finish_ingest() checkpoints the WAL and lets SQLite update its statistics.
+
+Any pragma can be overridden per deployment with an environment variable, e.g.
+BIRDNEST_SQLITE_MMAP_SIZE=0 or BIRDNEST_SQLITE_CACHE_SIZE=-2000. BIRDNEST_DB_POOL_SIZE
+sets the number of web connections per process.
+"""
+
+import os
+import sqlite3
+
+import metrics
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+MB = 1024 * 1024
+
+# applied, in order, to every new connection. A negative cache_size is in KiB.
+PROFILES = {
+    'web': {
+        'query_only': 'ON',
+        'mmap_size': 256 * MB,
+        'cache_size': -8 * 1024, # per connection; mmap does most of the work
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        # no synchronous: readers never write
+    },
+    'ingest': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL', # in WAL mode, only the last commit can be lost, and only to power failure
+        'mmap_size': 256 * MB,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+    },
+}
+
+DEFAULT_POOL_SIZE = 8
+
+def pragmas(role):
+    """The pragmas for `role`, with any BIRDNEST_SQLITE_* overrides from the environment"""
+    settings = dict(PROFILES[role])
+    for name in settings:
+        override = os.environ.get(f"BIRDNEST_SQLITE_{name.upper()}")
+        if override is not None:
+            settings[name] = override
+    return settings
+
+def _apply_on_connect(engine, role):
+    metrics.instrument_engine(engine, role)
+    settings = pragmas(role)
+    @event.listens_for(engine, 'connect')
+    def apply(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f"pragma {name} = {value}")
+        cursor.close()
+    return engine
+
+def web_engine(sqlite_filepath='birdnest.db', pool_size=None):
+    """An engine for serving: a pool of `pool_size` read-only connections, shared by threads"""
+    if pool_size is None:
+        pool_size = int(os.environ.get('BIRDNEST_DB_POOL_SIZE', DEFAULT_POOL_SIZE))
+    uri = f"file:{sqlite_filepath}?mode=ro"
+    engine = create_engine('sqlite://',
+        creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+        poolclass=QueuePool, pool_size=pool_size, max_overflow=0)
+    return _apply_on_connect(engine, 'web')
+
+def ingest_engine(sqlite_filepath='birdnest.db'):
+    """An engine for loading data, which holds one writer connection. A second checkout
+    waits for the first to be returned, rather than contending for SQLite's write lock."""
+    engine = create_engine(f"sqlite:///{sqlite_filepath}",
+        poolclass=QueuePool, pool_size=1, max_overflow=0)
+    return _apply_on_connect(engine, 'ingest')
+
+def finish_ingest(session):
+    """Run after an ingest commits: fold the WAL back into the database (waiting for any
+    readers still using it) and truncate it, then let SQLite re-analyze whatever tables
+    have changed enough for it to matter. The ingest's `session` is closed first, to give
+    back the writer connection. Returns the checkpoint's (busy, log, checkpointed)."""
+    engine = session.get_bind()
+    session.close()
+    with engine.connect() as conn:
+        result = tuple(conn.execute("pragma wal_checkpoint(TRUNCATE)").first())
+        conn.execute("pragma optimize")
+    return result
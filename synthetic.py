@@ -0,0 +1,219 @@
+"""Made-up Spotify data, for benchmarking and trying things out without an API account or
+the real birdnest.db. Everything is a function of the seed, so two runs at the same scale
+produce the same playlists, track for track.
+
+    data = synthetic.SyntheticData(playlists=500)
+    client = synthetic.StubClient(data)
+    db = models.Database('synthetic.db', api_client=client)
+    db.insert_playlists_from_json(session, client.allbirds())
+
+Like the real thing, plays are dominated by a few artists: artists (and genres) are drawn
+from a Zipf distribution, so big names recur across playlists, and their tracks with them,
+while there's a long tail of artists played once. The catalog is only notional; artists,
+albums and tracks are made when a playlist first uses them.
+"""
+
+import hashlib
+import random
+from datetime import date, timedelta
+from itertools import accumulate
+
+WORDS = """the a of in on and to my your you me we love night day time light dark blue
+red black white gold silver green sun moon star stars sky rain fire water river sea ocean
+wind storm cloud summer winter spring fall heart soul mind dream dreams song songs dance
+city street road home house room window door garden forest mountain valley desert island
+bird birds wolf tiger horse dog cat ghost angel devil king queen girl boy man woman child
+lover friend stranger song electric cosmic golden crystal velvet paper glass stone iron
+wild quiet loud slow fast lost found broken hidden secret sweet bitter cold warm high low
+new old young last first only little big long deep bright soft hard free true morning
+evening midnight tomorrow yesterday forever never always again away back down up over
+under between through beyond echo signal machine radio satellite rocket garden temple
+shadow mirror memory silence thunder lightning paradise heaven hell fever honey sugar
+diamond pearl rose lily violet ivory orchid tropical jungle safari mambo samba bossa funk
+soul disco boogie groove rhythm blues jazz ritual spirit mystic magic voodoo psychedelic
+orchestra quartet trio band club society collective sound sounds system experience
+""".split()
+
+GENRE_WORDS = """afro brazilian cosmic deep jazz soul funk disco psych latin tropical
+ambient minimal spiritual library ethio italo french japanese kraut dub reggae highlife
+balearic boogie fusion modal free exotica lounge folk baroque chamber dream garage surf
+""".split()
+GENRE_ROOTS = """jazz funk soul pop rock disco house techno folk psychedelia rap electronica
+""".split()
+
+def zipf_weights(n, s=1.0):
+    """Cumulative weights for choosing from `n` things by Zipf's law, most popular first"""
+    return list(accumulate(1 / (rank + 1) ** s for rank in range(n)))
+
+def spotify_id(seed, kind, key):
+    """A stable fake 22-character Spotify ID"""
+    return hashlib.md5(f"{seed}:{kind}:{key}".encode('utf-8')).hexdigest()[:22]
+
+def images(kind, key, sizes=(640, 300, 64)):
+    return [{'url': f"https://i.scdn.co/image/{kind}-{key}-{w}", 'width': w, 'height': w} for w in sizes]
+
+class SyntheticData():
+    """Playlists, tracks, artists and albums shaped like the Spotify API's JSON. `playlists`
+    is how many playlists to make, one a day; the catalog grows with it."""
+
+    def __init__(self, playlists=10, seed=0, tracks_per_playlist=(25, 45), start=date(2020, 1, 4)):
+        self.seed = seed
+        self.n_artists = 50 + playlists * 8
+        self.n_genres = min(1500, 40 + playlists // 2)
+        self._artist_weights = zipf_weights(self.n_artists, 0.9)
+        self._genre_weights = zipf_weights(self.n_genres, 1.2)
+        self.artists = {} # spotify_id -> full ArtistObject
+        self.albums = {} # spotify_id -> full AlbumObject
+        self.tracks = {} # spotify_id -> full TrackObject
+        self._artist_keys = {} # artist index -> spotify_id
+        self.playlists = []
+        self.playlist_tracks = {}
+
+        r = random.Random(f"{seed}:playlists")
+        for i in range(playlists):
+            day = start + timedelta(days=i)
+            playlist = {
+                'id': spotify_id(seed, 'playlist', i),
+                'name': f"JQBX :: Conference of the Birds {day.isoformat()}",
+                'description': f"What we played on {day:%B} {day.day}, {day.year}",
+                'external_urls': {'spotify': f"https://open.spotify.com/playlist/{spotify_id(seed, 'playlist', i)}"},
+                'images': images('playlist', i, sizes=(None,)),
+                'snapshot_id': spotify_id(seed, 'snapshot', i),
+                'type': 'playlist',
+            }
+            tracks = []
+            for _ in range(r.randint(*tracks_per_playlist)):
+                tracks.append(self._pick_track(r))
+            if r.random() < 0.05:
+                tracks.append(None) # the API's answer for a local file, or a deleted track
+            self.playlists.append(playlist)
+            self.playlist_tracks[playlist['id']] = tracks
+
+    def _words(self, r, lo, hi):
+        return ' '.join(r.choices(WORDS, cum_weights=_WORD_WEIGHTS, k=r.randint(lo, hi))).title()
+
+    def _artist(self, index):
+        if index in self._artist_keys:
+            return self.artists[self._artist_keys[index]]
+        r = random.Random(f"{self.seed}:artist:{index}")
+        artist_id = spotify_id(self.seed, 'artist', index)
+        genres = set()
+        for _ in range(r.choice([0, 1, 1, 2, 2, 3, 4, 5])):
+            genres.add(self._genre(r.choices(range(self.n_genres), cum_weights=self._genre_weights)[0]))
+        artist = {
+            'id': artist_id,
+            'name': self._words(r, 1, 3),
+            'type': 'artist',
+            'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"},
+            'popularity': max(0, min(100, int(r.gauss(70 - index * 60 / self.n_artists, 10)))),
+            'followers': {'href': None, 'total': int(r.paretovariate(1.2) * 1000)},
+            'genres': sorted(genres),
+            'images': images('artist', artist_id),
+            'albums': r.randint(1, 6), # how many; not part of the API's ArtistObject
+        }
+        self._artist_keys[index] = artist_id
+        self.artists[artist_id] = artist
+        return artist
+
+    def _genre(self, index):
+        r = random.Random(f"{self.seed}:genre:{index}")
+        return f"{' '.join(r.sample(GENRE_WORDS, r.randint(1, 2)))} {r.choice(GENRE_ROOTS)}"
+
+    def _album(self, artist, index):
+        album_id = spotify_id(self.seed, 'album', f"{artist['id']}:{index}")
+        if album_id in self.albums:
+            return self.albums[album_id]
+        r = random.Random(f"{self.seed}:album:{album_id}")
+        album = {
+            'id': album_id,
+            'name': self._words(r, 1, 4),
+            'type': 'album',
+            'album_type': r.choice(['album', 'album', 'single', 'compilation']),
+            'artists': [simplified(artist)],
+            'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id}"},
+            'images': images('album', album_id),
+            'release_date': f"{r.randint(1955, 2023)}-{r.randint(1, 12):02}-{r.randint(1, 28):02}",
+            'total_tracks': r.randint(4, 14),
+            'label': f"{self._words(r, 1, 2)} Records",
+            'popularity': r.randint(0, 80),
+        }
+        self.albums[album_id] = album
+        return album
+
+    def _track(self, artist, album, index):
+        track_id = spotify_id(self.seed, 'track', f"{album['id']}:{index}")
+        if track_id in self.tracks:
+            return self.tracks[track_id]
+        r = random.Random(f"{self.seed}:track:{track_id}")
+        artists = [simplified(artist)]
+        if r.random() < 0.15: # featuring someone
+            guest = self._artist(r.choices(range(self.n_artists), cum_weights=self._artist_weights)[0])
+            if guest['id'] != artist['id']:
+                artists.append(simplified(guest))
+        track = {
+            'id': track_id,
+            'name': self._words(r, 1, 5),
+            'type': 'track',
+            'artists': artists,
+            'album': {k: v for k, v in album.items() if k not in ('label', 'popularity')},
+            'duration_ms': int(r.lognormvariate(12.4, 0.35)),
+            'explicit': r.random() < 0.05,
+            'popularity': max(0, min(100, album['popularity'] + r.randint(-10, 10))),
+            'external_ids': {'isrc': f"US{track_id[:10].upper()}"},
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+            'preview_url': f"https://p.scdn.co/mp3-preview/{track_id}" if r.random() < 0.7 else None,
+            'track_number': index + 1,
+        }
+        self.tracks[track_id] = track
+        return track
+
+    def _pick_track(self, r):
+        artist = self._artist(r.choices(range(self.n_artists), cum_weights=self._artist_weights)[0])
+        album = self._album(artist, r.randrange(artist['albums']))
+        return self._track(artist, album, r.randrange(album['total_tracks']))
+
+def simplified(artist):
+    return {k: artist[k] for k in ('id', 'name', 'type', 'external_urls')}
+
+_WORD_WEIGHTS = zipf_weights(len(WORDS), 0.8)
+
+class StubClient():
+    """Stands in for spotclient.Client, answering from SyntheticData. It only has the
+    methods ingest uses. `api_calls` counts the requests the real client would have made."""
+
+    def __init__(self, data):
+        self.data = data
+        self.api_calls = 0
+
+    def _lookup(self, objects, ids, batch_size):
+        ids = list(ids)
+        self.api_calls += (len(ids) + batch_size - 1) // batch_size
+        return [objects.get(i) for i in ids]
+
+    def allbirds(self, refresh=False):
+        self.api_calls += (len(self.data.playlists) + 49) // 50
+        return list(reversed(self.data.playlists)) # newest first, as on Spotify
+
+    def playlist_tracks(self, playlist_id, full=False, snapshot_id=None):
+        tracks = self.data.playlist_tracks[playlist_id]
+        self.api_calls += (len(tracks) + 99) // 100
+        return list(tracks)
+
+    def playlists_tracks(self, playlist_ids, full=False, snapshot_ids=None):
+        return [self.playlist_tracks(p, full) for p in playlist_ids]
+
+    def artists(self, artist_ids):
+        return [a and {k: v for k, v in a.items() if k != 'albums'}
+                for a in self._lookup(self.data.artists, artist_ids, 50)]
+
+    def artist(self, artist_id):
+        return self.artists([artist_id])[0]
+
+    def albums(self, album_ids):
+        return self._lookup(self.data.albums, album_ids, 20)
+
+    def tracks(self, track_ids):
+        return self._lookup(self.data.tracks, track_ids, 50)
+
+    def audio_features(self, track_ids):
+        return self._lookup({}, track_ids, 100)
@@ -0,0 +1,36 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import storage
+import synthetic
+
+PLAYLISTS = 20
+
+@pytest.fixture(scope='session')
+def synthetic_data():
+    return synthetic.SyntheticData(playlists=PLAYLISTS)
+
+@pytest.fixture(scope='session')
+def synthetic_db_template(synthetic_data, tmp_path_factory):
+    """A small database ingested from synthetic.py, made once per run"""
+    db_path = str(tmp_path_factory.mktemp('synthetic') / 'birdnest.db')
+    client = synthetic.StubClient(synthetic_data)
+    db = models.Database(db_path, api_client=client)
+    session = models.get_session(db_path, create_all=True)
+    db.insert_playlists_from_json(session, list(reversed(client.allbirds())))
+    session.commit()
+    storage.finish_ingest(session)
+    return db_path
+
+@pytest.fixture
+def synthetic_db(synthetic_db_template, tmp_path):
+    """A copy of the synthetic database, for a test to change as it likes"""
+    db_path = str(tmp_path / 'birdnest.db')
+    shutil.copy(synthetic_db_template, db_path)
+    return db_path
@@ -0,0 +1,23 @@
+from cache import RenderCache
+
+def test_disk_tier_keeps_newer_generations(tmp_path):
+    ahead, behind = RenderCache(disk_dir=str(tmp_path)), RenderCache(disk_dir=str(tmp_path))
+    ahead.get(2, 'page')
+    ahead.put(2, 'page', b'new')
+    # a worker still on the last generation doesn't clear out the newer page
+    assert behind.get(1, 'page') is None
+    behind.put(1, 'page', b'old')
+    assert len(list(tmp_path.iterdir())) == 2
+    assert RenderCache(disk_dir=str(tmp_path)).get(2, 'page').body == b'new'
+
+    # but moving on to a newer generation clears out older ones
+    ahead.get(3, 'page')
+    assert list(tmp_path.iterdir()) == []
+
+def test_disk_tier_is_capped(tmp_path):
+    pages = RenderCache(max_entries=10, disk_dir=str(tmp_path), max_disk_entries=3)
+    pages.get(1, 'page')
+    for n in range(5):
+        pages.put(1, f"page {n}", b'body')
+    assert len(list(tmp_path.iterdir())) == 3
+    assert pages.get(1, 'page 4').body == b'body' # still in memory
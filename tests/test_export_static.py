@@ -0,0 +1,80 @@
+import sqlite3
+
+from sqlalchemy import bindparam, text
+
+import export_static
+import indexfiles
+import cooccurrence
+import membership
+import models
+import similarity
+
+def fingerprints(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return export_static.fingerprints(conn, 'code', db_path)
+    finally:
+        conn.close()
+
+def share_tracks(session):
+    """Give the newest playlist the first one's tracks as well; returns the first one's date"""
+    (first, first_date), (last, _) = session.execute(text("""select playlist_id, date from playlist
+        where playlist_id in ((select min(playlist_id) from playlist), (select max(playlist_id) from playlist))
+        order by playlist_id""")).fetchall()
+    session.execute(text("""insert into playlist_track (playlist_id, track_id, sequence)
+        select :last, track_id, 1000 + sequence from playlist_track where playlist_id = :first
+        and track_id not in (select track_id from playlist_track where playlist_id = :last)"""),
+        {'first': first, 'last': last})
+    session.execute(text("update playlist set snapshot_id = 'edited' where playlist_id = :last"), {'last': last})
+    session.commit()
+    return first_date
+
+def test_repeats_change_fingerprints(synthetic_db):
+    session = models.get_session(synthetic_db, create_all=False)
+    membership.update_after_ingest(session, synthetic_db)
+    before = fingerprints(synthetic_db)
+    # the first playlist's Repeats section changes, though nothing else about it does
+    first_date = share_tracks(session)
+    membership.update_after_ingest(session, synthetic_db)
+    after = fingerprints(synthetic_db)
+    session.close()
+
+    assert after.keys() == before.keys()
+    changed = set(url for url in after if after[url] != before[url])
+    assert f"/playlist/{first_date}" in changed
+    assert not any(url.startswith('/genre/') for url in changed)
+
+def test_cooccurrence_changes_fingerprints(synthetic_db):
+    session = models.get_session(synthetic_db, create_all=False)
+    cooccurrence.update_after_ingest(session, synthetic_db)
+    before = fingerprints(synthetic_db)
+    # artists who were only in the first playlist are now played alongside the newest one's
+    share_tracks(session)
+    cooccurrence.update_after_ingest(session, synthetic_db)
+    after = fingerprints(synthetic_db)
+    session.close()
+
+    changed = set(url for url in after if after[url] != before[url])
+    assert any(url.startswith('/artist/') for url in changed)
+
+def test_similarity_changes_fingerprints(synthetic_db):
+    session = models.get_session(synthetic_db, create_all=False)
+    similarity.update_after_ingest(session, synthetic_db)
+    artist_id, spotify_id = session.execute(text("""select a.artist_id, a.spotify_id from artist a
+        join artist_genre ag on ag.artist_id = a.artist_id group by a.artist_id
+        order by count(*) desc, a.artist_id limit 1""")).first()
+    vectors = similarity.load(indexfiles.current_version(similarity.index_dir(synthetic_db)))['artists']
+    similar = set(i for i, _ in vectors.similar([artist_id])[artist_id])
+    other = session.execute(text("select artist_id from artist where artist_id != :a and artist_id not in :similar limit 1"
+        ).bindparams(bindparam('similar', expanding=True)), {'a': artist_id, 'similar': list(similar)}).scalar()
+    before = fingerprints(synthetic_db)
+    # another artist now has all the same genres, so it's now among the most similar
+    session.execute(text("delete from artist_genre where artist_id = :other"), {'other': other})
+    session.execute(text("""insert into artist_genre (artist_id, genre_id)
+        select :other, genre_id from artist_genre where artist_id = :a"""), {'a': artist_id, 'other': other})
+    session.commit()
+    similarity.update_after_ingest(session, synthetic_db)
+    after = fingerprints(synthetic_db)
+    session.close()
+
+    assert after[f"/artist/{spotify_id}"] != before[f"/artist/{spotify_id}"]
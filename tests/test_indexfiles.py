@@ -0,0 +1,22 @@
+import pytest
+from sqlalchemy import text
+
+import cooccurrence
+import indexfiles
+import membership
+import models
+import similarity
+
+@pytest.mark.parametrize('index', [similarity, cooccurrence, membership])
+def test_rerun_writes_nothing(synthetic_db, index):
+    session = models.get_session(synthetic_db, create_all=False)
+    path = index.index_dir(synthetic_db)
+    index.update_after_ingest(session, synthetic_db)
+    version = indexfiles.current_version(path)
+    generation = session.execute(text("select value from generation")).scalar()
+
+    result = index.update_after_ingest(session, synthetic_db)
+    assert not any(changed for _, changed in result.values())
+    assert indexfiles.current_version(path) == version
+    assert session.execute(text("select value from generation")).scalar() == generation
+    session.close()
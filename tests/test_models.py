@@ -0,0 +1,26 @@
+from sqlalchemy import text
+
+import models
+
+def artists_in_order(session, table, key, spotify_id):
+    return [row[0] for row in session.execute(text(f"""select a.spotify_id from {table} x
+        join {key.split('_')[0]} o on o.{key} = x.{key} join artist a on a.artist_id = x.artist_id
+        where o.spotify_id = :id order by x.rowid"""), {'id': spotify_id})]
+
+def test_artists_in_credit_order(synthetic_db_template, synthetic_data):
+    session = models.get_session(synthetic_db_template, create_all=False)
+    tracks = [t for t in synthetic_data.tracks.values() if len(t['artists']) > 1]
+    assert tracks
+    for t in tracks:
+        assert artists_in_order(session, 'track_artist', 'track_id', t['id']) == [a['id'] for a in t['artists']]
+    session.close()
+
+def test_insert_missing_pairs_keeps_order(synthetic_db):
+    session = models.get_session(synthetic_db, create_all=False)
+    session.execute(text("delete from album_artist"))
+    assert models.insert_missing_pairs(session, 'album_artist', 'album_id', 'artist_id', [(1, 7), (2, 1)]) == 2
+    added = models.insert_missing_pairs(session, 'album_artist', 'album_id', 'artist_id',
+                                        dict.fromkeys([(1, 9), (1, 7), (1, 3), (1, 9), (1, 5)]))
+    assert added == 3
+    assert [row[0] for row in session.execute(text("select artist_id from album_artist where album_id = 1 order by rowid"))] == [7, 9, 3, 5]
+    session.close()
@@ -0,0 +1,85 @@
+"""Each view renders in a fixed number of queries, however many tracks, artists or
+playlists are on the page; none of them issues a query per row."""
+
+import importlib
+import shutil
+import sys
+
+import pytest
+from sqlalchemy import event, text
+
+import cooccurrence
+import membership
+import metrics
+import models
+import similarity
+
+@pytest.fixture(scope='module')
+def web(synthetic_db_template, tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp('web') / 'birdnest.db')
+    shutil.copy(synthetic_db_template, db_path)
+    session = models.get_session(db_path, create_all=False)
+    for index in (similarity, cooccurrence, membership):
+        index.update_after_ingest(session, db_path)
+    urls = {
+        'playlist': session.execute(text("""select date from playlist p
+            order by (select count(*) from playlist_track pt where pt.playlist_id = p.playlist_id) desc limit 1""")).scalar(),
+        'artist': session.execute(text("""select a.spotify_id from artist a join track_artist ta on ta.artist_id = a.artist_id
+            group by a.artist_id order by count(*) desc limit 1""")).scalar(),
+        'genre': session.execute(text("""select g.name from genre g join artist_genre ag on ag.genre_id = g.genre_id
+            group by g.genre_id order by count(*) desc limit 1""")).scalar(),
+        'word': session.execute(text("select name from track limit 1")).scalar().split()[0],
+    }
+    session.close()
+
+    with pytest.MonkeyPatch.context() as mp: # app opens BIRDNEST_DB as it's imported
+        mp.setenv('BIRDNEST_DB', db_path)
+        web_app = importlib.reload(sys.modules['app']) if 'app' in sys.modules else importlib.import_module('app')
+    queries = []
+    def count(conn, cursor, statement, *args):
+        if 'from generation' not in statement.lower(): # GenerationWatcher's, at most once a second
+            queries.append(statement)
+    event.listen(web_app.engine, 'before_cursor_execute', count)
+
+    def get(url): # each url once, so it's never already in the page cache
+        queries.clear()
+        response = web_app.app.test_client().get(url)
+        assert response.status_code == 200, url
+        response.get_data()
+        return len(queries)
+    get.urls = urls
+    get.app = web_app.app
+    yield get
+    web_app.engine.dispose()
+
+ROUTES = [
+    ('/', 1),
+    ('/genres', 1),
+    ('/artists', 1),
+    ('/playlist/{playlist}', 5),
+    ('/playlist/{playlist}.json', 2),
+    ('/artist/{artist}', 7),
+    ('/genre/{genre}', 5),
+    ('/search?q={word}', 4),
+    ('/search/suggest?q={word}', 1),
+    ('/export/tracks.ndjson', 1),
+    ('/similar/artists.json?id={artist}', 2),
+]
+
+@pytest.mark.parametrize('route,limit', ROUTES)
+def test_queries_per_view(web, route, limit):
+    assert web(route.format(**web.urls)) <= limit
+
+def test_pages_cached_by_the_args_they_read(web):
+    assert web('/genres?x=1') == 0 # already rendered as /genres
+    assert web('/search?q={word}&x=1'.format(**web.urls)) == 0
+    assert web('/search?q={word}&after=1:1'.format(**web.urls)) > 0
+
+def test_streamed_queries_count_towards_the_request(web):
+    def statements():
+        return sum(total for name, labels, _, total, _ in metrics.REGISTRY.snapshot()['histograms']
+                   if name == 'birdnest_request_sql_statements' and ['route', '/export/tracks.ndjson'] in map(list, labels))
+    before = statements()
+    with web.app.test_client().get('/export/tracks.ndjson') as response:
+        assert response.get_data()
+    assert statements() > before
@@ -0,0 +1,34 @@
+import random
+
+import numpy as np
+from sqlalchemy import text
+
+import indexfiles
+import models
+import similarity
+
+def test_update_on_synthetic_data(synthetic_db, tmp_path):
+    session = models.get_session(synthetic_db, create_all=False)
+    artists = session.execute(text("select count(*) from artist")).scalar()
+    assert artists % len(similarity.FEATURES) # the case which used to fail reshaping popularity
+    r = random.Random(0)
+    track_ids = [row[0] for row in session.execute(text("select distinct track_id from playlist_track"))]
+    for track_id in track_ids[::3]:
+        session.execute(text(f"""insert into audio_features (track_id, {', '.join(similarity.FEATURES)})
+            values (:track_id, {', '.join(':' + f for f in similarity.FEATURES)})"""),
+            dict(track_id=track_id, **{f: r.random() for f in similarity.FEATURES}))
+    session.commit()
+
+    path = str(tmp_path / 'similarity')
+    result = similarity.update(session, path, generation=1)
+    assert result['artists'] == (artists, artists)
+    assert result['tracks'] == (len(track_ids), len(track_ids))
+
+    index = similarity.load(indexfiles.current_version(path))
+    assert np.isfinite(index['tracks'].matrix).all()
+    assert np.isfinite(index['artists'].matrix).all()
+    assert index['tracks'].similar([track_ids[0]], k=5)
+
+    # nothing has changed, so an update recomputes nothing
+    assert similarity.update(session, path, generation=2) == {'tracks': (len(track_ids), 0), 'artists': (artists, 0)}
+    session.close()
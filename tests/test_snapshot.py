@@ -0,0 +1,32 @@
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import models
+import queries
+import snapshot
+import storage
+
+def test_genres_in_the_same_order_as_the_orm(synthetic_db):
+    session = models.get_session(synthetic_db, create_all=False)
+    # rowids in no particular order, as merged genres and re-ingested artists leave them
+    pairs = session.execute(text("select artist_id, genre_id from artist_genre order by random()")).fetchall()
+    session.execute(text("delete from artist_genre"))
+    session.execute(text("insert into artist_genre (artist_id, genre_id) values (:a, :g)"),
+                    [{'a': a, 'g': g} for a, g in pairs])
+    # and an artist Spotify gave no popularity
+    session.execute(text("update artist set popularity = null where artist_id = :a"), {'a': pairs[0][0]})
+    session.commit()
+    storage.finish_ingest(session)
+
+    snap = snapshot.load(synthetic_db)
+    engine = storage.web_engine(synthetic_db)
+    session = sessionmaker(bind=engine)()
+    names = [name for (name,) in session.execute(text("""select g.name from genre g
+        join artist_genre ag on ag.genre_id = g.genre_id group by g.genre_id having count(*) > 1"""))]
+    assert names
+    for name in names:
+        orm, snapped = queries.genre(session, name)[0], snap.genre(name)[0]
+        assert [a.spotify_id for a in orm.artists] == [a.spotify_id for a in snapped.artists]
+        assert [list(a.genres) for a in orm.artists] == [list(a.genres) for a in snapped.artists]
+    session.close()
+    engine.dispose()
@@ -0,0 +1,107 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from spotipy import SpotifyException
+
+import apicache
+import spotclient
+
+class Server():
+    """A local stand-in for the API, answering each request with the next of `responses`,
+    (status, headers, body) tuples"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                status, headers, body = server.responses.pop(0)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args): pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def prefix(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}/"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+ERROR = {'error': {'status': 429, 'message': 'API rate limit exceeded'}}
+
+def client(monkeypatch, server, max_retries):
+    monkeypatch.setenv('SPOTIPY_CLIENT_ID', 'id')
+    monkeypatch.setenv('SPOTIPY_CLIENT_SECRET', 'secret')
+    c = spotclient.Client(max_retries=max_retries)
+    c._sp.prefix = server.prefix
+    c._sp._auth = 'token' # rather than asking Spotify for one
+    return c
+
+@pytest.fixture
+def server():
+    servers = []
+    def start(*responses):
+        servers.append(Server(responses))
+        return servers[-1]
+    yield start
+    for s in servers:
+        s.close()
+
+def test_throttled_request_keeps_retry_after(monkeypatch, server):
+    api = server((429, {'Retry-After': '7'}, ERROR))
+    with pytest.raises(SpotifyException) as e:
+        client(monkeypatch, api, max_retries=0)._call('track', 'abc')
+    assert e.value.http_status == 429
+    assert e.value.headers['Retry-After'] == '7'
+    assert api.requests == 1 # urllib3 didn't retry it behind our back
+
+def test_server_error_keeps_its_status(monkeypatch, server):
+    api = server((503, {'Retry-After': '1'}, ERROR))
+    with pytest.raises(SpotifyException) as e:
+        client(monkeypatch, api, max_retries=0)._call('track', 'abc')
+    assert e.value.http_status == 503
+    assert api.requests == 1
+
+def test_retry_waits_for_retry_after(monkeypatch, server):
+    api = server((429, {'Retry-After': '7'}, ERROR), (200, {}, {'id': 'abc'}))
+    c = client(monkeypatch, api, max_retries=1)
+    pauses = []
+    monkeypatch.setattr(c._limiter, 'pause', pauses.append)
+    assert c._call('track', 'abc') == {'id': 'abc'}
+    assert api.requests == 2
+    assert len(pauses) == 1 and pauses[0] >= 7
+
+def page(*track_ids):
+    return {'items': [{'track': {'id': t}} for t in track_ids], 'next': None,
+            'offset': 0, 'limit': 100, 'total': len(track_ids)}
+
+def test_playlist_tracks_cached_by_snapshot(monkeypatch, server, tmp_path):
+    api = server((200, {}, page('a', 'b')), (200, {}, page('a', 'c')))
+    c = client(monkeypatch, api, max_retries=0)
+    c.cache = apicache.ResponseCache(str(tmp_path / 'cache.db'))
+    assert c.playlists_tracks(['p'], full=True, snapshot_ids=['1']) == [[{'id': 'a'}, {'id': 'b'}]]
+    # edited since: a new snapshot_id, so not the tracks cached a moment ago
+    assert c.playlists_tracks(['p'], full=True, snapshot_ids=['2']) == [[{'id': 'a'}, {'id': 'c'}]]
+    assert c.playlist_tracks('p', full=True, snapshot_id='1') == [{'id': 'a'}, {'id': 'b'}]
+    assert api.requests == 2
+
+def test_replay_only_raises_cache_miss_for_uncached_calls(tmp_path):
+    c = spotclient.Client(cache=apicache.ResponseCache(str(tmp_path / 'cache.db'), replay_only=True))
+    with pytest.raises(apicache.CacheMiss):
+        c.get_playlists()
@@ -0,0 +1,65 @@
+"""Flat rows for the templates which list tracks (_tracks_table.html and the search
+results), straight from a Core query rather than from ORM instances.
+
+Rendering a track from the ORM walks track.artists, track.features and track.album, one
+instrumented instance each, and calls key_str, mode_str and image_url on them as it goes.
+A TrackRow has all of that in one __slots__ object: the artists as (spotify_id, name)
+pairs in order, plus their names already joined; the audio features flattened, with the
+key and mode already named; and the album's thumbnail, which ingest picks out of its
+images (see models.thumbnail).
+
+snapshot.py builds its tracks with the same query, so the templates can't tell which
+they're given.
+"""
+
+from collections import namedtuple
+
+from models import key_name, mode_name
+
+ArtistRef = namedtuple('ArtistRef', ['spotify_id', 'name'])
+
+FEATURES = ('valence', 'danceability', 'energy', 'acousticness', 'instrumentalness', 'liveness',
+            'loudness', 'speechiness', 'tempo', 'time_signature')
+
+# {source} joins whatever picks the tracks to `t`, and {where} and {order} pick and order them
+TRACK_ROWS_SQL = """
+select t.track_id, t.spotify_id, t.name, t.spotify_url, t.preview_url, t.popularity,
+       album.name, {thumbnail},
+       (select group_concat(artist, char(30)) from (select a.spotify_id || char(31) || coalesce(a.name, '') artist
+         from track_artist ta join artist a on a.artist_id = ta.artist_id
+         where ta.track_id = t.track_id order by ta.rowid)) artists,
+       af.features_id, af.key, af.mode, {features}
+from {source}
+     left join album on album.album_id = t.album_id
+     left join audio_features af on af.track_id = t.track_id
+{where}
+{order}
+""".replace('{features}', ', '.join(f"af.{f}" for f in FEATURES))
+
+class TrackRow():
+    __slots__ = ('track_id', 'spotify_id', 'name', 'spotify_url', 'preview_url', 'popularity',
+                 'album_name', 'thumbnail_url', 'artists', 'artist_names', 'key_str', 'mode_str',
+                 'playlists') + FEATURES
+
+    def __init__(self, row):
+        (self.track_id, self.spotify_id, self.name, self.spotify_url, self.preview_url, self.popularity,
+         self.album_name, self.thumbnail_url, artists, features_id, key, mode) = row[:12]
+        self.artists = tuple(ArtistRef(*a.split('\x1f', 1)) for a in artists.split('\x1e')) if artists else ()
+        self.artist_names = ', '.join(a.name for a in self.artists)
+        if features_id is None:
+            # blank cells, as there were when the template found no track.features
+            self.key_str = self.mode_str = ''
+            for name in FEATURES:
+                setattr(self, name, '')
+        else:
+            self.key_str, self.mode_str = key_name(key), mode_name(mode)
+            for name, value in zip(FEATURES, row[12:]):
+                setattr(self, name, value)
+        self.playlists = ()
+
+def track_rows_sql(source='track t', where='', order='', thumbnails=True):
+    """The TrackRow query, for tracks from `source` (which joins them as `t`), picked by
+    `where` and ordered by `order`. The web app can't add columns, so it may have a database
+    which ingest hasn't upgraded yet; without `thumbnails`, there's no album.thumbnail_url."""
+    thumbnail = 'album.thumbnail_url' if thumbnails else 'null'
+    return TRACK_ROWS_SQL.format(source=source, where=where, order=order, thumbnail=thumbnail)